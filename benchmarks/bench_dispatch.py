@@ -0,0 +1,161 @@
+"""
+Micro-benchmark for the per-request overhead of ``site_dispatch``.
+
+Compares the original implementation, which copied the WSGI environ, scrubbed
+it of ``bfg.`` keys and built a new request for every call, against the
+precompiled ``DispatchTable``.  The instances dispatched to return a trivial
+WSGI application and are never busy, sharded or reloaded, so the numbers are
+the cost of routing alone.
+
+Usage::
+
+    bin/python benchmarks/bench_dispatch.py [n_instances] [iterations]
+"""
+import sys
+import timeit
+
+from pyramid.request import Request
+
+from karlserve.application import site_dispatch
+from karlserve.instance import DispatchTable
+
+
+def trivial_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['']
+
+
+class BenchInstance(object):
+    gate = None
+
+    def __init__(self, name):
+        self.name = name
+
+    def pipeline(self):
+        return trivial_app
+
+    def checkout(self):
+        return trivial_app, None
+
+    def checkin(self, generation):
+        pass
+
+
+class BenchInstances(object):
+
+    def __init__(self, n):
+        self.instances = dict(
+            ('instance%d' % i, BenchInstance('instance%d' % i))
+            for i in xrange(n))
+        self.virtual_hosts = dict(
+            ('instance%d.example.com:80' % i, 'instance%d' % i)
+            for i in xrange(0, n, 2))
+        self.root_instance = 'instance0'
+        self.sharding = None
+        self.dispatch_table = DispatchTable(self)
+
+    def check_config(self):
+        pass
+
+    def acquire(self, instance):
+        return instance
+
+    def release(self, instance):
+        pass
+
+    def get(self, name):
+        return self.instances.get(name)
+
+    def get_virtual_host(self, host):
+        return self.virtual_hosts.get(host)
+
+
+class BenchRegistry(object):
+
+    def __init__(self, instances):
+        self.settings = {'instances': instances}
+
+
+def legacy_site_dispatch(request):
+    """
+    The dispatcher as it was before the dispatch table was introduced.
+    """
+    instances = request.registry.settings['instances']
+    path = list(request.matchdict.get('subpath'))
+    host = request.host
+
+    environ = request.environ.copy()
+    for key in list(environ.keys()):
+        if key.startswith('bfg.'):
+            del environ[key]
+    request = request.__class__(environ)
+
+    if len(request.script_name) == 1:
+        request.script_name = ''
+
+    name = instances.get_virtual_host(host)
+    if not name and path:
+        name = path.pop(0)
+        instance = instances.get(name)
+        if instance is not None:
+            script_name = '/'.join((request.script_name, name))
+            path_info = '/' + '/'.join(path)
+            request.script_name = script_name
+            request.path_info = path_info
+    else:
+        instance = instances.get(name)
+
+    if instance is None:
+        name = instances.root_instance
+        if name is not None:
+            instance = instances.get(name)
+
+    return request.get_response(instance.pipeline())
+
+
+def make_request(registry, host, path):
+    request = Request.blank(path, environ={
+        'HTTP_HOST': host,
+        'SCRIPT_NAME': '/',
+        'bfg.routes.route': 'sites',
+        'bfg.routes.matchdict': {},
+        'HTTP_ACCEPT': 'text/html',
+        'HTTP_ACCEPT_LANGUAGE': 'en',
+        'HTTP_USER_AGENT': 'bench',
+        'HTTP_COOKIE': 'auth_tkt=foo',
+    })
+    request.registry = registry
+    request.matchdict = {'subpath': tuple(filter(None, path.split('/')))}
+    return request
+
+
+def bench(dispatch, registry, host, path, iterations):
+    def run():
+        dispatch(make_request(registry, host, path))
+    def baseline():
+        make_request(registry, host, path)
+    total = min(timeit.repeat(run, number=iterations, repeat=3))
+    setup = min(timeit.repeat(baseline, number=iterations, repeat=3))
+    return (total - setup) / iterations * 1e6
+
+
+def main(argv=sys.argv):
+    n_instances = int(argv[1]) if len(argv) > 1 else 50
+    iterations = int(argv[2]) if len(argv) > 2 else 20000
+    registry = BenchRegistry(BenchInstances(n_instances))
+    cases = [
+        ('path', 'localhost:80', '/instance1/communities/foo/view.html'),
+        ('vhost', 'instance2.example.com:80', '/communities/foo/view.html'),
+        ('root', 'localhost:80', '/communities/foo/view.html'),
+    ]
+    print '%d instances, %d iterations, usec per dispatch' % (
+        n_instances, iterations)
+    print '%-8s %10s %10s' % ('case', 'legacy', 'table')
+    for label, host, path in cases:
+        legacy = bench(legacy_site_dispatch, registry, host, path, iterations)
+        table = bench(site_dispatch, registry, host, path, iterations)
+        print '%-8s %10.2f %10.2f' % (label, legacy, table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Load generator comparing the throughput of the threaded and gevent servers
+at high client counts.
+
+Start the same configuration once with each server, on different ports::
+
+    bin/karlserve serve --port 6543
+    bin/karlserve-gevent serve --gevent --port 6544
+
+Then run the benchmark against a page of an instance on each::
+
+    bin/python benchmarks/bench_serve.py http://localhost:6543/foo/ \\
+        --clients 10,50,200,500 --duration 30
+    bin/python benchmarks/bench_serve.py http://localhost:6544/foo/ \\
+        --clients 10,50,200,500 --duration 30
+
+For each number of concurrent clients it reports requests per second, the
+median and 99th percentile latency, and the number of failed requests.  The
+threaded server's throughput levels off once every thread in its pool is
+busy waiting on PostgreSQL, blobs or the client, while the gevent server
+should keep scaling until the database or the CPU is saturated.  For a fair
+comparison psycogreen must be installed for the gevent server, the instance
+should be warmed up first and the client should run on a different machine
+than the server.  Slow clients can be simulated with ``--think``, which
+makes each client pause between requests, and ``--slow-read``, which makes
+each client read the response in small chunks.
+
+The load generator itself uses gevent, so that it can hold open more
+connections than the server under test.
+
+``wait_server.py`` serves a stand in for a page from either server, which
+waits 50ms for every request.  Against it, with the servers and the load
+generator sharing a single CPU and 10 second rounds::
+
+    threaded (Paste, 10 threads)                gevent (1000 greenlets)
+    clients  req/s  p50 ms  p99 ms  errors     req/s  p50 ms  p99 ms  errors
+         10  143.9    56.1   122.5       0     157.2    60.7   110.3       0
+         50  193.1   255.0   287.8       0     588.8    83.4   136.5       0
+        200  189.9  1034.3  1116.3       0     962.4   143.8  1403.6       0
+
+The threaded server tops out at its 10 threads over 50ms, less overhead,
+and queues everything else, while the gevent server keeps up with the
+clients until the CPU is saturated.  These numbers are an upper bound on
+the gain: real requests also spend CPU rendering pages, which greenlets
+don't parallelize, and without psycogreen the gevent server would serve one
+request at a time.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import time
+import urllib2
+
+import gevent
+
+
+def client(url, deadline, think, slow_read, latencies, errors):
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            response = urllib2.urlopen(url)
+            if slow_read:
+                while response.read(1024):
+                    gevent.sleep(slow_read)
+            else:
+                response.read()
+            response.close()
+        except Exception:
+            errors.append(1)
+        else:
+            latencies.append(time.time() - start)
+        if think:
+            gevent.sleep(think)
+
+
+def run(url, clients, duration, think, slow_read):
+    latencies = []
+    errors = []
+    start = time.time()
+    deadline = start + duration
+    greenlets = [gevent.spawn(client, url, deadline, think, slow_read,
+                              latencies, errors)
+                 for i in xrange(clients)]
+    gevent.joinall(greenlets)
+    elapsed = time.time() - start
+    latencies.sort()
+    if latencies:
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)]
+    else:
+        p50 = p99 = 0.0
+    print '%7d %10.1f %10.1f %10.1f %8d' % (
+        clients, len(latencies) / elapsed, p50 * 1000, p99 * 1000,
+        len(errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('url', help='URL to request.')
+    parser.add_argument('--clients', default='10,50,200,500',
+                        help='Comma separated numbers of concurrent clients.')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Seconds to run each round for.')
+    parser.add_argument('--think', type=float, default=0,
+                        help='Seconds each client waits between requests.')
+    parser.add_argument('--slow-read', type=float, default=0,
+                        help='Seconds each client waits between reading '
+                        'chunks of 1k of the response.')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='Number of requests made before measuring.')
+    args = parser.parse_args()
+
+    for i in xrange(args.warmup):
+        urllib2.urlopen(args.url).read()
+
+    print '%7s %10s %10s %10s %8s' % (
+        'clients', 'req/s', 'p50 ms', 'p99 ms', 'errors')
+    for clients in [int(n) for n in args.clients.split(',')]:
+        run(args.url, clients, args.duration, args.think, args.slow_read)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Serves a stand in for a Karl page, which waits a fixed time for every request
+as a request waits on PostgreSQL or blobs, from either server used by
+``karlserve serve``, for ``bench_serve.py`` to be run against.
+
+Usage::
+
+    bin/python benchmarks/wait_server.py threaded --port 6543
+    bin/python benchmarks/wait_server.py gevent --port 6544
+
+The threaded server is the Paste HTTP server with its default pool of 10
+threads, as ``karlserve serve`` runs it.  The gevent server is gevent's
+WSGI server with a pool of ``--connections`` greenlets, as
+``karlserve-gevent serve --gevent`` runs it.
+"""
+import argparse
+import sys
+
+
+def make_app(wait, size):
+    import time
+    body = 'x' * size
+
+    def app(environ, start_response):
+        time.sleep(wait)
+        start_response('200 OK', [('Content-Type', 'text/html'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('server', choices=['threaded', 'gevent'])
+    parser.add_argument('--port', type=int, default=6543)
+    parser.add_argument('--wait', type=float, default=0.05,
+                        help='Seconds each request waits.  Default: 0.05.')
+    parser.add_argument('--size', type=int, default=20000,
+                        help='Bytes in each response.  Default: 20000.')
+    parser.add_argument('--threads', type=int, default=10,
+                        help='Threads of the threaded server.  Default: 10.')
+    parser.add_argument('--connections', type=int, default=1000,
+                        help='Greenlets of the gevent server.  Default: '
+                        '1000.')
+    args = parser.parse_args()
+
+    if args.server == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+        app = make_app(args.wait, args.size)
+        server = WSGIServer(('127.0.0.1', args.port), app,
+                            spawn=Pool(args.connections), log=None)
+        server.serve_forever()
+    else:
+        from paste.httpserver import serve
+        app = make_app(args.wait, args.size)
+        serve(app, '127.0.0.1', args.port, use_threadpool=True,
+              threadpool_workers=args.threads)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,15 +1,22 @@
+import json
 import logging
 import os
 import time
 
+from karl.utils import asbool
 from pyramid.config import Configurator
 from pyramid.exceptions import NotFound
+from pyramid.httpexceptions import HTTPServiceUnavailable
+from pyramid.response import Response
 from repoze.depinj import lookup
 
+from karlserve.blobcache import get_blob_cache
+from karlserve.httpcache import get_response_cache
 from karlserve.instance import get_current_instance
 from karlserve.instance import get_instances
 from karlserve.instance import set_current_instance
 from karlserve.log import configure_log
+from karlserve.metrics import get_metrics
 from karlserve.scripts.utils import shell_capture
 
 log = logging.getLogger(__name__)
@@ -75,61 +82,110 @@ def make_app(global_config, **local_config):
 
     # Configure repoze.bfg application
     config = lookup(Configurator)(settings=settings)
+    metrics_path = settings.get('metrics_path')
+    if metrics_path:
+        config.add_route('metrics', metrics_path)
+        config.add_view(metrics_view, route_name='metrics')
     config.add_route('sites', '/*subpath')
     config.add_view(site_dispatch, route_name='sites')
 
     app = config.make_wsgi_app()
+
+    # Optionally spin up instances now, rather than on first request.  Only
+    # when the application is being loaded by `karlserve serve`, though, not
+    # by every script which loads it.
+    preload = settings.get('preload_instances')
+    if preload and asbool(settings.get('karlserve.serve')):
+        preload_instances(app.registry.settings, preload)
+
     return app
 
 
+def preload_instances(settings, preload):
+    """
+    Spins up instances in a thread pool.  `preload` is either a true value,
+    to spin up all instances, or a whitespace separated list of instance
+    names.
+    """
+    if preload.lower() in ('true', 'yes', 'on', '1', 'all'):
+        names = None
+    elif preload.lower() in ('false', 'no', 'off', '0', 'none'):
+        return
+    else:
+        names = preload.split()
+    threads = int(settings.get('preload_instances.threads', 4))
+    get_instances(settings).preload(names, threads)
+
+
+def metrics_view(request):
+    """
+    Reports the request metrics collected in this process as JSON.  Only
+    counters kept in memory are read, so no instance is ever spun up to serve
+    this view.
+    """
+    settings = request.registry.settings
+    instances = get_instances(settings)
+    report = {
+        'requests': get_metrics().report(),
+        'instances': instances.stats(),
+        'admission': instances.admission_stats(),
+        'caches': instances.cache_stats(),
+        'response_cache': get_response_cache(settings).stats(),
+    }
+    blobcache = get_blob_cache(settings, settings.get('blob_cache', ''))
+    if blobcache is not None:
+        report['blob_cache'] = blobcache.stats()
+    return Response(json.dumps(report, sort_keys=True, indent=2),
+                    content_type='application/json')
+
+
 def site_dispatch(request):
     instances = get_instances(request.registry.settings)
-    path = list(request.matchdict.get('subpath'))
-    host = request.host
-
-    # Copy request, getting rid of bfg keys from the environ
-    environ = request.environ.copy()
-    for key in list(environ.keys()):
-        if key.startswith('bfg.'):
-            del environ[key]
-    request = request.__class__(environ)
-
-    # nginx likes to set script name to '/' with screws up everybody
-    # trying to write urls and causes them to add an extra slash
-    if len(request.script_name) == 1:
-        request.script_name = ''
-
-    # See if we're in a virtual hosting environment
-    name = instances.get_virtual_host(host)
-    if not name and path:
-        # We are not in a virtual hosting environment, so the first element of
-        # the path_info is the name of the instance.
-        name = path.pop(0)
-
-        # Get the Karl instance to dispatch to
-        instance = instances.get(name)
-
-        # If we found the instance, rewrite paths for subrequest
-        if instance is not None:
-            script_name = '/'.join((request.script_name, name))
-            path_info = '/' + '/'.join(path)
-            request.script_name = script_name
-            request.path_info = path_info
+    instances.check_config()
+    environ = request.environ
 
-    else:
-        # Get the Karl instance to dispatch to
-        instance =  instances.get(name)
-
-    # If we still don't have an instance, see if one is defined as the root
-    # instance.
-    if instance is None:
-        name = instances.root_instance
-        if name is not None:
-            instance = instances.get(name)
+    # Get rid of the bfg routing keys from the environ so the Karl instance
+    # doesn't try to use our matchdict for its own traversal.
+    environ.pop('bfg.routes.route', None)
+    environ.pop('bfg.routes.matchdict', None)
 
+    name, instance = instances.dispatch_table.route(request.host, environ)
     if instance is None:
         raise NotFound
 
+    # If instances are sharded across workers, only serve our own.
+    sharding = instances.sharding
+    if sharding is not None and not sharding.is_local(name):
+        workers = ','.join(map(str, sharding.owners(name)))
+        return Response(
+            'Instance %s is served by workers %s.\n' % (name, workers),
+            status='421 Misdirected Request', content_type='text/plain',
+            headers=[('X-Karlserve-Workers', workers)])
+
+    # Turn the request away quickly if the instance is too busy, so one
+    # instance can't tie up every thread in the process.
+    gate = instance.gate
+    if gate is not None and not gate.enter():
+        log.warn("Instance %s is too busy, turning away request.", name)
+        return HTTPServiceUnavailable(
+            headers=[('Retry-After', str(gate.retry_after))])
+
     # Dispatch
     set_current_instance(name)
-    return request.get_response(instance.pipeline())
+    acquired = None
+    try:
+        # The instances config may have been reloaded since the request was
+        # routed, in which case another instance serves it.
+        acquired = instances.acquire(instance)
+        if acquired is None:
+            raise NotFound
+        pipeline, generation = acquired.checkout()
+        try:
+            return request.get_response(pipeline)
+        finally:
+            acquired.checkin(generation)
+    finally:
+        if acquired is not None:
+            instances.release(acquired)
+        if gate is not None:
+            gate.leave()
@@ -0,0 +1,240 @@
+from __future__ import with_statement
+
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from repoze.zodbconn.datatypes import byte_size
+
+log = logging.getLogger(__name__)
+
+_budgets = {}
+_lock = threading.Lock()
+
+
+def get_blob_cache(settings, root):
+    """
+    Returns the `BlobCacheBudget` for `root`, the folder containing the blob
+    caches of all of the instances, or `None` if no `blob_cache_budget` is set.
+    There is one per folder per process.
+    """
+    budget = settings.get('blob_cache_budget')
+    if not budget:
+        return None
+    root = os.path.abspath(root)
+    with _lock:
+        cache = _budgets.get(root)
+        if cache is None or cache.pid != os.getpid():
+            cache = BlobCacheBudget(
+                root, byte_size(budget),
+                interval=float(settings.get(
+                    'blob_cache_budget.interval', 300)),
+                window=float(settings.get(
+                    'blob_cache_budget.window', 3600)),
+            )
+            _budgets[root] = cache
+    return cache
+
+
+class BlobCacheBudget(object):
+    """
+    Keeps the blob caches of all of the instances on a host, which are the
+    folders in `root`, within a single `budget` in bytes.
+
+    Every `interval` seconds a background thread measures each instance's
+    cache.  If together they are over budget, the budget is split between the
+    instances in proportion to the bytes of blobs each has served in the last
+    `window` seconds, and the least recently used blobs of instances over their
+    share are removed.  The storages record when a blob is used in its access
+    time, so this works across all of the processes on the host.  A lock file
+    in `root` makes sure only one process at a time sweeps the caches.
+
+    Blob cache hits and misses are counted per instance, for the storages
+    passed to `watch`.
+    """
+    # Part of the budget split evenly between instances, so that an instance
+    # which hasn't served any blobs lately keeps a few.
+    floor = 0.1
+
+    def __init__(self, root, budget, interval=300, window=3600):
+        self.root = root
+        self.budget = budget
+        self.interval = interval
+        self.window = window
+        self.pid = os.getpid()
+        self.counters = {}
+        self.sizes = {}
+        self.shares = {}
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def watch(self, name, storage):
+        """
+        Counts blob cache hits and misses of `storage` for the named instance
+        and starts the background sweeps, if they haven't started yet.
+        """
+        with self._lock:
+            if name not in self.counters:
+                self.counters[name] = [0, 0]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+        _instrument(storage, lambda hit: self.record(name, hit))
+
+    def record(self, name, hit):
+        counters = self.counters.get(name)
+        if counters is None:
+            counters = self.counters.setdefault(name, [0, 0])
+        if hit:
+            counters[0] += 1
+        else:
+            counters[1] += 1
+
+    def stats(self):
+        """
+        Returns a mapping of instance name to cache hits and misses in this
+        process and the cache size and share of the budget as of the last
+        sweep.
+        """
+        stats = {}
+        for name in set(self.counters) | set(self.sizes):
+            hits, misses = self.counters.get(name, (0, 0))
+            stats[name] = {
+                'hits': hits,
+                'misses': misses,
+                'size': self.sizes.get(name, 0),
+                'share': self.shares.get(name, 0),
+            }
+        return stats
+
+    def close(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sweep()
+            except:
+                log.exception("Error sweeping blob caches in %s", self.root)
+
+    def sweep(self):
+        """
+        Measures the blob caches and evicts blobs if they are over budget.
+        Returns the number of bytes evicted, or `None` if another process is
+        sweeping.
+        """
+        lock = open(os.path.join(self.root, '.karlserve_blobcache.lock'), 'w')
+        try:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return None
+            return self._sweep()
+        finally:
+            lock.close()
+
+    def _sweep(self):
+        since = time.time() - self.window
+        caches = {}
+        sizes = {}
+        recent = {}
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path):
+                continue
+            blobs = _list_blobs(path)
+            caches[name] = blobs
+            sizes[name] = sum(size for atime, size, fname in blobs)
+            recent[name] = sum(size for atime, size, fname in blobs
+                               if atime >= since)
+        self.sizes = sizes
+        self.shares = shares = self._shares(recent)
+
+        evicted = 0
+        if sum(sizes.values()) > self.budget:
+            for name, blobs in caches.items():
+                excess = sizes[name] - shares[name]
+                if excess <= 0:
+                    continue
+                blobs.sort()
+                for atime, size, fname in blobs:
+                    if excess <= 0:
+                        break
+                    try:
+                        os.remove(fname)
+                    except OSError:
+                        continue
+                    excess -= size
+                    evicted += size
+                sizes[name] = shares[name] + excess
+            self.evicted += evicted
+            log.info("Evicted %d bytes of blobs from %s.", evicted, self.root)
+        return evicted
+
+    def _shares(self, recent):
+        if not recent:
+            return {}
+        total = sum(recent.values())
+        if not total:
+            share = self.budget / len(recent)
+            return dict((name, share) for name in recent)
+        floor = self.budget * self.floor / len(recent)
+        rest = self.budget * (1 - self.floor)
+        return dict((name, int(floor + rest * traffic / total))
+                    for name, traffic in recent.items())
+
+
+def _list_blobs(path):
+    blobs = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fname in filenames:
+            if not fname.endswith('.blob'):
+                continue
+            fname = os.path.join(dirpath, fname)
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            blobs.append((st.st_atime, st.st_size, fname))
+    return blobs
+
+
+def _blob_filename(storage, oid, serial):
+    fshelper = getattr(storage, 'fshelper', None)
+    if fshelper is None:
+        blobhelper = getattr(storage, 'blobhelper', None)
+        fshelper = getattr(blobhelper, 'fshelper', None)
+    if fshelper is None:
+        return None
+    return fshelper.getBlobFilename(oid, serial)
+
+
+def _instrument(storage, record):
+    """
+    Wraps `storage.loadBlob` to call `record` with whether the blob was already
+    in the cache.  MVCC storages, like RelStorage, give each connection its own
+    instance of the storage, so those are wrapped too.
+    """
+    load_blob = getattr(storage, 'loadBlob', None)
+    if load_blob is None:
+        return
+
+    def loadBlob(oid, serial):
+        fname = _blob_filename(storage, oid, serial)
+        if fname is not None:
+            record(os.path.exists(fname))
+        return load_blob(oid, serial)
+    storage.loadBlob = loadBlob
+
+    new_instance = getattr(storage, 'new_instance', None)
+    if new_instance is not None:
+        def new_instance_w_counters():
+            instance = new_instance()
+            _instrument(instance, record)
+            return instance
+        storage.new_instance = new_instance_w_counters
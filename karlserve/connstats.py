@@ -0,0 +1,325 @@
+from __future__ import with_statement
+
+import atexit
+import datetime
+import fcntl
+import logging
+import os
+import Queue
+import threading
+import time
+import transaction
+
+from repoze.zodbconn.datatypes import byte_size
+
+log = logging.getLogger(__name__)
+
+_writers = {}
+_lock = threading.Lock()
+
+
+def get_stats_writer(settings):
+    """
+    Returns the `StatsWriter` for the file named by the
+    `connection_stats_filename` setting, or `None` if connection statistics
+    are not being logged.  There is one writer per file per process.
+    """
+    filename = settings.get('connection_stats_filename')
+    if filename is None:
+        return None
+    filename = os.path.abspath(filename)
+    with _lock:
+        writer = _writers.get(filename)
+        if writer is None or writer.pid != os.getpid():
+            max_bytes = settings.get('connection_stats_max_bytes')
+            writer = StatsWriter(
+                filename,
+                queue_size=int(settings.get(
+                    'connection_stats_queue_size', 10000)),
+                flush_interval=float(settings.get(
+                    'connection_stats_flush_interval', 1.0)),
+                max_bytes=byte_size(max_bytes) if max_bytes else 0,
+                backup_count=int(settings.get(
+                    'connection_stats_backup_count', 5)),
+            )
+            _writers[filename] = writer
+    return writer
+
+
+# Per thread counters of storage activity not covered by the connection's
+# transfer counts.  Requests are served by a single thread (or greenlet), so
+# the difference between two readings is the activity of the request.
+COUNTERS = ('bytes_loaded', 'blob_opens', 'blob_bytes', 'round_trips')
+_counters = threading.local()
+
+
+def count(name, n=1):
+    setattr(_counters, name, getattr(_counters, name, 0) + n)
+
+
+def read_counters():
+    return dict([(name, getattr(_counters, name, 0)) for name in COUNTERS])
+
+
+class CountingCursor(object):
+    """
+    Proxy for a DB-API cursor which counts each statement it executes as a
+    round trip to the database.
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, *args, **kw):
+        count('round_trips')
+        return self._cursor.execute(*args, **kw)
+
+    def executemany(self, *args, **kw):
+        count('round_trips')
+        return self._cursor.executemany(*args, **kw)
+
+    def callproc(self, *args, **kw):
+        count('round_trips')
+        return self._cursor.callproc(*args, **kw)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def instrument_storage(storage):
+    """
+    Wraps the methods of `storage` which load object records and blobs so that
+    the bytes loaded and blobs opened are counted and, for RelStorage, the SQL
+    statements executed.  MVCC storages, like RelStorage, give each connection
+    its own instance of the storage, so those are wrapped too.
+    """
+    if getattr(storage, '_karlserve_counted', False):
+        return
+    storage._karlserve_counted = True
+
+    for name in ('load', 'loadBefore', 'loadSerial'):
+        method = getattr(storage, name, None)
+        if method is not None:
+            setattr(storage, name, _count_load(method))
+
+    for name in ('loadBlob', 'openCommittedBlobFile'):
+        method = getattr(storage, name, None)
+        if method is not None:
+            setattr(storage, name, _count_blob(method))
+
+    connmanager = getattr(getattr(storage, '_adapter', None),
+                          'connmanager', None)
+    if connmanager is not None and hasattr(connmanager, 'open'):
+        open_ = connmanager.open
+
+        def open_w_counter(*args, **kw):
+            conn, cursor = open_(*args, **kw)
+            return conn, CountingCursor(cursor)
+        connmanager.open = open_w_counter
+
+    new_instance = getattr(storage, 'new_instance', None)
+    if new_instance is not None:
+        def new_instance_w_counters():
+            instance = new_instance()
+            instrument_storage(instance)
+            return instance
+        storage.new_instance = new_instance_w_counters
+
+
+def _count_load(load):
+    def wrapper(*args, **kw):
+        result = load(*args, **kw)
+        if result:
+            data = result[0]
+            if data:
+                count('bytes_loaded', len(data))
+        return result
+    return wrapper
+
+
+def _count_blob(load_blob):
+    def wrapper(*args, **kw):
+        result = load_blob(*args, **kw)
+        count('blob_opens')
+        if isinstance(result, basestring):
+            fname = result
+        else:
+            fname = getattr(result, 'name', None)
+        if fname:
+            try:
+                count('blob_bytes', os.path.getsize(fname))
+            except OSError:
+                pass
+        return result
+    return wrapper
+
+
+class RequestStats(object):
+    """
+    Measurements of a single request's use of its ZODB connection.  Created
+    once the request has its connection; `finish` is called when the request
+    is finished, before the connection is closed.  `retry` is called if
+    ``pyramid_tm`` retries the request after a conflict error.
+    """
+    elapsed = 0.0
+    commit_time = 0.0
+    retries = 0
+    _commit_start = None
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.start = time.time()
+        self._loads, self._stores = connection.getTransferCounts()
+        self._counters = read_counters()
+        self._watch_commit()
+
+    def _watch_commit(self):
+        txn = transaction.get()
+        txn.addBeforeCommitHook(self._commit_started)
+        txn.addAfterCommitHook(self._commit_finished)
+
+    def _commit_started(self):
+        self._commit_start = time.time()
+
+    def _commit_finished(self, status):
+        if self._commit_start is not None:
+            self.commit_time += time.time() - self._commit_start
+            self._commit_start = None
+
+    def retry(self):
+        # Each attempt runs in a new transaction.
+        self.retries += 1
+        self._watch_commit()
+
+    def finish(self):
+        self.elapsed = time.time() - self.start
+        loads, stores = self.connection.getTransferCounts()
+        self.loads = loads - self._loads
+        self.stores = stores - self._stores
+        counters = read_counters()
+        for name in COUNTERS:
+            setattr(self, name, counters[name] - self._counters[name])
+
+    def csv_line(self, request):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return ('"%s", "%s", "%s", %f, %d, %d, %f, %d, %d, %d, %d, %d\n' % (
+            now,
+            request.method,
+            request.path_url,
+            self.elapsed,
+            self.loads,
+            self.stores,
+            self.commit_time,
+            self.bytes_loaded,
+            self.blob_opens,
+            self.blob_bytes,
+            self.round_trips,
+            self.retries,
+        ))
+
+
+class StatsWriter(object):
+    """
+    Appends lines to a statistics file from a background thread, so request
+    threads never wait on the filesystem.  Lines are queued in a bounded queue
+    and written in batches every `flush_interval` seconds.  If the queue is
+    full, lines are dropped and counted in `dropped`.  If `max_bytes` is set,
+    the file is rotated when it grows past that size, keeping `backup_count`
+    old files.
+
+    Several processes, eg prefork workers, may share the file.  Each batch is
+    appended, and the file rotated, while holding an exclusive lock on a
+    ``.lock`` file next to it, so only one process at a time rotates the file
+    and no process appends to a file another one just rotated.
+    """
+    dropped = 0
+    written = 0
+    _stop = object()
+
+    def __init__(self, filename, queue_size=10000, flush_interval=1.0,
+                 max_bytes=0, backup_count=5):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self.thread = thread = threading.Thread(
+            target=self._run, name='connstats-writer')
+        thread.setDaemon(True)
+        thread.start()
+        atexit.register(self.close)
+
+    def write(self, line):
+        try:
+            self.queue.put_nowait(line)
+        except Queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def close(self):
+        if self.thread.isAlive():
+            self.queue.put(self._stop)
+            self.thread.join()
+
+    def _run(self):
+        queue = self.queue
+        reported_dropped = 0
+        while True:
+            lines = [queue.get()]
+            deadline = time.time() + self.flush_interval
+            while lines[-1] is not self._stop:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    lines.append(queue.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+
+            stop = lines[-1] is self._stop
+            if stop:
+                lines.pop()
+            if lines:
+                try:
+                    self._write(lines)
+                except (IOError, OSError):
+                    log.error("Unable to write connection statistics to %s",
+                              self.filename, exc_info=True)
+
+            dropped = self.dropped
+            if dropped != reported_dropped:
+                log.warn("Dropped %d connection statistics lines: queue full.",
+                         dropped - reported_dropped)
+                reported_dropped = dropped
+
+            if stop:
+                return
+
+    def _write(self, lines):
+        lock = open(self.filename + '.lock', 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.max_bytes and os.path.exists(self.filename):
+                if os.path.getsize(self.filename) >= self.max_bytes:
+                    self._rotate()
+            with open(self.filename, 'a') as f:
+                f.write(''.join(lines))
+        finally:
+            lock.close()
+        self.written += len(lines)
+
+    def _rotate(self):
+        filename = self.filename
+        for i in xrange(self.backup_count - 1, 0, -1):
+            src = '%s.%d' % (filename, i)
+            if os.path.exists(src):
+                os.rename(src, '%s.%d' % (filename, i + 1))
+        if self.backup_count:
+            os.rename(filename, filename + '.1')
+        else:
+            os.remove(filename)
@@ -0,0 +1,382 @@
+from __future__ import with_statement
+
+import hashlib
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:  # Python < 2.7
+    from ordereddict import OrderedDict
+from Cookie import CookieError
+from Cookie import SimpleCookie
+from email.utils import formatdate
+from persistent.TimeStamp import TimeStamp
+from repoze.zodbconn.datatypes import byte_size
+from ZODB.utils import p64
+from ZODB.utils import u64
+
+
+def last_transaction(environ, app):
+    """
+    Returns the id of the last transaction committed to the main database of
+    the Karl instance `app`, as an integer.  It is looked up at most once per
+    request.  A connection is opened, rather than asking the database, so that
+    MVCC storages, like RelStorage, poll for transactions committed by other
+    processes.
+    """
+    tid = environ.get('karlserve.tid')
+    if tid is None:
+        db = app.registry._zodb_databases['']
+        conn = db.open()
+        try:
+            tid = u64(conn._storage.lastTransaction())
+        finally:
+            conn.close()
+        environ['karlserve.tid'] = tid
+    return tid
+
+
+def is_anonymous(environ, cookie_name):
+    """
+    Returns whether a request carries no credentials, in which case the
+    response doesn't depend on who is asking.
+    """
+    if 'HTTP_AUTHORIZATION' in environ:
+        return False
+    cookie = environ.get('HTTP_COOKIE')
+    if cookie and cookie_name in cookie:
+        try:
+            return cookie_name not in SimpleCookie(cookie)
+        except CookieError:
+            return False
+    return True
+
+
+def credentials(environ, cookie_name):
+    """
+    Returns the credentials a request carries, as a string, or an empty string
+    for an anonymous request.
+    """
+    if is_anonymous(environ, cookie_name):
+        return ''
+    value = environ.get('HTTP_AUTHORIZATION', '')
+    try:
+        morsel = SimpleCookie(environ.get('HTTP_COOKIE', '')).get(cookie_name)
+    except CookieError:
+        morsel = None
+    if morsel is not None:
+        value += morsel.value
+    return value
+
+
+def request_url(environ):
+    url = [environ['wsgi.url_scheme'], '://', environ.get('HTTP_HOST', ''),
+           environ.get('SCRIPT_NAME', ''), environ.get('PATH_INFO', '')]
+    query = environ.get('QUERY_STRING')
+    if query:
+        url.extend(['?', query])
+    return ''.join(url)
+
+
+class ResponseCache(object):
+    """
+    LRU cache of responses to anonymous GET requests, shared by all of the
+    instances in a process and bounded by the total size of the cached
+    bodies, `max_bytes`.
+
+    Responses are keyed on the instance, URL, the request headers named by
+    the response's Vary header and the id of the last transaction committed to
+    the instance's database.  A commit changes the key, so cached responses
+    are never stale as far as the database is concerned.  Entries for old
+    transactions are dropped as soon as a newer transaction is seen.
+    """
+
+    def __init__(self, max_bytes=64 << 20, max_entry=1 << 20):
+        self.max_bytes = max_bytes
+        self.max_entry = max_entry
+        self.bytes = 0
+        self.counters = {}
+        self._entries = OrderedDict()  # key -> (status, headers, body)
+        self._keys = {}  # instance -> (tid, set of keys)
+        self._vary = {}  # (instance, url) -> names of varying headers
+        self._lock = threading.Lock()
+
+    def key(self, instance, url, tid, environ):
+        vary = self._vary.get((instance, url), ())
+        return (instance, url, tid,
+                tuple([environ.get(header) for header in vary]))
+
+    def get(self, instance, key):
+        with self._lock:
+            counters = self._counters(instance)
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                counters['misses'] += 1
+                return None
+            self._entries[key] = entry
+            counters['hits'] += 1
+            return entry
+
+    def set(self, instance, url, tid, environ, status, headers, body):
+        vary = []
+        for name, value in headers:
+            if name.lower() == 'vary':
+                vary.extend([v.strip() for v in value.split(',')])
+        if '*' in vary:
+            return
+        vary = tuple(['HTTP_%s' % v.upper().replace('-', '_') for v in vary])
+        size = len(body)
+        with self._lock:
+            if not self._discard_older(instance, tid):
+                return
+            self._vary[(instance, url)] = vary
+            key = self.key(instance, url, tid, environ)
+            self._remove(key)
+            self._entries[key] = (status, headers, body)
+            self._keys[instance][1].add(key)
+            self.bytes += size
+            self._counters(instance)['stores'] += 1
+            while self.bytes > self.max_bytes:
+                self._remove(iter(self._entries).next())
+
+    def stats(self):
+        """
+        Returns a mapping of instance name to hits, misses and stores, along
+        with the number of responses and bytes cached for it.
+        """
+        with self._lock:
+            stats = {}
+            for instance, counters in self.counters.items():
+                keys = self._keys.get(instance, (None, ()))[1]
+                stats[instance] = dict(counters)
+                stats[instance]['entries'] = len(keys)
+                stats[instance]['bytes'] = sum(
+                    [len(self._entries[key][2]) for key in keys])
+            return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+            self._vary.clear()
+            self.bytes = 0
+
+    def _counters(self, instance):
+        counters = self.counters.get(instance)
+        if counters is None:
+            counters = self.counters[instance] = {
+                'hits': 0, 'misses': 0, 'stores': 0}
+        return counters
+
+    def _discard_older(self, instance, tid):
+        # Must be called with self._lock held.  Returns False if responses for
+        # a later transaction have already been cached.
+        seen = self._keys.get(instance)
+        if seen is not None:
+            if seen[0] > tid:
+                return False
+            if seen[0] == tid:
+                return True
+            for key in list(seen[1]):
+                self._remove(key)
+            for key in [key for key in self._vary if key[0] == instance]:
+                del self._vary[key]
+        self._keys[instance] = (tid, set())
+        return True
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry[2])
+            seen = self._keys.get(key[0])
+            if seen is not None:
+                seen[1].discard(key)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache(settings):
+    """
+    Returns the `ResponseCache` for this process, sized by the
+    `response_cache.max_bytes` and `response_cache.max_entry` settings.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(
+                    byte_size(settings.get('response_cache.max_bytes',
+                                           '64mb')),
+                    byte_size(settings.get('response_cache.max_entry',
+                                           '1mb')))
+    return _cache
+
+
+class ResponseCacheMiddleware(object):
+    """
+    Serves anonymous GET and HEAD requests from a `ResponseCache`, without
+    calling the application, as long as nothing has been committed to the
+    instance's database since the response was cached.  Only complete ``200
+    OK`` responses which don't set cookies and aren't marked private are
+    cached.
+    """
+
+    def __init__(self, app, karl, name, cache, cookie_name='auth_tkt'):
+        self.app = app
+        self.karl = karl
+        self.name = name
+        self.cache = cache
+        self.cookie_name = cookie_name
+
+    def __call__(self, environ, start_response):
+        if (environ['REQUEST_METHOD'] not in ('GET', 'HEAD') or
+                not is_anonymous(environ, self.cookie_name)):
+            return self.app(environ, start_response)
+
+        cache = self.cache
+        url = request_url(environ)
+        tid = last_transaction(environ, self.karl)
+        entry = cache.get(self.name, cache.key(self.name, url, tid, environ))
+        if entry is not None:
+            status, headers, body = entry
+            start_response(status, list(headers))
+            if environ['REQUEST_METHOD'] == 'HEAD':
+                return []
+            return [body]
+
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info is None]
+            write = start_response(status, headers, exc_info)
+
+            def capture_write(data):
+                captured[2] = False
+                write(data)
+            return capture_write
+
+        app_iter = self.app(environ, capture)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return app_iter
+
+        def store(body):
+            status, headers, complete = captured
+            if complete and _cacheable(status, headers):
+                cache.set(self.name, url, tid, environ, status, headers, body)
+
+        return _CapturingIterable(app_iter, cache.max_entry, store)
+
+
+def _cacheable(status, headers):
+    if not status.startswith('200'):
+        return False
+    for name, value in headers:
+        name = name.lower()
+        if name == 'set-cookie':
+            return False
+        if name == 'cache-control':
+            value = value.lower()
+            if 'private' in value or 'no-store' in value:
+                return False
+    return True
+
+
+class _CapturingIterable(object):
+    """
+    Passes the body of a response through, keeping a copy of it, and calls
+    `store` with the copy once the body has been sent completely, unless it is
+    bigger than `max_size`.
+    """
+
+    def __init__(self, app_iter, max_size, store):
+        self.app_iter = app_iter
+        self.max_size = max_size
+        self.store = store
+        self.chunks = []
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.app_iter:
+            if self.chunks is not None:
+                self.size += len(chunk)
+                if self.size > self.max_size:
+                    self.chunks = None
+                else:
+                    self.chunks.append(chunk)
+            yield chunk
+        if self.chunks is not None:
+            self.store(''.join(self.chunks))
+            self.chunks = None
+
+    def close(self):
+        close = getattr(self.app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+class ConditionalGetMiddleware(object):
+    """
+    Adds an ETag and a Last-Modified header, derived from the id of the last
+    transaction committed to the instance's database, to successful responses
+    to GET and HEAD requests, and answers requests whose ``If-None-Match``
+    header holds the current ETag with ``304 Not Modified``, without calling
+    the application.
+
+    The ETag also depends on the user's credentials, since pages differ per
+    user, and on `salt`, which should change when a new version of the
+    software is deployed.  The Last-Modified date depends on neither, so
+    ``If-Modified-Since`` alone never gets a ``304``.
+    """
+
+    def __init__(self, app, karl, salt='', cookie_name='auth_tkt'):
+        self.app = app
+        self.karl = karl
+        self.salt = salt
+        self.cookie_name = cookie_name
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return self.app(environ, start_response)
+
+        tid = last_transaction(environ, self.karl)
+        user = hashlib.md5(self.salt + credentials(
+            environ, self.cookie_name)).hexdigest()[:16]
+        etag = '"%016x-%s"' % (tid, user)
+        modified = int(TimeStamp(p64(tid)).timeTime())
+        validators = [('ETag', etag),
+                      ('Last-Modified', formatdate(modified, usegmt=True))]
+
+        if _not_modified(environ, etag):
+            start_response('304 Not Modified', validators)
+            return []
+
+        def add_validators(status, headers, exc_info=None):
+            if status.startswith('200') and _validatable(headers):
+                headers = list(headers) + validators
+            return start_response(status, headers, exc_info)
+
+        return self.app(environ, add_validators)
+
+
+def _validatable(headers):
+    for name, value in headers:
+        name = name.lower()
+        if name in ('etag', 'last-modified', 'set-cookie'):
+            return False
+        if name == 'cache-control' and 'no-store' in value.lower():
+            return False
+    return True
+
+
+def _not_modified(environ, etag):
+    # Only a client holding our own ETag for this user and deployment can be
+    # told its copy is current.  When If-None-Match is sent,
+    # If-Modified-Since is to be ignored (RFC 7232, section 3.3).
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+    return etag in tags
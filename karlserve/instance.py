@@ -1,9 +1,12 @@
 from __future__ import with_statement
 
 import ConfigParser
-import datetime
+import hashlib
+import logging
 import os
 import pickle
+import pkg_resources
+import Queue
 import shutil
 import sys
 import tempfile
@@ -11,17 +14,37 @@ import time
 import threading
 import transaction
 
+try:
+    from collections import OrderedDict
+except ImportError:  # Python < 2.7
+    from ordereddict import OrderedDict
 from persistent.mapping import PersistentMapping
 from pyramid.config import Configurator
 from pyramid.util import DottedNameResolver
+from pyramid_zodbconn import db_from_uri as zodbconn_db_from_uri
 from pyramid_zodbconn import get_connection
+from pyramid_zodbconn import get_uris
+from pyramid_zodbconn import includeme as zodbconn_includeme
 from repoze.depinj import lookup
 from repoze.urchin import UrchinMiddleware
-from ZODB.DB import DB
-from zodburi import resolve_uri
+from repoze.zodbconn.datatypes import byte_size
+from ZODB.utils import u64
 from zope.component import queryUtility
 
+from karlserve.blobcache import get_blob_cache
+from karlserve.connstats import RequestStats
+from karlserve.connstats import get_stats_writer
+from karlserve.connstats import instrument_storage
+from karlserve.httpcache import ConditionalGetMiddleware
+from karlserve.httpcache import ResponseCacheMiddleware
+from karlserve.httpcache import get_response_cache
 from karlserve.log import set_subsystem
+from karlserve.metrics import get_metrics
+from karlserve.metrics import route_name
+from karlserve.storage import RelStorageFactory
+from karlserve.storage import db_from_karlserve_uri
+from karlserve.storage import register_database
+from karlserve.storage import unregister_database
 from karlserve.textindex import KarlPGTextIndex
 
 import karl.includes
@@ -48,6 +71,8 @@ from repoze.retry import RetryException
 retryable = (IntegrityError, TransactionRollbackError,
     ConflictError, RetryException,)
 
+log = logging.getLogger(__name__)
+
 
 def get_instances(settings):
     instances = settings.get('instances')
@@ -62,7 +87,14 @@ class _InstanceProperty(object):
     Descriptor for storing a property of an instance that can't be stored in
     the database for that instance. These properties are stored as pickles in
     var/instance/<instance_name>/<property_name> in the filesystem.
+
+    Values are cached on the instance.  The file is only stat'ed again once
+    `check_interval` seconds have passed since the last check, and only
+    reloaded if it has changed, so changes made by other processes are seen
+    within `check_interval` seconds.
     """
+    check_interval = 2.0
+
     def __init__(self, name, default=None):
         self.name = name
         self.default = default
@@ -71,11 +103,39 @@ class _InstanceProperty(object):
     def _fname(self, instance):
         return os.path.join(instance.config['var_instance'], self.name)
 
+    def _stamp(self, fname):
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def _cache(self, instance):
+        cache = instance.__dict__.get('_property_cache')
+        if cache is None:
+            cache = instance.__dict__['_property_cache'] = {}
+        return cache
+
     def __get__(self, instance, cls):
+        if instance is None:
+            return self
+        cache = self._cache(instance)
+        now = time.time()
+        cached = cache.get(self.name)
+        if cached is not None and now - cached[2] < self.check_interval:
+            return cached[0]
+
         fname = self._fname(instance)
-        if not os.path.exists(fname):
-            return self.default
-        return pickle.load(open(fname))
+        stamp = self._stamp(fname)
+        if cached is not None and stamp == cached[1]:
+            value = cached[0]
+        elif stamp is None:
+            value = self.default
+        else:
+            with open(fname) as f:
+                value = pickle.load(f)
+        cache[self.name] = (value, stamp, now)
+        return value
 
     def __set__(self, instance, value):
         fname = self._fname(instance)
@@ -86,8 +146,14 @@ class _InstanceProperty(object):
             folder = os.path.dirname(fname)
             if not os.path.exists(folder):
                 os.makedirs(folder)
-            with open(fname, 'w') as f:
+            # Write to a temporary file and rename it into place, so readers
+            # in other processes never see a partially written file.
+            tmp = '%s.%d.tmp' % (fname, os.getpid())
+            with open(tmp, 'w') as f:
                 pickle.dump(value, f)
+            os.rename(tmp, fname)
+        self._cache(instance)[self.name] = (
+            value, self._stamp(fname), time.time())
 
 
 class Instances(object):
@@ -95,12 +161,102 @@ class Instances(object):
 
     def __init__(self, settings):
         self.settings = settings
-        ini_file = settings['instances_config']
+        self.ini_file = settings['instances_config']
+        self._config_stamp = _file_stamp(self.ini_file)
+        sections, virtual_hosts, root_instance = self._read_config()
+        self._zodb_sizes = self._autosize(len(sections))
+        instances = {}
+        for name, options in sections.items():
+            instances[name] = self._make_instance(name, options)
+
+        self.instances = instances
+        self.virtual_hosts = virtual_hosts
+        self.root_instance = root_instance
+        self.dispatch_table = DispatchTable(self)
+
+        # Eviction policy for live instances.  A value of 0 for any of these
+        # disables that part of the policy.
+        self.max_live = int(settings.get('instances.max_live', 0))
+        self.idle_ttl = float(settings.get('instances.idle_ttl', 0))
+        memory_budget = settings.get('instances.memory_budget')
+        if memory_budget:
+            self.memory_budget = byte_size(memory_budget)
+        else:
+            self.memory_budget = 0
+        self.evictions = 0
+        self._live = OrderedDict()  # name -> instance, least recent first
+        self._retired = []  # replaced instances waiting to be closed
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+
+        # Assignment of instances to worker processes.
+        self.sharding = None
+        shard_workers = int(settings.get('sharding.workers', 0))
+        if shard_workers:
+            self.sharding = Sharding(
+                shard_workers,
+                int(settings.get('sharding.replicas', 1)),
+                settings.get('sharding.worker_id'))
+
+        # Reloading of the instances config.  0 disables.
+        self.reload_interval = float(
+            settings.get('instances_config.reload_interval', 0))
+        self._last_config_check = time.time()
+        self._reload_lock = threading.Lock()
+
+    def _autosize(self, count):
+        """
+        If `zodb.autosize` is set, works out ZODB settings for each instance
+        from the number of server threads and a memory budget for the
+        process, rather than using fixed numbers of connections and objects.
+        ``karlserve serve`` sets `karlserve.server_threads` to the number of
+        requests the server in use serves at once: the Paste server's thread
+        pool size, a prefork worker's threads or gevent's connections.
+
+        Each thread can use one connection to an instance at a time, so the
+        pool has a connection per thread.  `zodb.memory_budget` is split
+        evenly between the instances which can be live in the process at
+        once, and between the connections to each, as the byte size limit of
+        each connection's object cache.
+        """
+        settings = self.settings
+        if not asbool(settings.get('zodb.autosize', False)):
+            return {}
+        threads = int(settings.get('karlserve.server_threads', 10))
+        sizes = {'zodb.pool_size': threads}
+        budget = settings.get('zodb.memory_budget')
+        if budget:
+            live = count
+            workers = int(settings.get('sharding.workers', 0))
+            if workers:
+                replicas = int(settings.get('sharding.replicas', 1))
+                live = -(-count * min(replicas, workers) // workers)
+            max_live = int(settings.get('instances.max_live', 0))
+            if max_live:
+                live = min(live, max_live)
+            sizes['zodb.cache_size_bytes'] = (
+                byte_size(budget) // max(live, 1) // threads)
+            # Let the byte size limit govern the size of the caches.
+            sizes['zodb.cache_size'] = 1000000
+        return sizes
+
+    def _make_instance(self, name, options):
+        instance = LazyInstance(name, self.settings, options)
+        config = instance.config
+        for key, value in self._zodb_sizes.items():
+            if key == 'zodb.pool_size' and instance.gate is not None:
+                value = min(value, instance.gate.max_concurrency)
+            config.setdefault(key, str(value))
+        return instance
+
+    def _read_config(self):
+        ini_file = self.ini_file
         here = os.path.dirname(os.path.abspath(ini_file))
         config = ConfigParser.ConfigParser(dict(here=here))
         config.read(ini_file)
-        instances = {}
+        sections = {}
         virtual_hosts = {}
+        root_instance = None
         for section in config.sections():
             if not section.startswith('instance:'):
                 continue
@@ -111,21 +267,299 @@ class Instances(object):
                 if option.endswith('keep_history'):
                     value = asbool(value)
                 options[option] = value
-            instances[name] = LazyInstance(name, settings, options)
+            sections[name] = options
             virtual_host = options.get('virtual_host')
             if virtual_host:
                 for host in virtual_host.split():
                     host = host.strip()
                     virtual_hosts[host] = name
             if asbool(options.get('root', 'false')):
-                self.root_instance = name
-
-        self.instances = instances
-        self.virtual_hosts = virtual_hosts
+                root_instance = name
+        return sections, virtual_hosts, root_instance
+
+    def check_config(self):
+        """
+        If reloading is enabled, checks, at most every `reload_interval`
+        seconds, whether the instances config file has changed.  If it has,
+        it is reloaded in a background thread.
+        """
+        interval = self.reload_interval
+        if not interval:
+            return
+        now = time.time()
+        if now - self._last_config_check < interval:
+            return
+        self._last_config_check = now
+        if _file_stamp(self.ini_file) != self._config_stamp:
+            thread = threading.Thread(target=self.reload,
+                                      name='instances-reload')
+            thread.setDaemon(True)
+            thread.start()
+
+    def reload(self):
+        """
+        Rereads the instances config file and applies the differences to the
+        running instances.  Instances whose configuration hasn't changed are
+        kept as they are.  New instances are added, and instances which were
+        removed or changed are retired and closed as soon as no request is
+        using them.  Changed instances which were live are spun up again
+        before the new routing table is put in place.
+        """
+        if not self._reload_lock.acquire(False):
+            return  # Already reloading
+        try:
+            self._config_stamp = _file_stamp(self.ini_file)
+            sections, virtual_hosts, root_instance = self._read_config()
+            old = self.instances
+            instances = {}
+            added, changed = [], []
+            for name, options in sections.items():
+                instance = old.get(name)
+                if instance is not None and instance.options == options:
+                    instances[name] = instance
+                    continue
+                new_instance = self._make_instance(name, options)
+                instances[name] = new_instance
+                if instance is None:
+                    added.append(name)
+                else:
+                    changed.append(name)
+                    if instance._instance is not None:
+                        try:
+                            new_instance.pipeline()
+                        except:
+                            log.error("Unable to spin up instance %s", name,
+                                      exc_info=True)
+            removed = [name for name in old if name not in instances]
+            retired = [instance for name, instance in old.items()
+                       if instances.get(name) is not instance]
+
+            # Swap in the new routing table.  Requests which were routed
+            # with the old one are handed the new instances by `acquire`.
+            with self._lock:
+                self.instances = instances
+                self.virtual_hosts = virtual_hosts
+                self.root_instance = root_instance
+                self.dispatch_table = DispatchTable(self)
+                for instance in retired:
+                    if self._live.get(instance.name) is instance:
+                        del self._live[instance.name]
+                self._retired.extend(retired)
+                closing = self._collect_retired()
+            for instance in closing:
+                self._close(instance)
+
+            log.info("Reloaded %s: added %s, changed %s, removed %s",
+                     self.ini_file, sorted(added), sorted(changed),
+                     sorted(removed))
+        finally:
+            self._reload_lock.release()
+
+    def _collect_retired(self):
+        # Must be called with self._lock held.  Returns the retired instances
+        # which are no longer in use, for the caller to close once the lock
+        # has been released.
+        retired, closing = [], []
+        for instance in self._retired:
+            if instance.in_flight:
+                retired.append(instance)
+            else:
+                closing.append(instance)
+        self._retired = retired
+        return closing
 
     def get(self, name):
         return self.instances.get(name)
 
+    def acquire(self, instance):
+        """
+        Marks an instance as being in use by a request.  The instance becomes
+        the most recently used one and, if an eviction policy is configured,
+        idle instances are closed to make room for it.
+
+        If the instances config has been reloaded since the request was
+        routed to `instance`, the instance now configured under its name is
+        used instead.  Returns the instance acquired, which must be passed to
+        `release` once the request is done with it, or `None` if the instance
+        has been removed.
+        """
+        with self._lock:
+            instance = self.instances.get(instance.name)
+            if instance is None:
+                return None
+            instance.in_flight += 1
+            instance.last_used = time.time()
+            self._live.pop(instance.name, None)
+            self._live[instance.name] = instance
+            try:
+                evicted = self._evict()
+            except:
+                log.error("Unable to evict instances", exc_info=True)
+                evicted = []
+
+        # Closing an instance can take a while.  Don't hold up requests for
+        # other instances while it happens.
+        for evictee in evicted:
+            self._close(evictee)
+        return instance
+
+    def release(self, instance):
+        """
+        Marks the end of a request's use of an instance.
+        """
+        with self._lock:
+            instance.in_flight -= 1
+            instance.last_used = time.time()
+            if not self._retired:
+                return
+            closing = self._collect_retired()
+        for instance in closing:
+            self._close(instance)
+
+    def _evict(self):
+        # Must be called with self._lock held.  Returns the instances to
+        # close, which the caller closes once the lock has been released.
+        evicted = []
+        now = time.time()
+        idle_ttl = self.idle_ttl
+        if idle_ttl and now - self._last_sweep >= min(idle_ttl, 60):
+            self._last_sweep = now
+            for instance in list(self._live.values()):
+                if now - instance.last_used > idle_ttl:
+                    self._evict_one(instance, 'idle', evicted)
+
+        max_live = self.max_live
+        if max_live:
+            for instance in list(self._live.values()):
+                if len(self._live) <= max_live:
+                    break
+                self._evict_one(instance, 'max_live', evicted)
+
+        memory_budget = self.memory_budget
+        if memory_budget:
+            rss = _current_rss()
+            if rss is not None and rss > memory_budget:
+                for instance in list(self._live.values()):
+                    if self._evict_one(instance, 'memory_budget', evicted):
+                        break
+        return evicted
+
+    def _evict_one(self, instance, reason, evicted):
+        # Must be called with self._lock held.
+        if instance.in_flight:
+            return False
+        del self._live[instance.name]
+        if instance._instance is None and instance._pipeline is None:
+            return False
+        log.info("Evicting instance %s (%s)", instance.name, reason)
+        evicted.append(instance)
+        self.evictions += 1
+        return True
+
+    def _close(self, instance):
+        # A request which picks the instance up again in the meantime gets a
+        # newly spun up one.  See `LazyInstance.close`.
+        try:
+            instance.close()
+        except:
+            log.error("Unable to close instance %s", instance.name,
+                      exc_info=True)
+
+    def preload(self, names=None, threads=4):
+        """
+        Spins up the named instances, or all instances if `names` is `None`,
+        using a pool of `threads` threads.  Returns once every instance has
+        been spun up.
+        """
+        if names is None:
+            names = sorted(self.get_names())
+            if self.sharding is not None:
+                names = filter(self.sharding.is_local, names)
+        if self.max_live and len(names) > self.max_live:
+            log.warn("Preloading %d instances but instances.max_live is %d.",
+                     len(names), self.max_live)
+
+        queue = Queue.Queue()
+        for name in names:
+            queue.put(name)
+
+        def worker():
+            while True:
+                try:
+                    name = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                instance = self.get(name)
+                if instance is not None:
+                    instance = self.acquire(instance)
+                if instance is None:
+                    log.warn("Cannot preload unknown instance: %s", name)
+                    continue
+                set_current_instance(name)
+                start = time.time()
+                try:
+                    instance.pipeline()
+                    log.info("Preloaded instance %s in %0.2f seconds.",
+                             name, time.time() - start)
+                except:
+                    log.error("Unable to preload instance %s", name,
+                              exc_info=True)
+                finally:
+                    self.release(instance)
+                    set_current_instance(None)
+
+        start = time.time()
+        pool = [threading.Thread(target=worker, name='preload-%d' % i)
+                for i in xrange(max(1, min(threads, len(names))))]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        log.info("Preloaded %d instances in %0.2f seconds.",
+                 len(names), time.time() - start)
+
+    def admission_stats(self):
+        """
+        Returns, for each instance, the number of requests currently being
+        served, the number waiting for admission and the number turned away
+        because the instance was too busy.
+        """
+        stats = {}
+        for name, instance in self.instances.items():
+            gate = instance.gate
+            stats[name] = {
+                'in_flight': instance.in_flight,
+                'queued': gate.waiting if gate is not None else 0,
+                'rejected': gate.rejected if gate is not None else 0,
+            }
+        return stats
+
+    def cache_stats(self):
+        """
+        Returns a mapping of name to the number of connections, objects and
+        estimated bytes in the object caches of each live instance's main
+        database, along with the byte size limit per connection, if any.
+        """
+        stats = {}
+        for name, instance in self.instances.items():
+            instance_stats = instance.cache_stats()
+            if instance_stats is not None:
+                stats[name] = instance_stats
+        return stats
+
+    def stats(self):
+        """
+        Returns counters describing the instances this process has spun up
+        and evicted.
+        """
+        instances = self.instances.values()
+        return {
+            'live': len([instance for instance in instances
+                         if instance._instance is not None]),
+            'spin_ups': sum([instance.spin_ups for instance in instances]),
+            'evictions': self.evictions,
+        }
+
     def get_virtual_host(self, host):
         return self.virtual_hosts.get(host)
 
@@ -135,14 +569,224 @@ class Instances(object):
     def close(self):
         for instance in self.instances.values():
             instance.close()
+        for instance in self._retired:
+            instance.close()
+        self._live.clear()
+        self._retired = []
+
+
+class Sharding(object):
+    """
+    Assigns each instance to `replicas` of `workers` worker processes using
+    rendezvous hashing, so that adding or removing an instance, or a worker,
+    only moves the instances which have to move.  Each worker only serves the
+    instances assigned to it.
+
+    The id of the current worker, from 0 to `workers` - 1, is taken from the
+    `sharding.worker_id` setting or, failing that, the `KARLSERVE_WORKER_ID`
+    environment variable.  If neither is set, the current worker serves every
+    instance.
+    """
+
+    def __init__(self, workers, replicas=1, worker_id=None):
+        self.workers = workers
+        self.replicas = min(replicas, workers)
+        self._worker_id = worker_id
+        self._owners = {}
+
+    @property
+    def worker_id(self):
+        worker_id = self._worker_id
+        if worker_id is None:
+            worker_id = os.environ.get('KARLSERVE_WORKER_ID')
+        if worker_id is None:
+            return None
+        return int(worker_id)
+
+    def owners(self, name):
+        """
+        Returns a sorted list of the ids of the workers which serve the named
+        instance.
+        """
+        owners = self._owners.get(name)
+        if owners is None:
+            scores = []
+            for worker in xrange(self.workers):
+                digest = hashlib.md5('%s:%d' % (name, worker)).hexdigest()
+                scores.append((int(digest[:16], 16), worker))
+            scores.sort(reverse=True)
+            owners = sorted([worker for score, worker
+                             in scores[:self.replicas]])
+            self._owners[name] = owners
+        return owners
+
+    def is_local(self, name):
+        """
+        Returns whether the current worker serves the named instance.
+        """
+        worker_id = self.worker_id
+        return worker_id is None or worker_id in self.owners(name)
+
+    def worker_address(self, host, port, worker):
+        """
+        Returns the `(host, port)` a worker listens on, when the workers
+        listening on `host` are given consecutive ports starting at `port`.
+        """
+        return host, port + worker
+
+    def routing_map(self, instances, address=None):
+        """
+        Returns a mapping of instance name to the virtual hosts which are
+        routed to the instance, whether it is the root instance and the ids of
+        the workers which serve it, for configuring a front end proxy.  If
+        the `(host, port)` `address` of the first worker is given, the
+        ``host:port`` each worker listens on is included as well.
+        """
+        hosts = {}
+        for host, name in instances.virtual_hosts.items():
+            hosts.setdefault(name, []).append(host)
+        routing = {}
+        for name in instances.get_names():
+            owners = self.owners(name)
+            route = {
+                'hosts': sorted(hosts.get(name, [])),
+                'root': name == instances.root_instance,
+                'workers': owners,
+            }
+            if address is not None:
+                route['addresses'] = [
+                    '%s:%d' % self.worker_address(address[0], address[1], w)
+                    for w in owners]
+            routing[name] = route
+        return routing
+
+
+class DispatchTable(object):
+    """
+    Routing structure compiled once from an `Instances` configuration. Maps the
+    host and first path segment of a request directly to the instance which
+    should serve it, without having to build any intermediate objects on each
+    request.
+    """
+
+    def __init__(self, instances):
+        self.hosts = dict(
+            (host, (name, instances.get(name)))
+            for host, name in instances.virtual_hosts.items()
+            if instances.get(name) is not None)
+        self.names = dict(
+            (name, (name, instance))
+            for name, instance in instances.instances.items())
+        root = instances.root_instance
+        if root is not None and root in instances.instances:
+            self.root = (root, instances.get(root))
+        else:
+            self.root = (None, None)
+
+    def route(self, host, environ):
+        """
+        Returns a `(name, instance)` tuple for the instance which should serve
+        the request described by `host` and `environ`, or `(None, None)` if no
+        instance matches.  If the instance is selected by the first segment of
+        the path, `SCRIPT_NAME` and `PATH_INFO` are rewritten in place.
+        """
+        script_name = environ.get('SCRIPT_NAME', '')
+        # nginx likes to set script name to '/' with screws up everybody
+        # trying to write urls and causes them to add an extra slash
+        if script_name == '/':
+            script_name = environ['SCRIPT_NAME'] = ''
+
+        # See if we're in a virtual hosting environment
+        route = self.hosts.get(host)
+        if route is not None:
+            return route
+
+        # We are not in a virtual hosting environment, so the first element of
+        # the path_info is the name of the instance.
+        segment, _, rest = environ.get('PATH_INFO', '').lstrip('/').partition(
+            '/')
+        route = self.names.get(segment)
+        if route is not None:
+            environ['SCRIPT_NAME'] = '%s/%s' % (script_name, segment)
+            environ['PATH_INFO'] = '/' + rest
+            return route
+
+        # If we still don't have an instance, fall back to the root instance.
+        return self.root
+
+
+class AdmissionGate(object):
+    """
+    Limits the number of requests an instance serves concurrently.  Requests
+    over the limit wait in a bounded queue for up to `timeout` seconds.  When
+    the queue is full, or the wait times out, the request is turned away.
+    """
+    waiting = 0
+    active = 0
+    rejected = 0
+
+    def __init__(self, max_concurrency, max_queue=0, timeout=30,
+                 retry_after=5):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._cond = threading.Condition(threading.Lock())
+
+    def enter(self):
+        """
+        Returns `True` if the request may proceed, in which case `leave` must
+        be called when it is done, or `False` if the request should be turned
+        away.
+        """
+        with self._cond:
+            if self.active < self.max_concurrency:
+                self.active += 1
+                return True
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                deadline = time.time() + self.timeout
+                while self.active >= self.max_concurrency:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self._cond.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def leave(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+class _Generation(object):
+    """
+    The requests using one spin up of a `LazyInstance`.  Once the spin up is
+    retired, the last of them calls `closer`.
+    """
+    users = 0
+    closer = None
 
 
 class LazyInstance(object):
     _instance = None
     _pipeline = None
+    _pipeline_mode = None
     _tmp_folder = None
+    gate = None
+    in_flight = 0
+    last_used = 0
+    spin_ups = 0
 
     last_sync_tid = _InstanceProperty('last_sync_tid')
+    last_index_tid = _InstanceProperty('last_index_tid')
     mode = _InstanceProperty('mode', default='NORMAL')
 
     def _make_instance_specific(self, config, key):
@@ -152,6 +796,10 @@ class LazyInstance(object):
 
     def __init__(self, name, global_config, options):
         self.name = name
+        self.options = options.copy()
+        self._generated_uris = []
+        self._lock = threading.Lock()
+        self._generation = _Generation()
 
         self.config = config = global_config.copy()
         for setting, value in config.items():
@@ -164,32 +812,143 @@ class LazyInstance(object):
         config.update(options)
         config['read_only'] = self.mode == 'READONLY'
 
+        max_concurrency = int(config.get('max_concurrency', 0))
+        if max_concurrency:
+            self.gate = AdmissionGate(
+                max_concurrency,
+                int(config.get('max_queue', max_concurrency)),
+                float(config.get('queue_timeout', 30)),
+                int(config.get('retry_after', 5)))
+
     def pipeline(self):
+        mode = self.mode
         pipeline = self._pipeline
-        if pipeline is None:
-            if self.mode == 'MAINTENANCE':
-                pipeline = lookup(maintenance)(None)
-            else:
-                instance = self.instance()
-                pipeline = lookup(make_karl_pipeline)(instance)
-            self._pipeline = pipeline
+        if pipeline is None or mode != self._pipeline_mode:
+            closer = None
+            with self._lock:
+                pipeline = self._pipeline
+                if pipeline is None or mode != self._pipeline_mode:
+                    pipeline, closer = self._make_pipeline(mode)
+            if closer is not None:
+                closer()
         return pipeline
 
+    def checkout(self):
+        """
+        Returns the pipeline to serve a request with, along with a token to
+        pass to `checkin` once the request is done with it.  If the spun up
+        instance is closed while requests are using it, it is only really
+        closed once the last of them has checked in.
+        """
+        mode = self.mode
+        closer = None
+        with self._lock:
+            pipeline = self._pipeline
+            if pipeline is None or mode != self._pipeline_mode:
+                pipeline, closer = self._make_pipeline(mode)
+            generation = self._generation
+            generation.users += 1
+        if closer is not None:
+            closer()
+        return pipeline, generation
+
+    def checkin(self, generation):
+        with self._lock:
+            generation.users -= 1
+            if generation.users or generation is self._generation:
+                return
+            closer, generation.closer = generation.closer, None
+        if closer is not None:
+            closer()
+
+    def _make_pipeline(self, mode):
+        # Must be called with self._lock held.  Returns the pipeline along
+        # with a function which closes the instance it replaces, if any,
+        # which the caller calls once the lock has been released.
+        closer = None
+        read_only = mode == 'READONLY'
+        if read_only != self.config['read_only']:
+            # The storage has to be reopened to change whether it is read
+            # only.  Requests still using the old one close it when done.
+            closer = self._retire()
+            self.config['read_only'] = read_only
+        if mode == 'MAINTENANCE':
+            pipeline = lookup(maintenance)(None)
+        else:
+            instance = self.instance()
+            pipeline = lookup(make_karl_pipeline)(instance)
+        self._pipeline = pipeline
+        self._pipeline_mode = mode
+        return pipeline, closer
+
     def instance(self):
         instance = self._instance
         if instance is None:
             instance = self._spin_up()
             self._instance = instance
+            self.spin_ups += 1
         return instance
 
+    def cache_stats(self):
+        """
+        Returns the sizes of the object caches of the connections to the main
+        database, or `None` if the instance isn't spun up.
+        """
+        registry = getattr(self._instance, 'registry', None)
+        databases = getattr(registry, '_zodb_databases', None)
+        if not databases:
+            return None
+        db = databases['']
+        caches = []
+        db._connectionMap(lambda conn: caches.append(conn._cache))
+        return {
+            'connections': len(caches),
+            'objects': sum([len(cache) for cache in caches]),
+            'bytes': sum([getattr(cache, 'total_estimated_size', 0)
+                          for cache in caches]),
+            'target_bytes': byte_size(
+                str(self.config.get('zodb.cache_size_bytes', 0))),
+        }
+
     def close(self):
-        instance = self._instance
-        if instance is not None:
-            instance.close()
-            self._instance = None
-        if self._tmp_folder is not None:
-            shutil.rmtree(self._tmp_folder)
-        self._tmp_folder = None
+        """
+        Closes the spun up instance, if any, so that the next request spins
+        up a new one.  If requests are still using it, it is closed once the
+        last of them has checked in.
+        """
+        with self._lock:
+            closer = self._retire()
+        if closer is not None:
+            closer()
+
+    def _retire(self):
+        # Must be called with self._lock held.  Detaches the spun up instance
+        # and returns a function which closes it, or `None` if requests are
+        # still using it, in which case the last of them closes it.
+        generation = self._generation
+        self._generation = _Generation()
+        instance, self._instance = self._instance, None
+        self._pipeline = None
+        tmp, self._tmp_folder = self._tmp_folder, None
+
+        # Forget about the generated database uris.  They'll be generated
+        # again if the instance is spun back up.
+        uris = [self.config.pop(key, None) for key in self._generated_uris]
+        self._generated_uris = []
+
+        def closer():
+            if instance is not None:
+                instance.close()
+            if tmp is not None:
+                shutil.rmtree(tmp)
+            for uri in uris:
+                if uri is not None:
+                    unregister_database(uri)
+
+        if generation.users:
+            generation.closer = closer
+            return None
+        return closer
 
     @property
     def uri(self):
@@ -199,22 +958,38 @@ class LazyInstance(object):
             # Backwards compatible
             config['zodbconn.uri'] = uri = config.get('zodb_uri')
         if uri is None:
-            config = self.config
-            cache_size = 10000
-            if 'zodb.cache_size' in config:
-                cache_size = int(config['zodb.cache_size'])
-            pool_size = 3
-            if 'zodb.pool_size' in config:
-                pool_size = int(config['zodb.pool_size'])
-            uri = self._write_zconfig(
-                'zodb.conf', config['dsn'], config['blob_cache'], cache_size,
-                pool_size, config.get('keep_history', False),
-                config['read_only'], config.get('relstorage.cache_servers'),
-                config.get('relstorage.cache_prefix'),
-            )
+            uri = self._database_uri(
+                'zodb.conf', config['dsn'], config['blob_cache'],
+                read_only=config['read_only'],
+                cache_servers=config.get('relstorage.cache_servers'),
+                cache_prefix=config.get('relstorage.cache_prefix'),
+                **self._database_options())
             self.config['zodbconn.uri'] = uri
+            self._generated_uris.append('zodbconn.uri')
         return uri
 
+    def _database_options(self):
+        config = self.config
+        cache_size = 10000
+        if 'zodb.cache_size' in config:
+            cache_size = int(config['zodb.cache_size'])
+        pool_size = 3
+        if 'zodb.pool_size' in config:
+            pool_size = int(config['zodb.pool_size'])
+        cache_size_bytes = 0
+        if 'zodb.cache_size_bytes' in config:
+            cache_size_bytes = byte_size(config['zodb.cache_size_bytes'])
+        # With a host wide blob cache budget, RelStorage's own limit for
+        # each instance is only a backstop.
+        blob_cache_size = config.get('blob_cache_size',
+                                     config.get('blob_cache_budget', '8gb'))
+        return dict(
+            cache_size=cache_size, pool_size=pool_size,
+            keep_history=config.get('keep_history', False),
+            blob_cache_size=blob_cache_size,
+            cache_size_bytes=cache_size_bytes,
+        )
+
     @property
     def tmp(self):
         tmp = self._tmp_folder
@@ -230,7 +1005,7 @@ class LazyInstance(object):
         config = self.config
         name = self.name
 
-        # Write postoffice zodb config
+        # Configure postoffice database
         po_uri = config.get('zodbconn.uri.postoffice')
         if po_uri is None:
             # Backwards compatible
@@ -242,13 +1017,22 @@ class LazyInstance(object):
                 if 'postoffice.blob_cache' not in config:
                     raise ValueError("If postoffice.dsn is in config, then "
                                      "postoffice.blob_cache is required.")
-                po_uri = self._write_zconfig(
+                po_uri = self._database_uri(
                     'postoffice.conf', config['postoffice.dsn'],
                     config['postoffice.blob_cache'], name='postoffice')
                 config['zodbconn.uri.postoffice'] = po_uri
+                self._generated_uris.append('zodbconn.uri.postoffice')
         if po_uri:
             config['postoffice.queue'] = name
 
+        # Configure read only replica database
+        replica_dsn = config.get('replica_dsn')
+        if replica_dsn and 'karlserve.replica_uri' not in config:
+            config['karlserve.replica_uri'] = self._database_uri(
+                'replica.conf', replica_dsn, config['blob_cache'],
+                read_only=True, **self._database_options())
+            self._generated_uris.append('karlserve.replica_uri')
+
         pg_dsn = self.config.get('pgtextindex.dsn')
         if pg_dsn is None:
             pg_dsn = self.config.get('dsn')
@@ -259,38 +1043,53 @@ class LazyInstance(object):
         self._instance = instance
         return instance
 
-    def _write_zconfig(
+    def _database_uri(
             self, fname, dsn, blob_cache, cache_size=10000, pool_size=3,
             keep_history=False, read_only=False, cache_servers=None,
-            cache_prefix=None, poll_interval=0, name=None):
-        path = os.path.join(self.tmp, fname)
-        uri = 'zconfig://%s' % path
-        config = dict(
-            dsn=dsn, blob_cache=blob_cache, cache_size=cache_size,
-            pool_size=pool_size, keep_history=keep_history,
-            read_only=read_only, name=name
-        )
-        if cache_servers:
-            config['cache_servers'] = cache_servers
-            config['poll_interval'] = poll_interval
-            if cache_prefix is not None:
-                config['cache_prefix'] = cache_prefix
-            else:
-                config['cache_prefix'] = self.name
+            cache_prefix=None, poll_interval=0, name=None,
+            blob_cache_size='8gb', cache_size_bytes=0):
+        """
+        Returns a uri for a RelStorage database.  The storage factory and the
+        database options are kept in memory, unless `zconfig_debug` is set, in
+        which case a zconfig is written to a file in the temporary folder so
+        it can be inspected.
+        """
+        if cache_servers and cache_prefix is None:
+            cache_prefix = self.name
+        if asbool(self.config.get('zconfig_debug', False)):
+            return self._write_zconfig(
+                fname, dsn=dsn, blob_cache=blob_cache, cache_size=cache_size,
+                pool_size=pool_size, keep_history=keep_history,
+                read_only=read_only, cache_servers=cache_servers,
+                cache_prefix=cache_prefix, poll_interval=poll_interval,
+                name=name, blob_cache_size=blob_cache_size,
+                cache_size_bytes=cache_size_bytes)
+        storage_factory = RelStorageFactory(
+            dsn, blob_cache, keep_history=keep_history, read_only=read_only,
+            blob_cache_size=blob_cache_size, cache_servers=cache_servers,
+            cache_prefix=cache_prefix, poll_interval=poll_interval)
+        return register_database(
+            self.name, fname, storage_factory, cache_size=cache_size,
+            pool_size=pool_size, cache_size_bytes=cache_size_bytes)
+
+    def _write_zconfig(self, fname, **config):
+        if config['cache_servers']:
             zconfig = zconfig_template_w_memcache % config
         else:
             zconfig = zconfig_template % config
+        path = os.path.join(self.tmp, fname)
         with open(path, 'w') as f:
             f.write(zconfig)
-        return uri
+        return 'zconfig://%s' % path
 
     def __del__(self):
         if self._tmp_folder and os.path.exists(self._tmp_folder):
             shutil.rmtree(self._tmp_folder)
+        for key in self._generated_uris:
+            unregister_database(self.config.get(key))
 
 
-def _get_config(global_config, uri):
-    db = db_from_uri(uri)
+def _get_config(global_config, db):
     conn = db.open()
     root = conn.root()
 
@@ -307,41 +1106,241 @@ def _get_config(global_config, uri):
 
     transaction.commit()
     conn.close()
-    db.close()
-    del db, conn, root
+    del conn, root
 
     return config
 
 
+def _include_zodbconn(config, databases):
+    """
+    Includes `pyramid_zodbconn`, except that databases already opened in
+    `databases` are reused rather than opened again.
+    """
+    def db_from_uri(uri, dbname, dbmap):
+        db = databases.get(dbname)
+        if db is None:
+            return _db_from_uri(uri, dbname, dbmap)
+        # Join the multi-database pyramid_zodbconn builds, so that the other
+        # databases can be reached from connections to this one.
+        db.databases = dbmap
+        dbmap[dbname] = db
+        return db
+
+    zodbconn_includeme(config, db_from_uri=db_from_uri)
+
+
+def _db_from_uri(uri, dbname, databases):
+    if uri.startswith('karlserve:'):
+        return db_from_karlserve_uri(uri, dbname, databases)
+    return zodbconn_db_from_uri(uri, dbname, databases)
+
+
+_safe_methods = ('GET', 'HEAD', 'OPTIONS')
+
+
+def _open_replica(settings):
+    """
+    Opens the read only replica of the instance's main database, if one is
+    configured.  The replica gets its own copies of any other databases, so
+    that cross database references work from a connection to the replica.
+    """
+    uri = settings.get('karlserve.replica_uri')
+    if uri is None:
+        return None
+    databases = {}
+    try:
+        _db_from_uri(uri, '', databases)
+        for dbname, other_uri in get_uris(settings):
+            if dbname:
+                _db_from_uri(other_uri, dbname, databases)
+    except:
+        _close_databases(databases)
+        raise
+    return databases['']
+
+
+class _Replica(object):
+    """
+    The read only replica of an instance's main database, opened on first
+    use rather than when the instance is spun up, so an unreachable replica
+    doesn't keep the instance from serving requests from the primary.  If the
+    replica can't be opened, `get` returns `None` and opening it is retried
+    after `retry_interval` seconds.
+    """
+    db = None
+    _retry_at = 0
+
+    def __init__(self, settings, retry_interval=30, instrument=False):
+        self.settings = settings
+        self.retry_interval = retry_interval
+        self.instrument = instrument
+        self._lock = threading.Lock()
+
+    def get(self):
+        db = self.db
+        if db is not None or time.time() < self._retry_at:
+            return db
+        with self._lock:
+            if self.db is None and time.time() >= self._retry_at:
+                try:
+                    db = _open_replica(self.settings)
+                except:
+                    log.warn("Unable to open replica, serving requests from "
+                             "the primary database.", exc_info=True)
+                    self._retry_at = time.time() + self.retry_interval
+                else:
+                    if self.instrument:
+                        instrument_storage(db.storage)
+                    self.db = db
+            return self.db
+
+    def close(self):
+        with self._lock:
+            db, self.db = self.db, None
+        if db is not None:
+            _close_databases(db.databases)
+
+
+def _use_replica(request, read_only, primary_paths):
+    """
+    Returns whether `request` may be served by the replica.  Every request to
+    an instance in READONLY mode may, as may requests with a safe method
+    unless their path starts with one of `primary_paths`, for views which
+    write even though the method is safe.
+    """
+    if read_only:
+        return True
+    return (request.method in _safe_methods and
+            not request.path_info.startswith(primary_paths))
+
+
+def _replica_connection(request, db, min_tid=0):
+    """
+    Opens a connection to the replica `db` as the request's primary
+    connection, in place of the one `pyramid_zodbconn.get_connection` would
+    open.  Returns `None`, so the request falls back to the primary database,
+    if the replica can't be reached or hasn't caught up with `min_tid`, the
+    last transaction committed by the user.
+    """
+    connection = getattr(request, '_primary_zodb_conn', None)
+    if connection is not None:
+        # The request is being retried.
+        if connection.db() is db:
+            return connection
+        return None
+    try:
+        connection = db.open()
+    except:
+        log.warn("Unable to open connection to replica.", exc_info=True)
+        return None
+    if min_tid and u64(connection._storage.lastTransaction()) < min_tid:
+        connection.close()
+        return None
+
+    def finished(request):
+        connection.transaction_manager.abort()
+        connection.close()
+    request.add_finished_callback(finished)
+    request._primary_zodb_conn = connection
+    return connection
+
+
+def _min_tid(request, cookie_name):
+    try:
+        return int(request.cookies.get(cookie_name, '0'), 16)
+    except ValueError:
+        return 0
+
+
+def _remember_commits(request, connection, cookie_name, max_age):
+    """
+    Sets a cookie with the id of the transaction committed by the request, if
+    any, so the user's next requests aren't served by a replica which hasn't
+    caught up with their changes yet.
+    """
+    committed = []
+
+    def after_commit(status):
+        if status:
+            committed.append(connection._storage.lastTransaction())
+    transaction.get().addAfterCommitHook(after_commit)
+
+    def set_cookie(request, response):
+        if committed:
+            response.set_cookie(
+                cookie_name, '%016x' % u64(committed[-1]), max_age=max_age,
+                path=request.script_name or '/', httponly=True)
+    request.add_response_callback(set_cookie)
+
+
+def _close_databases(databases):
+    for db in databases.values():
+        db.close()
+
+
 def make_karl_instance(name, global_config, uri):
-    settings = _get_config(global_config, uri)
-    connstats_file = global_config.get('connection_stats_filename')
-    connstats_threshhold = float(global_config.get( 
+    # The primary database is opened once, here, and is used both to read the
+    # instance configuration and, later, to serve requests.
+    databases = {}
+    _db_from_uri(uri, '', databases)
+    try:
+        return _make_karl_instance(name, global_config, databases)
+    except:
+        # Including pyramid_zodbconn moves the primary database, and the
+        # others it opens, to a new map.
+        _close_databases(databases[''].databases)
+        raise
+
+
+def _make_karl_instance(name, global_config, databases):
+    settings = _get_config(global_config, databases[''])
+    instance_name = name
+    connstats = get_stats_writer(global_config)
+    connstats_threshhold = float(global_config.get(
                                     'connection_stats_threshhold', 0))
+    metrics = None
+    if global_config.get('metrics_path'):
+        metrics = get_metrics()
+    collect_stats = connstats is not None or metrics is not None
+
+    blobcache = get_blob_cache(
+        global_config, os.path.dirname(global_config.get('blob_cache', '')))
+    if blobcache is not None:
+        blobcache.watch(name, databases[''].storage)
+
+    if collect_stats:
+        instrument_storage(databases[''].storage)
+    replica = None
+    if settings.get('karlserve.replica_uri'):
+        replica = _Replica(
+            settings, float(settings.get('replica.retry_interval', 30)),
+            instrument=collect_stats)
+    read_only = asbool(settings.get('read_only', False))
+    tid_cookie = settings.get('replica.tid_cookie', 'karlserve_tid')
+    tid_max_age = int(settings.get('replica.tid_max_age', 600))
+    primary_paths = tuple(settings.get('replica.primary_paths', '').split())
+
+    def finished(request):
+        # closing the primary also closes any secondaries opened
+        stats = request._karlserve_stats
+        if stats is None:
+            return
+        stats.finish()
+        if connstats is not None and stats.elapsed > connstats_threshhold:
+            connstats.write(stats.csv_line(request))
+        if metrics is not None:
+            metrics.record(instance_name, route_name(request), stats)
 
     def root_factory(request, name='site'):
-        def finished(request):
-            # closing the primary also closes any secondaries opened
-            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            elapsed = time.time() - before
-            if elapsed > connstats_threshhold:
-                loads_after, stores_after = connection.getTransferCounts()
-                loads = loads_after - loads_before
-                stores = stores_after - stores_before
-                with open(connstats_file, 'a', 0) as f:
-                    f.write('"%s", "%s", "%s", %f, %d, %d\n' %
-                               (now,
-                                request.method,
-                                request.path_url,
-                                elapsed,
-                                loads,
-                                stores,
-                               )
-                           )
-                    f.flush()
-
-        if connstats_file is not None:
+        # pyramid_tm calls the root factory again if it retries the request.
+        # Only measure the request once, counting the retries.
+        measure = (collect_stats and
+                   not hasattr(request, '_karlserve_stats'))
+        if measure:
+            request._karlserve_stats = None
             request.add_finished_callback(finished)
+        elif collect_stats and request._karlserve_stats is not None:
+            request._karlserve_stats.retry()
 
         # NB: Finished callbacks are executed in the order they've been added
         # to the request.  pyramid_zodbconn's ``get_connection`` registers a
@@ -351,19 +1350,34 @@ def make_karl_instance(name, global_config, uri):
         # call to ``request.add_finished_callback`` *must* be executed before
         # we call ``get_connection`` below.
 
-        # Rationale: we want the call to getTransferCounts() above to happen
-        # before the ZODB database is closed, because closing the ZODB database
-        # has the side effect of clearing the transfer counts (the ZODB
+        # Rationale: we want the call to getTransferCounts() in ``finish`` to
+        # happen before the ZODB database is closed, because closing the ZODB
+        # database has the side effect of clearing the transfer counts (the ZODB
         # activity monitor clears the transfer counts when the database is
         # closed).  Having the finished callbacks called in the "wrong" order
         # will result in the transfer counts being cleared before the above
         # "finished" function has a chance to read their per-request values,
         # and they will appear to always be zero.
             
-        connection = get_connection(request)
-        if connstats_file is not None:
-            before = time.time()
-            loads_before, stores_before = connection.getTransferCounts()
+        connection = None
+        if replica is not None and _use_replica(
+                request, read_only, primary_paths):
+            db = replica.get()
+            if db is not None:
+                connection = _replica_connection(
+                    request, db, _min_tid(request, tid_cookie))
+            if connection is not None and name not in connection.root():
+                # The site has yet to be created, on the primary.  The
+                # replica connection is closed when the request finishes.
+                request._primary_zodb_conn = None
+                connection = None
+        if connection is None:
+            connection = get_connection(request)
+            if replica is not None and not read_only:
+                _remember_commits(request, connection, tid_cookie,
+                                  tid_max_age)
+        if measure:
+            request._karlserve_stats = RequestStats(connection)
         folder = connection.root()
         if name not in folder:
             bootstrapper = queryUtility(IBootstrapper, default=populate)
@@ -418,7 +1432,7 @@ def make_karl_instance(name, global_config, uri):
             root_factory=root_factory, autocommit=True)
     config.begin()
     config.include('pyramid_tm')
-    config.include('pyramid_zodbconn')
+    _include_zodbconn(config, databases)
     if filename is not None:
         if configure_karl is not None: # BBB See above
             configure_karl(config, load_zcml=False)
@@ -433,12 +1447,14 @@ def make_karl_instance(name, global_config, uri):
         registry = config.registry
         dbs = getattr(registry, '_zodb_databases', None)
         if dbs:
-            for db in dbs.values():
-                db.close()
+            _close_databases(dbs)
             del registry._zodb_databases
+        if replica is not None:
+            replica.close()
 
     app = config.make_wsgi_app()
     app.config = settings
+    app.instance_name = name
     app.close = closer
 
     return app
@@ -458,9 +1474,28 @@ def make_karl_pipeline(app):
     urchin_account = config.get('urchin.account')
     if urchin_account:
         pipeline = UrchinMiddleware(pipeline, urchin_account)
+    if asbool(config.get('response_cache', False)):
+        pipeline = ResponseCacheMiddleware(
+            pipeline, app, app.instance_name, get_response_cache(config),
+            config.get('who_cookie', 'auth_tkt'))
+    if asbool(config.get('conditional_get', False)):
+        pipeline = ConditionalGetMiddleware(
+            pipeline, app, config.get('conditional_get.salt', _etag_salt()),
+            config.get('who_cookie', 'auth_tkt'))
     return pipeline
 
 
+def _etag_salt():
+    # Pages change when new software is deployed, even if the data doesn't.
+    versions = []
+    for name in ('karl', 'karlserve'):
+        try:
+            versions.append(pkg_resources.get_distribution(name).version)
+        except pkg_resources.DistributionNotFound:
+            pass
+    return ' '.join(versions)
+
+
 _threadlocal = threading.local()
 
 
@@ -472,9 +1507,25 @@ def get_current_instance():
     return getattr(_threadlocal, 'instance', None)
 
 
-def db_from_uri(uri):
-    storage_factory, dbkw = resolve_uri(uri)
-    return DB(storage_factory(), **dbkw)
+def _file_stamp(fname):
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+def _current_rss():
+    """
+    Returns the resident set size of this process in bytes, or `None` if it
+    can't be determined on this platform.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
 
 
 default_instance_config = {
@@ -507,6 +1558,7 @@ zconfig_template = """
 <zodb>
   database-name %(name)s
   cache-size %(cache_size)s
+  cache-size-bytes %(cache_size_bytes)s
   pool-size %(pool_size)s
   <relstorage>
     <postgresql>
@@ -514,7 +1566,7 @@ zconfig_template = """
     </postgresql>
     shared-blob-dir False
     blob-dir %(blob_cache)s
-    blob-cache-size 8gb
+    blob-cache-size %(blob_cache_size)s
     keep-history %(keep_history)s
     read-only %(read_only)s
   </relstorage>
@@ -526,6 +1578,7 @@ zconfig_template_w_memcache = """
 <zodb>
   database-name %(name)s
   cache-size %(cache_size)s
+  cache-size-bytes %(cache_size_bytes)s
   pool-size %(pool_size)s
   <relstorage>
     <postgresql>
@@ -533,7 +1586,7 @@ zconfig_template_w_memcache = """
     </postgresql>
     shared-blob-dir False
     blob-dir %(blob_cache)s
-    blob-cache-size 8gb
+    blob-cache-size %(blob_cache_size)s
     keep-history %(keep_history)s
     read-only %(read_only)s
     cache-servers %(cache_servers)s
@@ -0,0 +1,163 @@
+from __future__ import with_statement
+
+import bisect
+import threading
+
+
+def _geometric(start, stop, factor):
+    bounds = [0]
+    value = start
+    while value < stop:
+        bounds.append(value)
+        value *= factor
+    bounds.append(stop)
+    return bounds
+
+# Upper bounds of histogram buckets.
+LATENCY_BOUNDS = _geometric(0.001, 300.0, 1.2)   # seconds
+COUNT_BOUNDS = _geometric(1, 10000000, 1.25)      # objects, round trips, ...
+BYTES_BOUNDS = _geometric(1024, 1 << 34, 1.5)     # bytes
+
+
+class Histogram(object):
+    """
+    Fixed size histogram with geometrically spaced buckets.  Percentiles are
+    approximate: they are reported as the upper bound of the bucket they fall
+    in.
+    """
+    count = 0
+    total = 0
+    max = 0
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        rank = p / 100.0 * self.count
+        seen = 0
+        bounds = self.bounds
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                if i < len(bounds):
+                    return min(bounds[i], self.max)
+                return self.max
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / float(self.count) if self.count else 0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class RequestSeries(object):
+    """
+    Histograms for the requests served by one route of one instance.
+    """
+    histograms = (
+        ('latency', LATENCY_BOUNDS),
+        ('loads', COUNT_BOUNDS),
+        ('stores', COUNT_BOUNDS),
+        ('commit', LATENCY_BOUNDS),
+        ('bytes_loaded', BYTES_BOUNDS),
+        ('blob_opens', COUNT_BOUNDS),
+        ('blob_bytes', BYTES_BOUNDS),
+        ('round_trips', COUNT_BOUNDS),
+        ('retries', COUNT_BOUNDS),
+    )
+
+    def __init__(self):
+        for name, bounds in self.histograms:
+            setattr(self, name, Histogram(bounds))
+
+    def record(self, stats):
+        self.latency.add(stats.elapsed)
+        self.loads.add(stats.loads)
+        self.stores.add(stats.stores)
+        if stats.commit_time:
+            self.commit.add(stats.commit_time)
+        self.bytes_loaded.add(stats.bytes_loaded)
+        self.blob_opens.add(stats.blob_opens)
+        self.blob_bytes.add(stats.blob_bytes)
+        self.round_trips.add(stats.round_trips)
+        self.retries.add(stats.retries)
+
+    def summary(self):
+        summary = dict([(name, getattr(self, name).summary())
+                        for name, bounds in self.histograms])
+        summary['count'] = self.latency.count
+        return summary
+
+
+class Metrics(object):
+    """
+    Per request measurements, tagged by instance name and route, collected
+    into histograms in memory.  Once `max_series` distinct routes have been
+    seen, further routes are lumped together under the route name 'other'.
+    """
+
+    def __init__(self, max_series=2000):
+        self.max_series = max_series
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def record(self, instance, route, stats):
+        key = (instance, route)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                if len(self._series) >= self.max_series:
+                    key = (instance, 'other')
+                    series = self._series.get(key)
+                if series is None:
+                    series = self._series[key] = RequestSeries()
+            series.record(stats)
+
+    def report(self):
+        report = {}
+        with self._lock:
+            for (instance, route), series in self._series.items():
+                report.setdefault(instance, {})[route] = series.summary()
+        return report
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    """
+    Returns the `Metrics` for this process.
+    """
+    return _metrics
+
+
+def route_name(request):
+    """
+    Returns a name for the view which served a request, to tag its
+    measurements with.  This is the name of the matched route if there is one,
+    otherwise the type of the context and the view name.
+    """
+    route = getattr(request, 'matched_route', None)
+    if route is not None:
+        return route.name
+    context = getattr(request, 'context', None)
+    return '%s:%s' % (type(context).__name__, getattr(request, 'view_name', ''))
@@ -0,0 +1,332 @@
+from __future__ import with_statement
+
+import collections
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+from persistent.TimeStamp import TimeStamp
+from ZODB.blob import is_blob_record
+from ZODB.POSException import POSKeyError
+from ZODB.utils import p64
+from ZODB.utils import u64
+from ZODB.utils import z64
+
+from karlserve.instance import get_instances
+from karlserve.storage import _storage_from_uri
+from karlserve.storage import storage_from_config
+
+log = logging.getLogger(__name__)
+
+
+def config_parser(name, subparsers, **helpers):
+    parser = subparsers.add_parser(
+        name, help='Copy the transactions of one storage to another, for '
+        'instance to migrate from FileStorage to RelStorage.  The copy can '
+        'be interrupted and resumed.')
+    parser.add_argument('source', help='Instance name or database URI to '
+                        'copy from.')
+    parser.add_argument('destination', help='Instance name or database URI '
+                        'to copy to.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of threads copying blobs.  Default: 4.')
+    parser.add_argument('--checkpoint', metavar='FILE', default=None,
+                        help='File recording the id of the last transaction '
+                        'copied.  By default the copy resumes after the last '
+                        'transaction in the destination.')
+    parser.add_argument('--report-interval', type=float, default=10.0,
+                        help='Seconds between progress reports.  Default: '
+                        '10.')
+    parser.add_argument('--skip-missing-blobs', action='store_true',
+                        default=False,
+                        help='Copy records whose blob is missing from the '
+                        'source without the blob, and list them at the end, '
+                        'instead of stopping the copy.')
+    parser.set_defaults(func=main, parser=parser)
+
+
+def main(args):
+    source = open_storage(args, args.source)
+    try:
+        destination = open_storage(args, args.destination)
+        try:
+            copier = StorageCopier(source, destination, workers=args.workers,
+                                   checkpoint=args.checkpoint,
+                                   report_interval=args.report_interval,
+                                   skip_missing_blobs=args.skip_missing_blobs,
+                                   out=args.out)
+            copier.run()
+        finally:
+            destination.close()
+    finally:
+        source.close()
+
+
+def open_storage(args, name):
+    """
+    Opens the storage of the named instance or, if `name` is a URI, the
+    storage it describes.
+    """
+    if '://' in name:
+        return _storage_from_uri(name)
+    instance = get_instances(args.app.registry.settings).get(name)
+    if instance is None:
+        args.parser.error("No such instance: %s" % name)
+    storage = storage_from_config(instance.config)
+    if storage is None:
+        storage = _storage_from_uri(instance.uri)
+    return storage
+
+
+class MissingBlob(POSKeyError):
+    """
+    A blob record's blob is missing from the source storage.
+    """
+
+
+class StorageCopier(object):
+    """
+    Copies transactions from `source` to `destination`, keeping their ids, as
+    ``zodbconvert`` does.
+
+    Transactions are copied one at a time, in order, in their own
+    transaction in the destination, so the copy can be interrupted at any
+    time.  It resumes after the last transaction in the destination or, if a
+    `checkpoint` file is given, the one recorded in it, whichever is later.
+
+    Blobs are fetched from the source and copied to the destination's
+    temporary directory by a pool of `workers` threads, ahead of the
+    transaction being stored.  Progress is reported every `report_interval`
+    seconds.
+
+    A blob missing from the source stops the copy with `MissingBlob`, before
+    the transaction referring to it is stored, unless `skip_missing_blobs`
+    is set, in which case the record is copied without its blob and the
+    missing blobs are listed at the end.
+    """
+    lookahead_per_worker = 4
+
+    def __init__(self, source, destination, workers=4, checkpoint=None,
+                 report_interval=10.0, skip_missing_blobs=False, out=None):
+        self.source = source
+        self.destination = destination
+        self.workers = max(1, workers)
+        self.checkpoint = checkpoint
+        self.report_interval = report_interval
+        self.out = out
+        self.transactions = 0
+        self.records = 0
+        self.bytes = 0
+        self.blobs = 0
+        self.skip_missing_blobs = skip_missing_blobs
+        self.missing_blobs = []
+        self._local = threading.local()
+        self._source_instances = []
+        self._lock = threading.Lock()
+
+    def start_tid(self):
+        """
+        Returns the id of the first transaction to copy, as an integer.
+        """
+        last = u64(self.destination.lastTransaction() or z64)
+        checkpoint = self.checkpoint
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                last = max(last, int(f.read().strip() or 0, 16))
+        if last:
+            return last + 1
+        return 0
+
+    def run(self):
+        start = self.start_tid()
+        end = u64(self.source.lastTransaction() or z64)
+        if start > end:
+            self._print("Nothing to copy.")
+            return
+        if start:
+            self._print("Resuming after transaction %016x." % (start - 1))
+
+        self.started = self.last_report = time.time()
+        self.first_time = None
+        self.end_time = _tid_time(end)
+        pool = ThreadPool(self.workers)
+        pending = collections.deque()
+        lookahead = self.workers * self.lookahead_per_worker
+        transactions = self.source.iterator(p64(start))
+        try:
+            for txn in transactions:
+                if self.first_time is None:
+                    self.first_time = _tid_time(u64(txn.tid))
+                records = []
+                for record in txn:
+                    blob = None
+                    if record.data and is_blob_record(record.data):
+                        blob = pool.apply_async(
+                            self._fetch_blob, (record.oid, record.tid))
+                    records.append((record, blob))
+                pending.append((txn, records))
+                while len(pending) > lookahead:
+                    self._store(*pending.popleft())
+            while pending:
+                self._store(*pending.popleft())
+        finally:
+            pool.terminate()
+            pool.join()
+            close = getattr(transactions, 'close', None)
+            if close is not None:
+                close()
+            for storage in self._source_instances:
+                release = getattr(storage, 'release', None)
+                if release is not None:
+                    release()
+            for txn, records in pending:
+                for record, blob in records:
+                    if blob is not None and blob.ready() and \
+                            blob.successful():
+                        _remove(blob.get())
+        self.report()
+        self.report_missing_blobs()
+
+    def _fetch_blob(self, oid, serial):
+        # Runs in a worker thread.  MVCC storages get a storage instance per
+        # thread, since instances aren't thread safe.  The blob is copied
+        # because storing it moves the file into the destination.
+        local = self._local
+        storage = getattr(local, 'storage', None)
+        if storage is None:
+            storage = self.source
+            new_instance = getattr(storage, 'new_instance', None)
+            if new_instance is not None:
+                storage = new_instance()
+            local.storage = storage
+            with self._lock:
+                self._source_instances.append(storage)
+        try:
+            fname = storage.loadBlob(oid, serial)
+        except POSKeyError:
+            if not self.skip_missing_blobs:
+                raise MissingBlob(
+                    "Blob missing from the source for oid %016x, serial "
+                    "%016x.  Use --skip-missing-blobs to copy the record "
+                    "without it." % (u64(oid), u64(serial)))
+            log.warn("Blob missing from the source for oid %016x, serial "
+                     "%016x.", u64(oid), u64(serial))
+            with self._lock:
+                self.missing_blobs.append((u64(oid), u64(serial)))
+            return None
+        fd, copy = tempfile.mkstemp('.blob', dir=self._tmp_dir())
+        os.close(fd)
+        shutil.copyfile(fname, copy)
+        return copy
+
+    def _tmp_dir(self):
+        temporary_directory = getattr(
+            self.destination, 'temporaryDirectory', None)
+        if temporary_directory is not None:
+            return temporary_directory()
+        return None
+
+    def _store(self, txn, records):
+        destination = self.destination
+        destination.tpc_begin(txn, txn.tid, txn.status)
+        try:
+            for record, blob in records:
+                blobfile = None
+                if blob is not None:
+                    blobfile = blob.get()
+                if blobfile is not None:
+                    destination.restoreBlob(
+                        record.oid, record.tid, record.data, blobfile,
+                        record.data_txn, txn)
+                    self.blobs += 1
+                else:
+                    destination.restore(
+                        record.oid, record.tid, record.data, '',
+                        record.data_txn, txn)
+                self.records += 1
+                self.bytes += len(record.data or '')
+            destination.tpc_vote(txn)
+            destination.tpc_finish(txn)
+        except:
+            destination.tpc_abort(txn)
+            for record, blob in records:
+                if blob is not None and blob.ready() and blob.successful():
+                    _remove(blob.get())
+            raise
+        self.transactions += 1
+        self.last_tid = u64(txn.tid)
+        if self.checkpoint:
+            self._write_checkpoint(txn.tid)
+        if time.time() - self.last_report >= self.report_interval:
+            self.report()
+
+    def _write_checkpoint(self, tid):
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('%016x\n' % u64(tid))
+        os.rename(tmp, self.checkpoint)
+
+    def report(self):
+        now = time.time()
+        self.last_report = now
+        elapsed = max(now - self.started, 0.001)
+        if not self.transactions:
+            self._print("Copied 0 transactions.")
+            return
+
+        # The transaction ids are timestamps.  Assuming the database grew at
+        # a steady rate, the part of the history copied is a good estimate
+        # of the part of the work done.
+        span = self.end_time - self.first_time
+        done = 1.0
+        if span > 0:
+            done = (_tid_time(self.last_tid) - self.first_time) / span
+        eta = ''
+        if 0 < done < 1:
+            eta = ', ETA %s' % _format_seconds(elapsed / done - elapsed)
+        missing = ''
+        if self.missing_blobs:
+            missing = ' (%d missing)' % len(self.missing_blobs)
+        self._print(
+            "Copied %d transactions, %d records (%.1f MB), %d blobs%s in %s: "
+            "%.1f txn/s, %.1f MB/s, %.1f%% done%s." % (
+                self.transactions, self.records, self.bytes / 1048576.0,
+                self.blobs, missing, _format_seconds(elapsed),
+                self.transactions / elapsed,
+                self.bytes / 1048576.0 / elapsed, done * 100, eta))
+
+    def report_missing_blobs(self):
+        if not self.missing_blobs:
+            return
+        self._print("Copied %d records without their missing blob:" %
+                    len(self.missing_blobs))
+        for oid, serial in sorted(self.missing_blobs):
+            self._print("  oid %016x, serial %016x" % (oid, serial))
+
+    def _print(self, msg):
+        if self.out is not None:
+            print >> self.out, msg
+        else:
+            log.info(msg)
+
+
+def _tid_time(tid):
+    return TimeStamp(p64(tid)).timeTime()
+
+
+def _format_seconds(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def _remove(fname):
+    if fname is None:
+        return
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
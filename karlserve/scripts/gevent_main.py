@@ -0,0 +1,24 @@
+import sys
+
+
+def main(argv=sys.argv, out=None):
+    """
+    Entry point of the ``karlserve-gevent`` script, which is the ``karlserve``
+    script with the standard library monkeypatched by gevent, for
+    ``karlserve-gevent serve --gevent``.
+
+    gevent has to patch the standard library before anything else imports
+    it, so that thread locals, such as the current instance, become greenlet
+    locals.  So karlserve, and with it Karl, is only imported once the
+    standard library is patched.
+    """
+    from gevent import monkey
+    monkey.patch_all()
+    try:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        pass
+
+    from karlserve.scripts.main import main
+    return main(argv, out)
@@ -1,10 +1,21 @@
+from __future__ import with_statement
+
 import BTrees
+import contextlib
+import itertools
 import logging
+import os
+import resource
+import time
 import transaction
 
 from pyramid.traversal import find_model
 from repoze.catalog.indexes.text import CatalogTextIndex
+from repoze.zodbconn.datatypes import byte_size
 from ZODB.POSException import ConflictError
+from ZODB.POSException import POSKeyError
+from ZODB.utils import p64
+from ZODB.utils import u64
 
 from karl.models.site import get_textrepr
 from karl.models.site import get_weighted_textrepr
@@ -15,8 +26,15 @@ from karlserve.textindex import KarlPGTextIndex
 log = logging.getLogger(__name__)
 
 IF = BTrees.family32.IF
+II = BTrees.family32.II
 
 BATCH_SIZE = 500
+MIN_BATCH_SIZE = 10
+MAX_BATCH_SIZE = 5000
+
+# Number of docids read or added at a time while working out which documents
+# to reindex.
+CHUNK_SIZE = 10000
 
 
 def config_parser(name, subparsers, **helpers):
@@ -33,6 +51,35 @@ def config_parser(name, subparsers, **helpers):
     parser.add_argument('--show', action='store_true', default=False,
                         help='Show which index type in currently in use. '
                         'Performs no action.')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='Only reindex documents changed since the last '
+                        'reindex, full or incremental.')
+    parser.add_argument('--since-tid', type=_tid, default=None,
+                        help='Only reindex documents changed after the '
+                        'transaction with this id, in hex.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes reindexing documents in '
+                        'parallel, when reindexing into pgtextindex.  '
+                        'Default: 1.')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='Number of documents to reindex in the first '
+                        'transaction.  Default: %d.' % BATCH_SIZE)
+    parser.add_argument('--min-batch-size', type=int, default=MIN_BATCH_SIZE,
+                        help='Smallest number of documents to reindex per '
+                        'transaction.  Default: %d.' % MIN_BATCH_SIZE)
+    parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE,
+                        help='Largest number of documents to reindex per '
+                        'transaction.  Default: %d.' % MAX_BATCH_SIZE)
+    parser.add_argument('--commit-time', type=float, default=5.0,
+                        help='Seconds a commit should take.  The batch size '
+                        'shrinks when commits take longer and grows when they '
+                        'take less than half as long.  Default: 5.')
+    parser.add_argument('--memory-growth', type=byte_size, default='256MB',
+                        help='Growth of the peak memory use of the process, '
+                        'during one batch, over which the batch size '
+                        'shrinks.  Default: 256MB.')
+    parser.add_argument('--report-interval', type=float, default=60.0,
+                        help='Seconds between progress reports.  Default: 60.')
     parser.set_defaults(func=main, parser=parser)
 
 
@@ -43,12 +90,46 @@ def main(args):
             'Current text index type: %s' % get_index_type(args, site))
         return
 
+    instance = args.get_instance(args.inst)
     status = getattr(site, '_reindex_text_status', None)
+    if args.incremental or args.since_tid is not None:
+        if status == 'reindexing':
+            args.parser.error("A full reindex is in progress.  Finish it "
+                              "before reindexing incrementally.")
+        since = args.since_tid
+        if since is None:
+            since = instance.last_index_tid
+        if since is None:
+            args.parser.error("No reindex has been recorded for this "
+                              "instance.  Use --since-tid, or do a full "
+                              "reindex first.")
+        instance.last_index_tid = reindex_incremental(args, site, since)
+        return
+
+    if args.workers > 1 and get_new_index_type(args, site) != 'pg':
+        # Every document indexed by zope.index changes the same lexicon and
+        # word BTrees, so parallel workers would do little but conflict.
+        args.parser.error("--workers can only be used when reindexing into "
+                          "pgtextindex.")
+
     if status == 'reindexing':
-        reindex_text(args, site)
+        tid = reindex_text(args, site)
     else:
         switch_text_index(args, site)
-        reindex_text(args, site)
+        tid = reindex_text(args, site)
+    instance.last_index_tid = tid
+
+
+def _tid(value):
+    return int(value, 16)
+
+
+def last_transaction(site):
+    """
+    Returns the id of the last transaction committed to the site's database,
+    as an integer.
+    """
+    return u64(site._p_jar._storage.lastTransaction())
 
 
 def get_index_type(args, site):
@@ -64,6 +145,22 @@ def get_index_type(args, site):
         return 'other (%s)' % type(index)
 
 
+def get_new_index_type(args, site):
+    """
+    Returns the type name of the index being reindexed into: the new index
+    if a reindex is in progress, otherwise the one asked for or, failing
+    that, the current one.
+    """
+    catalog = find_catalog(site)
+    if getattr(site, '_reindex_text_status', None) == 'reindexing':
+        if isinstance(catalog['new_texts'], KarlPGTextIndex):
+            return 'pg'
+        return 'zope'
+    if args.convert_to is not None:
+        return args.convert_to
+    return get_index_type(args, site)
+
+
 def switch_text_index(args, site):
     """
     It turns out, for OSI at least, that reindexing every document is too large
@@ -104,100 +201,571 @@ def switch_text_index(args, site):
     else:
         raise ValueError("Unknown text index type: %s" % new_type)
     catalog['new_texts'] = new_index  # temporary location
-    new_index.to_index = IF.Set()
-    new_index.indexed = IF.Set()
+    # Documents changed after this are picked up by the next incremental
+    # reindex.
+    new_index.start_tid = last_transaction(site)
+    new_index.to_index = IF.TreeSet()
+    new_index.indexed = IF.TreeSet()
+    new_index.progress = II.BTree()
     transaction.commit()
     site._reindex_text_status = 'reindexing'
 
 
 def reindex_text(args, site):
-    catalog = find_catalog(site)
-    old_index = catalog['texts']
-    new_index = catalog['new_texts']
-
+    """
+    Reindexes the documents left to index and puts the new index in place.
+    Returns the id of the last transaction committed before reindexing
+    started.
+    """
     done = False
     while not done:
+        catalog = find_catalog(site)
+        old_index = catalog['texts']
+        new_index = catalog['new_texts']
         try:
+            settle_progress(new_index)
             if len(new_index.to_index) == 0:
                 calculate_docids_to_index(catalog, old_index, new_index)
                 if len(new_index.to_index) == 0:
+                    # Reindexing started before this version recorded when.
+                    tid = getattr(new_index, 'start_tid', None)
+                    if tid is None:
+                        tid = last_transaction(site)
+                    else:
+                        del new_index.start_tid
                     catalog['texts'] = new_index
                     del new_index.to_index
                     del new_index.indexed
+                    del new_index.progress
                     del site._reindex_text_status
                     done = True
                     log.info("Finished.")
+            elif args.workers > 1:
+                site = reindex_parallel(args, site)
+                continue
             else:
-                reindex_batch(args, site)
+                reindex_range(args, site)
+                continue
             transaction.commit()
             site._p_jar.db().cacheMinimize()
         except ConflictError:
             log.warn("Conflict error: retrying....")
             transaction.abort()
+    return tid
 
 
 def calculate_docids_to_index(catalog, old_index, new_index):
+    """
+    Works out which documents in the catalog are missing from the new index,
+    and removes documents which are no longer in the catalog from it.  The
+    docids of the catalog and of the new index are both streamed in order and
+    merged, so the docids never all have to be in memory at once.  The set of
+    docids to index is attached to the new index before it is filled, and a
+    savepoint is taken after each `CHUNK_SIZE` docids, so its buckets are
+    written out and can be ghosted as it grows.
+    """
     log.info("Calculating docids to reindex...")
-    old_docids = IF.Set(get_catalog_docids(catalog))
-    new_docids = IF.Set(get_index_docids(new_index))
-
-    # Include both docids actually in the new index and docids we have tried to
-    # index, since some docids might not actually be in the index if their
-    # discriminator returns no value for texts.
-    to_index = IF.difference(old_docids, new_docids)
-    new_index.to_index = IF.difference(to_index, new_index.indexed)
-    new_index.n_to_index = len(new_index.to_index)
-
-    # Set of docids to unindex (user may have deleted something during reindex)
-    # should be pretty small.  Just go ahead and handle that here.
-    to_unindex = IF.difference(new_docids, old_docids)
+    indexed = new_index.indexed
+    to_index = new_index.to_index = IF.TreeSet()
+    to_unindex = []
+    chunk = []
+    diff = diff_docids(get_catalog_docids(catalog), get_index_docids(new_index))
+    for docid, in_catalog in diff:
+        if not in_catalog:
+            # Set of docids to unindex (user may have deleted something
+            # during reindex) should be pretty small.
+            to_unindex.append(docid)
+
+        # Include both docids actually in the new index and docids we have
+        # tried to index, since some docids might not actually be in the
+        # index if their discriminator returns no value for texts.
+        elif docid not in indexed:
+            chunk.append(docid)
+            if len(chunk) >= CHUNK_SIZE:
+                to_index.update(chunk)
+                chunk = []
+                transaction.savepoint(True)
+    to_index.update(chunk)
+    new_index.n_to_index = len(to_index)
+
     for docid in to_unindex:
         new_index.unindex_doc(docid)
 
 
+def diff_docids(catalog_docids, index_docids):
+    """
+    Merges two iterables of docids, each in ascending order, and yields the
+    docids which are in only one of them, with whether they are in the first.
+    A docid repeated in either iterable is only considered once.
+    """
+    catalog_docids = _unique(catalog_docids)
+    index_docids = _unique(index_docids)
+    left = next(catalog_docids, None)
+    right = next(index_docids, None)
+    while left is not None or right is not None:
+        if right is None or (left is not None and left < right):
+            yield left, True
+            left = next(catalog_docids, None)
+        elif left is None or right < left:
+            yield right, False
+            right = next(index_docids, None)
+        else:
+            left = next(catalog_docids, None)
+            right = next(index_docids, None)
+
+
+def _unique(docids):
+    # Skips repeats in an iterable of docids in ascending order.
+    last = None
+    for docid in docids:
+        if docid != last:
+            yield docid
+            last = docid
+
+
 def get_index_docids(index):
+    """
+    Returns an iterator over the docids in a text index, in ascending order.
+    """
     # We have to peek inside the index because listing the docids
     # is not an exposed API.
     if isinstance(index, KarlPGTextIndex):
-        cursor = index.cursor
-        cursor.execute("SELECT docid from %(table)s" % index._subs)
-        return (row[0] for row in cursor)
+        return _pg_docids(index)
     elif isinstance(index, CatalogTextIndex):
-        return index.index._docwords.keys()
+        return iter(index.index._docwords.keys())
     else:
         raise TypeError("Don't know how to get_index_docids from %s" % index)
 
 
+def _pg_docids(index):
+    # A named cursor is a server side cursor, so the rows are fetched in
+    # chunks of `itersize` as they are iterated over.
+    cursor = index.cursor.connection.cursor('karlserve_reindex_docids')
+    cursor.itersize = CHUNK_SIZE
+    try:
+        cursor.execute("SELECT docid FROM %(table)s ORDER BY docid"
+                       % index._subs)
+        for row in cursor:
+            yield row[0]
+    finally:
+        cursor.close()
+
+
 def get_catalog_docids(catalog):
-    return catalog.document_map.docid_to_address.keys()
+    # BTree iteration loads one bucket at a time, in key order.
+    return iter(catalog.document_map.docid_to_address.keys())
 
 
-def reindex_batch(args, site):
-    catalog = find_catalog(site)
-    addr = catalog.document_map.address_for_docid
-    new_index = catalog['new_texts']
+def reindex_parallel(args, site):
+    """
+    Reindexes the documents left to index with `args.workers` processes, each
+    indexing the documents in its own range of docids, in its own
+    transactions.  Database connections can't be shared across a fork, so the
+    instance is closed before forking and each process opens its own
+    connection.  Returns the site, from a new connection.
+
+    Each worker records its progress under its own key in
+    `new_index.progress`, as a single process would, so reindexing can still
+    be interrupted and resumed, with any number of workers.  Concurrent
+    changes to different keys are merged by the BTree's conflict resolution.
+    """
+    new_index = find_catalog(site)['new_texts']
+    ranges = split_docids(new_index.to_index, args.workers)
+    transaction.abort()
+    args.get_instance(args.inst).close()
+
+    log.info("Reindexing with %d workers.", len(ranges))
+    children = {}
+    for start, end in ranges:
+        pid = os.fork()
+        if pid:
+            children[pid] = (start, end)
+            continue
+        status = 1
+        try:
+            site, closer = args.get_root(args.inst)
+            reindex_range(args, site, start, end)
+            status = 0
+        except:
+            log.exception("Worker %d failed.", os.getpid())
+        finally:
+            try:
+                transaction.abort()
+                args.get_instance(args.inst).close()
+            finally:
+                os._exit(status)
+
+    failed = []
+    while children:
+        pid, status = os.wait()
+        docids = children.pop(pid, None)
+        if docids is not None and status:
+            failed.append(docids)
+    if failed:
+        raise RuntimeError("Reindexing failed for docids in: %s" % ', '.join(
+            ['%s-%s' % docids for docids in failed]))
+
+    site, closer = args.get_root(args.inst)
+    return site
+
+
+def split_docids(docids, n):
+    """
+    Splits a set of docids into at most `n` ranges of about the same number of
+    docids.  Returns a list of (min, max) pairs, inclusive, where the max of
+    the last range is `None`.
+    """
+    count = len(docids)
+    n = max(1, min(n, count))
+    keys = docids.keys()
+    starts = [keys[i * count // n] for i in xrange(n)]
+    ends = [start - 1 for start in starts[1:]] + [None]
+    return zip(starts, ends)
+
+
+def settle_progress(new_index):
+    """
+    Moves the docids which the progress markers show have been reindexed
+    from `to_index` to `indexed`, and clears the markers.  This is done in
+    bulk, in transactions of `CHUNK_SIZE` docids, before the documents left to
+    index are split up again or worked out again.  If it is interrupted,
+    whatever hasn't been moved yet is moved the next time.
+    """
+    progress = getattr(new_index, 'progress', None)
+    if progress is None:
+        # Reindexing was started by an older version, which moved each
+        # docid as it was reindexed.
+        new_index.progress = II.BTree()
+        transaction.commit()
+        return
+    if not progress:
+        return
+
+    log.info("Recording progress...")
     to_index = new_index.to_index
     indexed = new_index.indexed
-    l = new_index.n_to_index
-    offset = l - len(to_index)
-    batch = []
-    for i in xrange(min(BATCH_SIZE, len(to_index))):
-        batch.append(to_index[i])
-    for i, docid in enumerate(batch):
-        to_index.remove(docid)
-        indexed.add(docid)
-        path = addr(docid)
-        if path is None:
-            continue
+    for first, last in list(progress.items()):
+        while True:
+            chunk = list(itertools.islice(
+                to_index.keys(first, last), CHUNK_SIZE))
+            if not chunk:
+                break
+            indexed.update(chunk)
+            for docid in chunk:
+                to_index.remove(docid)
+            transaction.commit()
+    progress.clear()
+    transaction.commit()
+
+
+def reindex_range(args, site, start=None, end=None):
+    """
+    Reindexes the documents left to index, optionally only those with docids
+    from `start` to `end`, inclusive, a batch per transaction.  The size of
+    the batches adapts to how long commits take, to conflicts and to the
+    growth of the process's memory use.
+
+    Rather than moving each docid from `to_index` to `indexed` as it goes,
+    which would make every batch rewrite the buckets of both sets, the last
+    docid reindexed in the range is recorded in `new_index.progress`, keyed
+    by the first docid in the range.  `settle_progress` moves the docids in
+    bulk later.
+    """
+    sizer = BatchSizer(args.batch_size, args.min_batch_size,
+                       args.max_batch_size, args.commit_time,
+                       args.memory_growth)
+    new_index = find_catalog(site)['new_texts']
+    first = next(iter(new_index.to_index.keys(start, end)), None)
+    if first is None:
+        return
+    progress = Progress(len(remaining_docids(new_index, first, end)),
+                        args.report_interval)
+    while True:
+        memory = _max_rss()
         try:
-            doc = find_model(site, path)
-        except KeyError:
-            log.warn("No object at path: %s", path)
+            count = reindex_batch(args, site, sizer.size, progress,
+                                  first, end)
+            if not count:
+                break
+            committing = time.time()
+            transaction.commit()
+            commit_time = time.time() - committing
+            site._p_jar.db().cacheMinimize()
+        except ConflictError:
+            log.warn("Conflict error: retrying....")
+            transaction.abort()
+            progress.conflicted()
+            sizer.conflicted()
             continue
+        progress.committed(count)
+        sizer.committed(commit_time, _max_rss() - memory)
+        progress.maybe_report(sizer.size)
+    progress.report(sizer.size)
+
+
+def remaining_docids(new_index, first, end=None):
+    """
+    Returns the docids left to reindex in the range of docids starting with
+    `first`, up to `end`, inclusive, in order.
+    """
+    last = new_index.progress.get(first)
+    if last is None:
+        return new_index.to_index.keys(first, end)
+    return new_index.to_index.keys(last, end, excludemin=True)
+
 
-        log.info("Reindexing (%d/%d) %s", i + offset + 1, l, path)
-        new_index.index_doc(docid, doc)
-        deactivate = getattr(doc, '_p_deactivate', None)
+def reindex_batch(args, site, size=BATCH_SIZE, progress=None, first=None,
+                  end=None):
+    """
+    Reindexes the next batch of `size` documents left to index in the range
+    of docids starting with `first`, up to `end`, inclusive.  Returns the
+    number of documents in the batch.
+    """
+    catalog = find_catalog(site)
+    addr = catalog.document_map.address_for_docid
+    new_index = catalog['new_texts']
+    if first is None:
+        first = next(iter(new_index.to_index.keys()), None)
+        if first is None:
+            return 0
+    batch = list(itertools.islice(
+        remaining_docids(new_index, first, end), size))
+    if not batch:
+        return 0
+    with counting_text(new_index, progress):
+        for docid in batch:
+            path = addr(docid)
+            if path is None:
+                continue
+            try:
+                doc = find_model(site, path)
+            except KeyError:
+                log.warn("No object at path: %s", path)
+                continue
+
+            log.debug("Reindexing %s", path)
+            new_index.index_doc(docid, doc)
+            deactivate = getattr(doc, '_p_deactivate', None)
+            if deactivate is not None:
+                deactivate()
+    new_index.progress[first] = batch[-1]
+    return len(batch)
+
+
+def reindex_incremental(args, site, since):
+    """
+    Reindexes the documents changed by transactions committed after the one
+    with the id `since`, found in the storage's transaction log.  Changed
+    documents which are no longer in the catalog are unindexed.  Returns the
+    id of the last transaction looked at.
+    """
+    tid = last_transaction(site)
+    log.info("Finding documents changed since transaction %016x...", since)
+    docids = changed_docids(site, since, tid)
+    catalog = find_catalog(site)
+    index = catalog['texts']
+    addr = catalog.document_map.address_for_docid
+    progress = Progress(len(docids), args.report_interval)
+    for i in xrange(0, len(docids), args.batch_size):
+        batch = docids[i:i + args.batch_size]
+        while True:
+            try:
+                with counting_text(index, progress):
+                    for docid in batch:
+                        path = addr(docid)
+                        doc = None
+                        if path is not None:
+                            try:
+                                doc = find_model(site, path)
+                            except KeyError:
+                                pass
+                        if doc is None:
+                            index.unindex_doc(docid)
+                            continue
+                        log.debug("Reindexing %s", path)
+                        index.index_doc(docid, doc)
+                transaction.commit()
+                site._p_jar.db().cacheMinimize()
+            except ConflictError:
+                log.warn("Conflict error: retrying....")
+                transaction.abort()
+                progress.conflicted()
+                continue
+            progress.committed(len(batch))
+            progress.maybe_report(args.batch_size)
+            break
+    progress.report(args.batch_size)
+    log.info("Reindexed changes up to transaction %016x.", tid)
+    return tid
+
+
+def changed_docids(site, since, until):
+    """
+    Returns the sorted docids of the documents changed by transactions
+    committed after `since`, up to and including `until`.  A changed object
+    which isn't a document itself, like an attachment or a container of
+    comments, counts as a change to the nearest document above it in the
+    `__parent__` chain.  Objects outside that chain, like the ZODB blobs of
+    files, are only found through the document holding them.
+    """
+    jar = site._p_jar
+    storage = jar.db().storage
+    oids = set()
+    transactions = storage.iterator(p64(since + 1), p64(until))
+    try:
+        for txn in transactions:
+            for record in txn:
+                oids.add(record.oid)
+    finally:
+        close = getattr(transactions, 'close', None)
+        if close is not None:
+            close()
+
+    docids = set()
+    for oid in oids:
+        try:
+            obj = jar.get(oid)
+        except (KeyError, POSKeyError):
+            # Removed by a pack since.
+            continue
+        docid = _find_docid(obj)
+        if docid is not None:
+            docids.add(docid)
+        deactivate = getattr(obj, '_p_deactivate', None)
         if deactivate is not None:
             deactivate()
+    return sorted(docids)
+
+
+def _find_docid(obj):
+    while obj is not None:
+        docid = getattr(obj, 'docid', None)
+        if isinstance(docid, (int, long)):
+            return docid
+        obj = getattr(obj, '__parent__', None)
+    return None
+
+
+@contextlib.contextmanager
+def counting_text(index, progress):
+    """
+    Counts the bytes of text of the documents `index` indexes, for `progress`,
+    by wrapping the index's discriminator.  The wrapper is put in the index's
+    `__dict__` directly, so the index isn't marked as changed and the wrapper
+    is never stored.  The index is only ghosted between transactions.
+    """
+    discriminator = getattr(index, 'discriminator', None)
+    if progress is None or not callable(discriminator):
+        yield
+        return
+
+    def discriminate(obj, default):
+        value = discriminator(obj, default)
+        if value is not default:
+            progress.text_bytes += _text_size(value)
+        return value
+
+    index.__dict__['discriminator'] = discriminate
+    try:
+        yield
+    finally:
+        index.__dict__['discriminator'] = discriminator
+
+
+def _text_size(value):
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum([_text_size(item) for item in value])
+    return 0
+
 
+def _max_rss():
+    # Peak resident set size of this process, in bytes.  Linux reports it in
+    # kilobytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class BatchSizer(object):
+    """
+    Adapts the number of documents reindexed per transaction.  The batch size
+    is halved after a conflict, or if the last commit took longer than
+    `commit_time` seconds or the peak memory use of the process grew by more
+    than `memory_growth` bytes during the last batch.  It grows by a quarter
+    if the last commit took less than half of `commit_time`.  It is kept
+    between `min_size` and `max_size`.
+    """
+    grow = 1.25
+    shrink = 0.5
+
+    def __init__(self, size=BATCH_SIZE, min_size=MIN_BATCH_SIZE,
+                 max_size=MAX_BATCH_SIZE, commit_time=5.0,
+                 memory_growth=256 << 20):
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.commit_time = commit_time
+        self.memory_growth = memory_growth
+        self.size = self._bounded(size)
+
+    def committed(self, commit_time, memory_growth):
+        if (commit_time > self.commit_time or
+                memory_growth > self.memory_growth):
+            self.size = self._bounded(self.size * self.shrink)
+        elif commit_time < self.commit_time / 2:
+            # Grow by at least one document, so small batches grow too.
+            self.size = self._bounded(max(self.size * self.grow,
+                                          self.size + 1))
+
+    def conflicted(self):
+        self.size = self._bounded(self.size * self.shrink)
+
+    def _bounded(self, size):
+        return int(max(self.min_size, min(self.max_size, size)))
+
+
+class Progress(object):
+    """
+    Keeps track of the documents reindexed by this process, out of `total`,
+    and logs a summary every `interval` seconds.  Text counted for a batch
+    which is then retried is not included in the summaries.
+    """
+    text_bytes = 0
+
+    def __init__(self, total, interval=60.0):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.conflicts = 0
+        self.indexed_bytes = 0
+        self.started = self.reported = time.time()
+
+    def committed(self, count):
+        self.done += count
+        self.indexed_bytes += self.text_bytes
+        self.text_bytes = 0
+
+    def conflicted(self):
+        self.conflicts += 1
+        self.text_bytes = 0
+
+    def maybe_report(self, batch_size):
+        if time.time() - self.reported >= self.interval:
+            self.report(batch_size)
+
+    def report(self, batch_size):
+        now = self.reported = time.time()
+        elapsed = max(now - self.started, 0.001)
+        rate = self.done / elapsed
+        remaining = max(self.total - self.done, 0)
+        eta = 'unknown'
+        if rate:
+            eta = _format_seconds(remaining / rate)
+        log.info("Reindexed %d/%d documents (%.1f docs/s, %.1f MB of text), "
+                 "%d conflicts retried, batch size %d, ETA %s.",
+                 self.done, self.total, rate, self.indexed_bytes / 1048576.0,
+                 self.conflicts, batch_size, eta)
+
+
+def _format_seconds(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
@@ -1,18 +1,380 @@
+from __future__ import with_statement
+
+import ConfigParser
+import errno
+import logging
 import os
+import signal
 import sys
+import threading
+import time
 
+from paste.httpserver import serve
 from paste.script.serve import ServeCommand
+from pyramid.config import global_registries
+from repoze.depinj import lookup
+
+from karl.utils import asbool
+from karlserve.instance import get_instances
+
+log = logging.getLogger(__name__)
 
 
 def config_parser(name, subparsers, **helpers):
     parser = subparsers.add_parser(
         name, help='Serve the application using Paste HTTP server.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Fork this many worker processes, sharing the '
+                        'application loaded by the master process.  By '
+                        'default a single threaded process is served.')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Maximum number of requests a worker serves at '
+                        'once.  Defaults to threadpool_workers in the '
+                        '[server:main] section of the config, or 10.  Only '
+                        'used with --workers.')
+    parser.add_argument('--max-requests', type=int, default=0,
+                        help='Restart a worker after it has served this '
+                        'many requests.  Only used with --workers.')
+    parser.add_argument('--graceful-timeout', type=float, default=30,
+                        help='Seconds to wait for workers to finish their '
+                        'requests on shutdown before killing them.')
+    parser.add_argument('--gevent', action='store_true', default=False,
+                        help='Serve requests from greenlets instead of '
+                        'threads.  Requires gevent, and must be run from the '
+                        'karlserve-gevent script.')
+    parser.add_argument('--connections', type=int, default=1000,
+                        help='Maximum number of connections served at once. '
+                        'Only used with --gevent.')
+    parser.add_argument('--host', default=None,
+                        help='Interface to listen on.  Defaults to the host '
+                        'in the [server:main] section of the config.  Only '
+                        'used with --workers or --gevent.')
+    parser.add_argument('--port', type=int, default=None,
+                        help='Port to listen on.  Defaults to the port in the '
+                        '[server:main] section of the config.  Only used with '
+                        '--workers or --gevent.')
     parser.set_defaults(func=main, parser=parser)
 
 
 def main(args):
+    if args.gevent:
+        if args.workers:
+            args.parser.error("--gevent can't be used with --workers.")
+        sys.exit(serve_gevent(args))
+    if args.workers:
+        sys.exit(prefork(args))
+
     os.environ['PASTE_CONFIG_FILE'] = args.config
 
-    cmd = ServeCommand('karlserve serve')
+    cmd = KarlServeCommand('karlserve serve')
+    cmd.server_threads = server_threads(args)
     exit_code = cmd.run([])
     sys.exit(exit_code)
+
+
+class KarlServeCommand(ServeCommand):
+    """
+    Tells the application it is being loaded to be served, so it preloads
+    instances if ``preload_instances`` is set, and how many threads serve it,
+    for ``zodb.autosize``.  The prefork master sets `preload` to false, as its
+    workers preload their own instances.
+    """
+    server_threads = None
+    preload = True
+
+    def loadapp(self, app_spec, name, relative_to, **kw):
+        global_conf = dict(kw.pop('global_conf', None) or {})
+        if self.preload:
+            global_conf['karlserve.serve'] = 'true'
+        if self.server_threads is not None:
+            global_conf['karlserve.server_threads'] = str(self.server_threads)
+        return ServeCommand.loadapp(self, app_spec, name, relative_to,
+                                    global_conf=global_conf, **kw)
+
+
+def load_app(args, threads, preload=True):
+    """
+    Loads the application to serve the way ``karlserve serve`` does without
+    ``--workers`` or ``--gevent``: logging is configured from the config, then
+    the ``main`` application, with the filters of its pipeline, is loaded.
+    Returns the application along with the settings of the Karl application
+    it wraps.
+    """
+    config = os.path.abspath(args.config)
+    cmd = KarlServeCommand('karlserve serve')
+    cmd.server_threads = threads
+    cmd.preload = preload
+    cmd.logging_file_config(config)
+    app = cmd.loadapp('config:%s' % config, None, os.getcwd())
+    return app, global_registries.last.settings
+
+
+def prefork(args):
+    """
+    Serves the application from `args.workers` forked worker processes.
+
+    The application is loaded by the master process, as it is served without
+    ``--workers``, so the workers share Karl's code and the compiled
+    configuration with the master, copy-on-write.  Database connections can't
+    be shared across a fork, so any instances spun up in the master are closed
+    before forking and each worker spins up (or preloads) its own.  Each
+    worker sets ``KARLSERVE_WORKER_ID`` to its slot number, for sharding of
+    instances across workers.
+
+    The workers share the listening socket, unless instances are sharded.
+    A sharded worker only serves its own instances, so the front end proxy
+    has to pick the worker: each worker then listens on its own port, the
+    configured port plus its slot number, as listed by ``karlserve shards``.
+
+    Each worker serves at most `args.threads` requests at once, from a thread
+    per request.
+
+    The master restarts workers which exit and, on SIGTERM or SIGINT, tells the
+    workers to finish the requests they are serving and exit.
+    """
+    host, port = server_address(args)
+    threads = args.threads
+    if threads is None:
+        threads = server_threads(args) or 10
+    app, settings = lookup(load_app)(args, threads, preload=False)
+    instances = get_instances(settings)
+    sharding = instances.sharding
+    if sharding is None:
+        addresses = [(host, port)]
+    else:
+        if sharding.workers != args.workers:
+            args.parser.error("--workers must be sharding.workers (%d) when "
+                              "instances are sharded." % sharding.workers)
+        addresses = [sharding.worker_address(host, port, slot)
+                     for slot in xrange(args.workers)]
+
+    app = WorkerApp(app, args.max_requests, threads)
+    servers = [lookup(serve)(app, host, port, use_threadpool=False,
+                             start_loop=False)
+               for host, port in addresses]
+    instances.close()
+    for host, port in addresses:
+        log.info("Serving on http://%s:%s with %d workers.",
+                 host, port, args.workers / len(addresses))
+
+    master = lookup(Master)(servers, app, settings, args.workers,
+                            args.graceful_timeout)
+    return master.run()
+
+
+def serve_gevent(args):
+    """
+    Serves the application from greenlets, so that requests waiting on the
+    database, on blobs or on slow clients don't each tie up a thread.
+
+    The standard library has already been monkeypatched by the
+    ``karlserve-gevent`` script, before anything imported it, so thread
+    locals, such as the current instance, are greenlet locals.  psycopg2
+    waits on PostgreSQL in C code, which blocks every greenlet unless
+    psycogreen is installed.
+    """
+    import gevent
+    from gevent.monkey import is_module_patched
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+
+    if not is_module_patched('socket'):
+        args.parser.error("gevent must patch the standard library before the "
+                          "application is loaded.  Run karlserve-gevent "
+                          "serve --gevent.")
+    try:
+        from psycopg2.extensions import get_wait_callback
+        if get_wait_callback() is None:
+            log.warn("psycopg2 will block every greenlet while waiting on "
+                     "PostgreSQL.  Install psycogreen.")
+    except ImportError:
+        pass
+
+    # A greenlet per connection, each of which can use a database connection.
+    app, settings = lookup(load_app)(args, args.connections)
+
+    host, port = server_address(args)
+    server = WSGIServer((host, port), app, spawn=Pool(args.connections),
+                        log=None)
+    gevent.signal(signal.SIGTERM, server.stop, args.graceful_timeout)
+    log.info("Serving on http://%s:%s with gevent.", host, port)
+    server.serve_forever()
+    return 0
+
+
+def _server_options(args):
+    parser = ConfigParser.ConfigParser()
+    parser.read(args.config)
+    if parser.has_section('server:main'):
+        return dict(parser.items('server:main', raw=True))
+    return {}
+
+
+def server_address(args):
+    options = _server_options(args)
+    host = options.get('host', '127.0.0.1')
+    port = int(options.get('port', 8080))
+    if args.host is not None:
+        host = args.host
+    if args.port is not None:
+        port = args.port
+    return host, port
+
+
+def server_threads(args):
+    """
+    Returns the number of threads the Paste HTTP server configured in the
+    ``[server:main]`` section of the config serves requests from, or `None` if
+    it starts a thread per request.
+    """
+    options = _server_options(args)
+    if not asbool(options.get('use_threadpool', True)):
+        return None
+    return int(options.get('threadpool_workers', 10))
+
+
+class WorkerApp(object):
+    """
+    Counts the requests served by a worker and stops the worker once it has
+    served `max_requests` of them.  If `threads` is set, at most that many
+    requests are served at once; other request threads wait their turn.
+    """
+    server = None
+
+    def __init__(self, app, max_requests=0, threads=0):
+        self.app = app
+        self.max_requests = max_requests
+        self.threads = threads
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._slots = None
+        if threads:
+            self._slots = threading.BoundedSemaphore(threads)
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.requests += 1
+            requests = self.requests
+        if self.max_requests and requests == self.max_requests:
+            log.info("Worker %d served %d requests, restarting.",
+                     os.getpid(), requests)
+            self.stop()
+        slots = self._slots
+        if slots is None:
+            return self.app(environ, start_response)
+        with slots:
+            return self.app(environ, start_response)
+
+    def stop(self):
+        # shutdown() blocks until the serve loop exits, so it can't be called
+        # from a request thread or a signal handler in the serving thread.
+        thread = threading.Thread(target=self.server.shutdown)
+        thread.setDaemon(True)
+        thread.start()
+
+
+class Master(object):
+    """
+    Forks and looks after `workers` worker processes serving `app`.  Either
+    every worker serves from the one server in `servers`, or each worker
+    serves from the server at its slot.
+    """
+
+    def __init__(self, servers, app, settings, workers, graceful_timeout=30):
+        self.servers = servers
+        self.app = app
+        self.settings = settings
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.children = {}
+        self.running = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for slot in xrange(self.workers):
+            self.spawn(slot)
+
+        while self.running:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            slot, started = self.children.pop(pid, (None, None))
+            if slot is None or not self.running:
+                continue
+            log.info("Worker %d exited with status %d.", pid, status)
+            if time.time() - started < 1:
+                # Don't fork in a tight loop if workers die on start up.
+                time.sleep(1)
+            self.spawn(slot)
+
+        self.drain()
+        for server in self.servers:
+            server.server_close()
+        return 0
+
+    def server(self, slot):
+        servers = self.servers
+        if len(servers) == 1:
+            return servers[0]
+        return servers[slot]
+
+    def stop(self, signum, frame):
+        self.running = False
+
+    def spawn(self, slot):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (slot, time.time())
+            return
+        try:
+            status = self.serve(slot)
+        except:
+            log.exception("Worker %d failed.", os.getpid())
+            status = 1
+        os._exit(status)
+
+    def serve(self, slot):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.app.stop())
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        os.environ['KARLSERVE_WORKER_ID'] = str(slot)
+        server = self.server(slot)
+        for other in self.servers:
+            if other is not server:
+                other.server_close()
+        self.app.server = server
+
+        preload = self.settings.get('preload_instances')
+        if preload:
+            from karlserve.application import preload_instances
+            preload_instances(self.settings, preload)
+
+        server.serve_forever()
+
+        # Let requests in progress finish before closing the databases.
+        deadline = time.time() + self.graceful_timeout
+        for thread in threading.enumerate():
+            if thread is threading.currentThread() or thread.isDaemon():
+                continue
+            thread.join(max(deadline - time.time(), 0))
+        get_instances(self.settings).close()
+        return 0
+
+    def drain(self):
+        for pid in self.children:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self.children and time.time() < deadline:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                self.children.pop(pid, None)
+            else:
+                time.sleep(0.1)
+        for pid in self.children:
+            log.warn("Killing worker %d.", pid)
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.children.clear()
@@ -0,0 +1,43 @@
+import json
+
+from karlserve.instance import get_instances
+from karlserve.scripts.serve import server_address
+
+
+def config_parser(name, subparsers, **helpers):
+    parser = subparsers.add_parser(
+        name, help='Show which worker processes serve which instances.')
+    parser.add_argument('--json', action='store_true', default=False,
+                        help='Output the routing map as JSON.')
+    parser.add_argument('--host', default=None,
+                        help='Interface the workers listen on.  Defaults to '
+                        'the host in the [server:main] section of the '
+                        'config.')
+    parser.add_argument('--port', type=int, default=None,
+                        help='Port the first worker listens on.  Each worker '
+                        'listens on this port plus its id, as with '
+                        '"karlserve serve --workers".  Defaults to the port '
+                        'in the [server:main] section of the config.')
+    parser.set_defaults(func=main, parser=parser)
+
+
+def main(args):
+    instances = get_instances(args.app.registry.settings)
+    sharding = instances.sharding
+    if sharding is None:
+        args.parser.error("Sharding is not enabled.  Set sharding.workers "
+                          "in the configuration.")
+
+    routing = sharding.routing_map(instances, server_address(args))
+    if args.json:
+        print >> args.out, json.dumps(routing, sort_keys=True, indent=2)
+        return
+
+    for name in sorted(routing):
+        route = routing[name]
+        hosts = ' '.join(route['hosts'])
+        if route['root']:
+            hosts = ('%s /' % hosts).strip()
+        print >> args.out, '%-14s workers=%-10s %-40s %s' % (
+            name, ','.join(map(str, route['workers'])),
+            ','.join(route['addresses']), hosts)
@@ -1,4 +1,5 @@
 import cgi
+import itertools
 import os
 from cStringIO import StringIO
 import urlparse
@@ -10,6 +11,7 @@ from repoze.zodbconn.datatypes import TRUETYPES
 from ZEO.ClientStorage import ClientStorage
 from ZODB.FileStorage.FileStorage import FileStorage
 from ZODB.blob import BlobStorage
+from ZODB.DB import DB
 import ZConfig
 
 try:
@@ -40,20 +42,63 @@ def _storage_from_dsn(dsn, options, w_prefix):
         raise NotImplementedError(
             "Must have relstorage installed to use dsns.")
 
-    from relstorage.options import Options
-    from relstorage.storage import RelStorage
-    from relstorage.adapters.postgresql import PostgreSQLAdapter
+    factory = RelStorageFactory(
+        dsn, options[w_prefix('blob_cache')],
+        keep_history=options.get(w_prefix('keep_history'), False),
+        blob_cache_size=10 * 1<<20) # 10 MB
+    return factory()
 
-    options = Options(**{
-        'blob_dir': options[w_prefix('blob_cache')],
-        'shared_blob_dir': False,
-        'keep_history': options.get(w_prefix('keep_history'), False),
-        'blob_cache_size': 10 * 1<<20 # 10 MB
-    })
-    adapter = PostgreSQLAdapter(dsn, options=options)
-    storage = RelStorage(adapter, options=options)
 
-    return storage
+class RelStorageFactory(object):
+    """
+    Opens a RelStorage on PostgreSQL configured like the ``<relstorage>``
+    section of a zconfig would configure it, but straight from settings,
+    without generating and parsing a configuration.  Settings may be given as
+    strings, as they are found in the ini file.
+    """
+
+    def __init__(self, dsn, blob_dir, keep_history=False, read_only=False,
+                 blob_cache_size='8gb', cache_servers=None, cache_prefix=None,
+                 poll_interval=0):
+        self.dsn = dsn
+        self.blob_dir = blob_dir
+        self.keep_history = _bool(keep_history)
+        self.read_only = _bool(read_only)
+        if isinstance(blob_cache_size, basestring):
+            blob_cache_size = byte_size(blob_cache_size)
+        self.blob_cache_size = blob_cache_size
+        self.cache_servers = cache_servers
+        self.cache_prefix = cache_prefix
+        self.poll_interval = int(poll_interval or 0)
+
+    def options(self):
+        from relstorage.options import Options
+        kw = dict(
+            blob_dir=self.blob_dir,
+            shared_blob_dir=False,
+            blob_cache_size=self.blob_cache_size,
+            keep_history=self.keep_history,
+            read_only=self.read_only,
+        )
+        if self.cache_servers:
+            kw['cache_servers'] = self.cache_servers
+            kw['cache_prefix'] = self.cache_prefix
+        if self.poll_interval:
+            kw['poll_interval'] = self.poll_interval
+        return Options(**kw)
+
+    def __call__(self):
+        from relstorage.adapters.postgresql import PostgreSQLAdapter
+        from relstorage.storage import RelStorage
+        options = self.options()
+        adapter = PostgreSQLAdapter(self.dsn, options=options)
+        return RelStorage(adapter, options=options)
+
+
+def _bool(value):
+    if isinstance(value, basestring):
+        return value.lower() in TRUETYPES
+    return bool(value)
 
 
 ##############################################################################
@@ -207,8 +252,7 @@ class _ZConfigURIResolver(object):
          # urlparse doesnt understand file URLs and stuffs everything into path
         (scheme, netloc, path, query, frag) = urlparse.urlsplit('http:' + path)
         path = os.path.normpath(path)
-        schema_xml = self.schema_xml_template
-        schema = ZConfig.loadSchemaFile(StringIO(schema_xml))
+        schema = _load_schema(self.schema_xml_template)
         config, handler = ZConfig.loadConfig(schema, path)
         for factory in config.databases:
             if not frag:
@@ -222,8 +266,99 @@ class _ZConfigURIResolver(object):
         return factory.open()
 
 
+class _KarlserveURIResolver(object):
+
+    def __call__(self, uri):
+        storage_factory, dbkw = get_database(uri)
+        return storage_factory()
+
+
 _RESOLVERS = {
     'zeo': _ClientStorageURIResolver(),
     'file': _FileStorageURIResolver(),
     'zconfig': _ZConfigURIResolver(),
+    'karlserve': _KarlserveURIResolver(),
 }
+
+
+##############################################################################
+#
+# Databases configured by karlserve are kept in memory, as a storage factory
+# and the options of the database, and referred to by ``karlserve://`` uris,
+# rather than written to temporary files as zconfigs and parsed again from
+# there.
+#
+
+_schemas = {}
+
+
+def _load_schema(schema_xml):
+    # Parsing a schema means importing and parsing the component.xml of every
+    # package it refers to, so each schema is only parsed once per process.
+    schema = _schemas.get(schema_xml)
+    if schema is None:
+        schema = ZConfig.loadSchemaFile(StringIO(schema_xml))
+        _schemas[schema_xml] = schema
+    return schema
+
+
+_database_options = ('cache_size', 'cache_size_bytes', 'pool_size')
+_zodburi_options = ('cache_size', 'pool_size')
+
+_databases = {}
+_database_ids = itertools.count(1)
+
+
+def register_database(name, fname, storage_factory, **dbkw):
+    """
+    Keeps a database configuration in memory and returns a ``karlserve://``
+    uri referring to it.  `storage_factory` is called with no arguments to
+    open the storage.  `dbkw` are options for the database, one of
+    ``cache_size``, ``cache_size_bytes`` and ``pool_size``.
+    """
+    for option in dbkw:
+        if option not in _database_options:
+            raise TypeError("Unknown database option: %s" % option)
+    uri = 'karlserve://%s/%d/%s' % (name, _database_ids.next(), fname)
+    _databases[uri] = (storage_factory, dbkw)
+    return uri
+
+
+def unregister_database(uri):
+    _databases.pop(uri, None)
+
+
+def get_database(uri):
+    """
+    Returns the storage factory and the database options registered for
+    `uri`.
+    """
+    try:
+        return _databases[uri]
+    except KeyError:
+        raise ValueError("Unknown database URI: %s" % uri)
+
+
+def db_from_karlserve_uri(uri, dbname, databases):
+    """
+    Opens the database registered for a ``karlserve://`` uri and adds it to
+    the multi-database `databases` as `dbname`, like
+    `pyramid_zodbconn.db_from_uri` does for other uris.
+    """
+    storage_factory, dbkw = get_database(uri)
+    return DB(storage_factory(), database_name=dbname, databases=databases,
+              **dbkw)
+
+
+def resolve_karlserve_uri(uri):
+    """
+    `zodburi` resolver for ``karlserve://`` uris, so that code outside of
+    karlserve which opens databases by uri, eg the mail in script with the post
+    office uri, can use them.
+    """
+    storage_factory, dbkw = get_database(uri)
+    # zodburi rejects database options it doesn't know, which include
+    # cache_size_bytes, so databases opened this way don't get that limit.
+    dbkw = dict(('connection_%s' % name, dbkw[name])
+                for name in _zodburi_options if name in dbkw)
+    return storage_factory, dbkw
@@ -77,6 +77,79 @@ class Test_make_app(unittest.TestCase):
         self.failUnless(settings['mail_queue_path'].endswith('/var/mail_queue'))
         self.failUnless(settings['blob_cache'].endswith('/var/blob_cache'))
 
+    def test_metrics_path(self):
+        from karlserve.application import metrics_view
+        from karlserve.application import site_dispatch
+        global_config = {
+            'instances_config': 'instances.ini',
+            'who_secret': 'secret',
+            'who_cookie': 'terces',
+            'var': 'var',
+        }
+        config = {
+            'metrics_path': '/_karlserve/metrics',
+        }
+        app = self.call_fut(global_config, config)
+        self.assertEqual(app._added_routes,
+                         [('metrics', '/_karlserve/metrics'),
+                          ('sites', '/*subpath')])
+        self.assertEqual(app._added_views,
+                         [(metrics_view, 'metrics'),
+                          (site_dispatch, 'sites')])
+
+    def test_preload_all_instances(self):
+        from karlserve.instance import Instances
+        from repoze.depinj import inject
+        inject(DummyPreloadInstances, Instances)
+        global_config = {
+            'instances_config': 'instances.ini',
+            'who_secret': 'secret',
+            'who_cookie': 'terces',
+            'var': 'var',
+            'karlserve.serve': 'true',
+        }
+        config = {
+            'preload_instances': 'true',
+            'preload_instances.threads': '2',
+        }
+        app = self.call_fut(global_config, config)
+        instances = app.registry.settings['instances']
+        self.assertEqual(instances.preloaded, (None, 2))
+
+    def test_preload_some_instances(self):
+        from karlserve.instance import Instances
+        from repoze.depinj import inject
+        inject(DummyPreloadInstances, Instances)
+        global_config = {
+            'instances_config': 'instances.ini',
+            'who_secret': 'secret',
+            'who_cookie': 'terces',
+            'var': 'var',
+            'karlserve.serve': 'true',
+        }
+        config = {
+            'preload_instances': 'foo bar',
+        }
+        app = self.call_fut(global_config, config)
+        instances = app.registry.settings['instances']
+        self.assertEqual(instances.preloaded, (['foo', 'bar'], 4))
+
+    def test_preload_not_serving(self):
+        from karlserve.instance import Instances
+        from repoze.depinj import inject
+        inject(DummyPreloadInstances, Instances)
+        global_config = {
+            'instances_config': 'instances.ini',
+            'who_secret': 'secret',
+            'who_cookie': 'terces',
+            'var': 'var',
+        }
+        config = {
+            'preload_instances': 'true',
+        }
+        app = self.call_fut(global_config, config)
+        self.failIf('instances' in app.registry.settings)
+
 
 class Test_site_dispatch(unittest.TestCase):
 
@@ -132,10 +205,151 @@ class Test_site_dispatch(unittest.TestCase):
     def test_dispatch_virtual(self):
         request = dummy_request('/some/url')
         instances = request.registry.settings['instances']
-        instances['example.com:80'] = 'foo'
+        instances.virtual_hosts['example.com:80'] = 'foo'
         request.host = 'example.com:80'
         request, name = self.call_fut(request)
         self.assertEqual(name, 'foo')
+        self.assertEqual(request.script_name, '')
+        self.assertEqual(request.path_info, '/some/url')
+
+    def test_dispatch_other_shard(self):
+        from karlserve.instance import Sharding
+        request = dummy_request('/foo/some/url')
+        instances = request.registry.settings['instances']
+        sharding = Sharding(4)
+        owner = sharding.owners('foo')[0]
+        sharding._worker_id = (owner + 1) % 4
+        instances.sharding = sharding
+        response = self.call_fut(request)
+        self.assertEqual(response.status_int, 421)
+        self.assertEqual(response.headers['X-Karlserve-Workers'], str(owner))
+
+    def test_dispatch_own_shard(self):
+        from karlserve.instance import Sharding
+        request = dummy_request('/foo/some/url')
+        instances = request.registry.settings['instances']
+        sharding = Sharding(4)
+        sharding._worker_id = sharding.owners('foo')[0]
+        instances.sharding = sharding
+        request, name = self.call_fut(request)
+        self.assertEqual(name, 'foo')
+
+    def test_dispatch_root_instance(self):
+        request = dummy_request('/some/url')
+        instances = request.registry.settings['instances']
+        instances.root_instance = 'bar'
+        request, name = self.call_fut(request)
+        self.assertEqual(name, 'bar')
+        self.assertEqual(request.script_name, '')
+        self.assertEqual(request.path_info, '/some/url')
+
+    def test_dispatch_removes_bfg_routing_keys(self):
+        request = dummy_request('/foo/some/url')
+        request.environ['bfg.routes.matchdict'] = {}
+        request.environ['bfg.routes.route'] = 'sites'
+        request, name = self.call_fut(request)
+        self.failIf('bfg.routes.matchdict' in request.environ)
+        self.failIf('bfg.routes.route' in request.environ)
+
+    def test_dispatch_instance_root(self):
+        request = dummy_request('/foo')
+        request, name = self.call_fut(request)
+        self.assertEqual(name, 'foo')
+        self.assertEqual(request.script_name, '/foo')
+        self.assertEqual(request.path_info, '/')
+
+    def test_dispatch_too_busy(self):
+        from karlserve.instance import AdmissionGate
+        request = dummy_request('/foo/some/url')
+        instances = request.registry.settings['instances']
+        gate = AdmissionGate(1, 0, retry_after=7)
+        gate.enter()
+        instances.get('foo').gate = gate
+        response = self.call_fut(request)
+        self.assertEqual(response.status_int, 503)
+        self.assertEqual(response.headers['Retry-After'], '7')
+        self.assertEqual(gate.rejected, 1)
+
+    def test_dispatch_admitted(self):
+        from karlserve.instance import AdmissionGate
+        request = dummy_request('/foo/some/url')
+        instances = request.registry.settings['instances']
+        gate = AdmissionGate(1, 0)
+        instances.get('foo').gate = gate
+        request, name = self.call_fut(request)
+        self.assertEqual(name, 'foo')
+        self.assertEqual(gate.active, 0)
+
+    def test_dispatch_releases_instance(self):
+        request = dummy_request('/foo/some/url')
+        instances = request.registry.settings['instances']
+        instance = instances.get('foo')
+        self.call_fut(request)
+        self.assertEqual(instances.acquired, [instance])
+        self.assertEqual(instances.released, [instance])
+        self.assertEqual(instance.checked_in, ['generation'])
+
+    def test_dispatch_spin_up_fails(self):
+        from karlserve.instance import AdmissionGate
+        request = dummy_request('/foo/some/url')
+        instances = request.registry.settings['instances']
+        instance = instances.get('foo')
+        instance.checkout = instance.broken
+        gate = AdmissionGate(1, 0)
+        instance.gate = gate
+        self.assertRaises(ValueError, self.call_fut, request)
+        self.assertEqual(instances.released, [instance])
+        self.assertEqual(instance.checked_in, [])
+        self.assertEqual(gate.active, 0)
+
+    def test_dispatch_reloaded(self):
+        request = dummy_request('/foo/some/url')
+        instances = request.registry.settings['instances']
+        foo = instances.get('foo')
+        instances.table = instances.dispatch_table
+        instances.instances['foo'] = new_foo = DummyInstance('foo')
+        request, name = self.call_fut(request)
+        self.assertEqual(instances.acquired, [foo])
+        self.assertEqual(instances.released, [new_foo])
+        self.assertEqual(new_foo.checked_in, ['generation'])
+
+    def test_dispatch_removed(self):
+        from pyramid.exceptions import NotFound
+        request = dummy_request('/foo/some/url')
+        instances = request.registry.settings['instances']
+        instances.table = instances.dispatch_table
+        del instances.instances['foo']
+        self.assertRaises(NotFound, self.call_fut, request)
+        self.assertEqual(instances.released, [])
+
+    def test_dispatch_acquire_fails(self):
+        from karlserve.instance import AdmissionGate
+        request = dummy_request('/foo/some/url')
+        instances = request.registry.settings['instances']
+        instances.acquire = instances.broken
+        gate = AdmissionGate(1, 0)
+        instances.get('foo').gate = gate
+        self.assertRaises(ValueError, self.call_fut, request)
+        self.assertEqual(instances.released, [])
+        self.assertEqual(gate.active, 0)
+
+
+class Test_metrics_view(unittest.TestCase):
+
+    def call_fut(self, request):
+        from karlserve.application import metrics_view as fut
+        return fut(request)
+
+    def test_it(self):
+        import json
+        request = dummy_request('/_karlserve/metrics')
+        response = self.call_fut(request)
+        self.assertEqual(response.content_type, 'application/json')
+        report = json.loads(response.body)
+        self.assertEqual(report['instances'], {'live': 0})
+        self.assertEqual(report['admission'], {})
+        self.assertEqual(report['caches'], {})
+        self.failUnless('requests' in report)
 
 
 class DummyConfigurator(object):
@@ -163,6 +377,16 @@ class DummyConfigurator(object):
         return self
 
 
+class DummyPreloadInstances(object):
+    preloaded = None
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def preload(self, names, threads):
+        self.preloaded = (names, threads)
+
+
 class DummyRegistry(dict):
     def __init__(self, settings=None):
         self.settings = settings
@@ -176,7 +400,7 @@ class DummyRequest(BFGDummyRequest):
         self.registry.settings['instances'] = DummyInstances()
         if environ is not None:
             self.environ = environ
-        self.environ['bfg.foo'] = 'bar'
+        self.environ.setdefault('SCRIPT_NAME', '')
 
     def get_response(self, app):
         return self, app
@@ -191,30 +415,88 @@ class DummyRequest(BFGDummyRequest):
 
         return property(__get__, __set__)
 
+    @apply
+    def path_info():
+        def __get__(self):
+            return self.environ['PATH_INFO']
+
+        def __set__(self, path):
+            self.environ['PATH_INFO'] = path
+
+        return property(__get__, __set__)
+
 
 def dummy_request(path):
     request = DummyRequest()
+    request.path_info = path
     request.matchdict = {
         'subpath': filter(None, path.split('/'))
     }
     return request
 
 
-class DummyInstances(dict):
+class DummyInstances(object):
     root_instance = None
+    sharding = None
+    table = None
 
     def __init__(self):
-        super(DummyInstances, self).__init__()
-        self['foo'] = DummyInstance('foo')
-        self['bar'] = DummyInstance('bar')
+        self.instances = {
+            'foo': DummyInstance('foo'),
+            'bar': DummyInstance('bar'),
+        }
+        self.virtual_hosts = {}
+        self.acquired = []
+        self.released = []
+
+    def get(self, name):
+        return self.instances.get(name)
+
+    def check_config(self):
+        pass
+
+    def acquire(self, instance):
+        self.acquired.append(instance)
+        return self.instances.get(instance.name)
+
+    def broken(self, instance):
+        raise ValueError
 
-    get_virtual_host = dict.get
+    def stats(self):
+        return {'live': 0}
+
+    def admission_stats(self):
+        return {}
+
+    def cache_stats(self):
+        return {}
+
+    def release(self, instance):
+        self.released.append(instance)
+
+    @property
+    def dispatch_table(self):
+        from karlserve.instance import DispatchTable
+        if self.table is not None:
+            return self.table
+        return DispatchTable(self)
 
 
 class DummyInstance(object):
+    gate = None
 
     def __init__(self, name):
         self.name = name
+        self.checked_in = []
 
     def pipeline(self):
         return self.name
+
+    def checkout(self):
+        return self.name, 'generation'
+
+    def checkin(self, generation):
+        self.checked_in.append(generation)
+
+    def broken(self):
+        raise ValueError
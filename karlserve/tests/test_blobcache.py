@@ -0,0 +1,130 @@
+from __future__ import with_statement
+
+import unittest
+
+
+class Test_get_blob_cache(unittest.TestCase):
+
+    def call_fut(self, settings, root='/tmp/blobs'):
+        from karlserve.blobcache import get_blob_cache as fut
+        return fut(settings, root)
+
+    def test_not_configured(self):
+        self.assertEqual(self.call_fut({}), None)
+
+    def test_configured(self):
+        settings = {'blob_cache_budget': '10mb',
+                    'blob_cache_budget.interval': '60'}
+        cache = self.call_fut(settings)
+        self.assertEqual(cache.budget, 10 << 20)
+        self.assertEqual(cache.interval, 60)
+        self.assertEqual(cache.root, '/tmp/blobs')
+        self.failUnless(self.call_fut(settings) is cache)
+
+
+class TestBlobCacheBudget(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.root = tempfile.mkdtemp('.karlserve_tests')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.root)
+
+    def make_one(self, budget, **kw):
+        from karlserve.blobcache import BlobCacheBudget as cut
+        return cut(self.root, budget, **kw)
+
+    def write_blob(self, instance, name, size, age):
+        import os
+        import time
+        folder = os.path.join(self.root, instance, '0x00')
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        fname = os.path.join(folder, '%s.blob' % name)
+        with open(fname, 'wb') as f:
+            f.write('x' * size)
+        atime = time.time() - age
+        os.utime(fname, (atime, atime))
+        return fname
+
+    def test_under_budget(self):
+        import os
+        blob = self.write_blob('foo', 'a', 100, 0)
+        cache = self.make_one(1000)
+        self.assertEqual(cache.sweep(), 0)
+        self.failUnless(os.path.exists(blob))
+        self.assertEqual(cache.sizes, {'foo': 100})
+
+    def test_evicts_least_recently_used(self):
+        import os
+        old = self.write_blob('foo', 'old', 400, 100)
+        new = self.write_blob('foo', 'new', 400, 10)
+        cache = self.make_one(500)
+        self.assertEqual(cache.sweep(), 400)
+        self.failIf(os.path.exists(old))
+        self.failUnless(os.path.exists(new))
+        self.assertEqual(cache.evicted, 400)
+
+    def test_shares_follow_traffic(self):
+        import os
+        busy = [self.write_blob('busy', str(i), 100, 10) for i in range(8)]
+        idle = [self.write_blob('idle', str(i), 100, 10000 + i)
+                for i in range(8)]
+        cache = self.make_one(1000, window=3600)
+        cache.sweep()
+        self.failUnless(cache.shares['busy'] > cache.shares['idle'])
+        self.failUnless(all(os.path.exists(fname) for fname in busy))
+        self.assertEqual(len(filter(os.path.exists, idle)), 0)
+        self.failUnless(sum(cache.sizes.values()) <= 1000)
+
+    def test_sweep_locked_by_other_process(self):
+        import fcntl
+        import os
+        self.write_blob('foo', 'a', 400, 0)
+        cache = self.make_one(100)
+        lock = open(os.path.join(self.root, '.karlserve_blobcache.lock'), 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # flock locks are per open file, so this behaves like another
+            # process holding the lock.
+            self.assertEqual(cache.sweep(), None)
+        finally:
+            lock.close()
+
+    def test_hits_and_misses(self):
+        import os
+        fname = self.write_blob('foo', 'a', 10, 0)
+        storage = DummyStorage(fname)
+        cache = self.make_one(1000, interval=3600)
+        cache.watch('foo', storage)
+        storage.loadBlob('oid', 'serial')
+        os.remove(fname)
+        connection_storage = storage.new_instance()
+        connection_storage.loadBlob('oid', 'serial')
+        stats = cache.stats()['foo']
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        cache.close()
+
+
+class DummyFSHelper(object):
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def getBlobFilename(self, oid, serial):
+        return self.fname
+
+
+class DummyStorage(object):
+
+    def __init__(self, fname):
+        self.fshelper = DummyFSHelper(fname)
+
+    def loadBlob(self, oid, serial):
+        return self.fshelper.fname
+
+    def new_instance(self):
+        return DummyStorage(self.fshelper.fname)
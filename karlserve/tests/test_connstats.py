@@ -0,0 +1,246 @@
+from __future__ import with_statement
+
+import unittest
+
+
+class TestStatsWriter(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmp = tempfile.mkdtemp('.karlserve_tests')
+        self.fname = os.path.join(self.tmp, 'stats.csv')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def make_one(self, **kw):
+        from karlserve.connstats import StatsWriter as cut
+        kw.setdefault('flush_interval', 0.01)
+        return cut(self.fname, **kw)
+
+    def test_write(self):
+        writer = self.make_one()
+        writer.write('one\n')
+        writer.write('two\n')
+        writer.close()
+        self.assertEqual(open(self.fname).read(), 'one\ntwo\n')
+        self.assertEqual(writer.written, 2)
+        self.assertEqual(writer.dropped, 0)
+
+    def test_queue_full(self):
+        writer = self.make_one(queue_size=1)
+        writer.close()  # Nobody reading the queue anymore
+        writer.write('one\n')
+        writer.write('two\n')
+        self.assertEqual(writer.dropped, 1)
+
+    def test_rotate(self):
+        import os
+        with open(self.fname, 'w') as f:
+            f.write('x' * 20)
+        with open(self.fname + '.1', 'w') as f:
+            f.write('y')
+        writer = self.make_one(max_bytes=10, backup_count=2)
+        writer.write('one\n')
+        writer.close()
+        self.assertEqual(open(self.fname).read(), 'one\n')
+        self.assertEqual(open(self.fname + '.1').read(), 'x' * 20)
+        self.assertEqual(open(self.fname + '.2').read(), 'y')
+        self.failIf(os.path.exists(self.fname + '.3'))
+
+
+    def test_dropped_counted_across_threads(self):
+        import threading
+        writer = self.make_one(queue_size=1)
+        writer.close()
+        writer.write('one\n')
+
+        def write():
+            for i in xrange(1000):
+                writer.write('line\n')
+        threads = [threading.Thread(target=write) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(writer.dropped, 4000)
+
+    def test_write_waits_for_other_process(self):
+        import fcntl
+        import time
+        writer = self.make_one()
+        lock = open(self.fname + '.lock', 'w')
+        try:
+            # flock locks are per open file, so this behaves like another
+            # process holding the lock.
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            writer.write('one\n')
+            time.sleep(0.1)
+            self.assertEqual(writer.written, 0)
+        finally:
+            lock.close()
+        writer.close()
+        self.assertEqual(writer.written, 1)
+        self.assertEqual(open(self.fname).read(), 'one\n')
+
+    def test_rotate_shared_file(self):
+        import glob
+        writers = [self.make_one(max_bytes=100, backup_count=1000)
+                   for i in range(4)]
+        for i in xrange(200):
+            writers[i % 4].write('line %03d\n' % i)
+        for writer in writers:
+            writer.close()
+        lines = []
+        for fname in glob.glob(self.fname + '*'):
+            if not fname.endswith('.lock'):
+                lines.extend(open(fname).read().splitlines())
+        self.assertEqual(sorted(lines), ['line %03d' % i for i in xrange(200)])
+
+
+class Test_get_stats_writer(unittest.TestCase):
+
+    def test_not_configured(self):
+        from karlserve.connstats import get_stats_writer
+        self.assertEqual(get_stats_writer({}), None)
+
+    def test_one_per_file(self):
+        import os
+        import shutil
+        import tempfile
+        from karlserve.connstats import get_stats_writer
+        tmp = tempfile.mkdtemp('.karlserve_tests')
+        try:
+            settings = {
+                'connection_stats_filename': os.path.join(tmp, 'stats.csv'),
+                'connection_stats_max_bytes': '1MB',
+            }
+            writer = get_stats_writer(settings)
+            self.failUnless(get_stats_writer(settings) is writer)
+            self.assertEqual(writer.max_bytes, 1 << 20)
+            writer.close()
+        finally:
+            shutil.rmtree(tmp)
+
+
+class Test_instrument_storage(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        fd, self.blob = tempfile.mkstemp('.blob')
+        os.write(fd, 'x' * 100)
+        os.close(fd)
+
+    def tearDown(self):
+        import os
+        os.remove(self.blob)
+
+    def call_fut(self, storage):
+        from karlserve.connstats import instrument_storage as fut
+        fut(storage)
+
+    def test_counts(self):
+        from karlserve.connstats import read_counters
+        storage = DummyStorage(self.blob)
+        self.call_fut(storage)
+        self.call_fut(storage)  # Only wrapped once
+        before = read_counters()
+        instance = storage.new_instance()
+        instance.load('oid', '')
+        instance.loadBlob('oid', 'serial')
+        conn, cursor = instance._adapter.connmanager.open()
+        cursor.execute('SELECT 1')
+        cursor.executemany('SELECT %s', [(1,), (2,)])
+        after = read_counters()
+        self.assertEqual(after['bytes_loaded'] - before['bytes_loaded'], 5)
+        self.assertEqual(after['blob_opens'] - before['blob_opens'], 1)
+        self.assertEqual(after['blob_bytes'] - before['blob_bytes'], 100)
+        self.assertEqual(after['round_trips'] - before['round_trips'], 2)
+        self.assertEqual(cursor.executed, 2)
+
+
+class TestRequestStats(unittest.TestCase):
+
+    def setUp(self):
+        import transaction
+        transaction.begin()
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+
+    def make_one(self, connection):
+        from karlserve.connstats import RequestStats as cut
+        return cut(connection)
+
+    def test_finish(self):
+        import transaction
+        from karlserve.connstats import count
+        connection = DummyConnection()
+        stats = self.make_one(connection)
+        connection.loads = 3
+        count('round_trips', 4)
+        count('bytes_loaded', 1000)
+        transaction.commit()
+        stats.retry()
+        stats.finish()
+        self.assertEqual(stats.loads, 3)
+        self.assertEqual(stats.round_trips, 4)
+        self.assertEqual(stats.bytes_loaded, 1000)
+        self.assertEqual(stats.retries, 1)
+        self.failUnless(stats.commit_time >= 0)
+        line = stats.csv_line(DummyRequest())
+        self.failUnless(line.endswith(', 1000, 0, 0, 4, 1\n'), line)
+
+
+class DummyConnection(object):
+    loads = stores = 0
+
+    def getTransferCounts(self):
+        return self.loads, self.stores
+
+
+class DummyRequest(object):
+    method = 'GET'
+    path_url = 'http://example.com/'
+
+
+class DummyCursor(object):
+    executed = 0
+
+    def execute(self, *args):
+        self.executed += 1
+
+    def executemany(self, *args):
+        self.executed += 1
+
+
+class DummyConnManager(object):
+
+    def open(self):
+        return None, DummyCursor()
+
+
+class DummyAdapter(object):
+
+    def __init__(self):
+        self.connmanager = DummyConnManager()
+
+
+class DummyStorage(object):
+
+    def __init__(self, blob):
+        self.blob = blob
+        self._adapter = DummyAdapter()
+
+    def load(self, oid, version):
+        return 'hello', 'serial'
+
+    def loadBlob(self, oid, serial):
+        return self.blob
+
+    def new_instance(self):
+        return DummyStorage(self.blob)
@@ -0,0 +1,126 @@
+from __future__ import with_statement
+
+import unittest
+
+
+class TestStorageCopier(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp('.karlserve_tests')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def open_storage(self, name):
+        import os
+        from ZODB.FileStorage import FileStorage
+        path = os.path.join(self.tmp, name)
+        return FileStorage(path + '.fs', blob_dir=path + '.blobs')
+
+    def make_source(self):
+        import transaction
+        from persistent.mapping import PersistentMapping
+        from ZODB.DB import DB
+        from ZODB.blob import Blob
+        db = DB(self.open_storage('source'))
+        conn = db.open()
+        root = conn.root()
+        root['blob'] = Blob()
+        with root['blob'].open('w') as f:
+            f.write('first')
+        transaction.commit()
+        root['other'] = PersistentMapping()
+        transaction.commit()
+        with root['blob'].open('w') as f:
+            f.write('second')
+        transaction.commit()
+        self.blob_oid = root['blob']._p_oid
+        conn.close()
+        db.close()
+        return self.open_storage('source')
+
+    def make_one(self, source, destination, **kw):
+        from karlserve.scripts.copy_storage import StorageCopier as cut
+        return cut(source, destination, workers=2, **kw)
+
+    def read_blob(self, storage):
+        import transaction
+        from ZODB.DB import DB
+        db = DB(storage)
+        conn = db.open()
+        try:
+            with conn.root()['blob'].open() as f:
+                return f.read()
+        finally:
+            transaction.abort()
+            conn.close()
+            db.close()
+
+    def test_copy(self):
+        from StringIO import StringIO
+        source = self.make_source()
+        destination = self.open_storage('destination')
+        out = StringIO()
+        copier = self.make_one(source, destination, out=out)
+        copier.run()
+        self.assertEqual(copier.transactions, 4)
+        self.assertEqual(copier.blobs, 2)
+        self.assertEqual(copier.missing_blobs, [])
+        self.assertEqual(destination.lastTransaction(),
+                         source.lastTransaction())
+        source.close()
+        self.assertEqual(self.read_blob(destination), 'second')
+
+    def test_resume(self):
+        source = self.make_source()
+        destination = self.open_storage('destination')
+        self.make_one(source, destination).run()
+        copier = self.make_one(source, destination)
+        copier.run()
+        self.assertEqual(copier.transactions, 0)
+        source.close()
+        destination.close()
+
+    def remove_blobs(self, source):
+        import os
+        from ZODB.utils import u64
+        for txn in source.iterator():
+            for record in txn:
+                if u64(record.oid) == u64(self.blob_oid):
+                    os.remove(source.fshelper.getBlobFilename(
+                        record.oid, record.tid))
+                    return
+
+    def test_missing_blob(self):
+        from karlserve.scripts.copy_storage import MissingBlob
+        source = self.make_source()
+        self.remove_blobs(source)
+        destination = self.open_storage('destination')
+        copier = self.make_one(source, destination)
+        self.assertRaises(MissingBlob, copier.run)
+        self.assertEqual(copier.transactions, 1)
+        source.close()
+        destination.close()
+
+    def test_skip_missing_blob(self):
+        from StringIO import StringIO
+        from ZODB.utils import u64
+        source = self.make_source()
+        self.remove_blobs(source)
+        destination = self.open_storage('destination')
+        out = StringIO()
+        copier = self.make_one(source, destination, skip_missing_blobs=True,
+                               out=out)
+        copier.run()
+        self.assertEqual(copier.transactions, 4)
+        self.assertEqual(copier.blobs, 1)
+        self.assertEqual(len(copier.missing_blobs), 1)
+        oid, serial = copier.missing_blobs[0]
+        self.assertEqual(oid, u64(self.blob_oid))
+        self.failUnless('1 missing' in out.getvalue())
+        self.failUnless('oid %016x, serial %016x' % (oid, serial)
+                        in out.getvalue())
+        source.close()
+        self.assertEqual(self.read_blob(destination), 'second')
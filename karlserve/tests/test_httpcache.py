@@ -0,0 +1,286 @@
+import unittest
+
+
+class Test_is_anonymous(unittest.TestCase):
+
+    def call_fut(self, environ):
+        from karlserve.httpcache import is_anonymous as fut
+        return fut(environ, 'auth_tkt')
+
+    def test_no_credentials(self):
+        self.failUnless(self.call_fut({}))
+        self.failUnless(self.call_fut({'HTTP_COOKIE': 'foo=bar'}))
+
+    def test_cookie(self):
+        self.failIf(self.call_fut({'HTTP_COOKIE': 'foo=bar; auth_tkt=abc'}))
+
+    def test_authorization(self):
+        self.failIf(self.call_fut({'HTTP_AUTHORIZATION': 'Basic abc'}))
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def make_one(self, *args, **kw):
+        from karlserve.httpcache import ResponseCache as cut
+        return cut(*args, **kw)
+
+    def test_get_set(self):
+        cache = self.make_one()
+        key = cache.key('foo', '/a', 1, {})
+        self.assertEqual(cache.get('foo', key), None)
+        cache.set('foo', '/a', 1, {}, '200 OK', [], 'abc')
+        self.assertEqual(cache.get('foo', key), ('200 OK', [], 'abc'))
+        stats = cache.stats()['foo']
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['bytes'], 3)
+
+    def test_new_transaction_discards_older(self):
+        cache = self.make_one()
+        cache.set('foo', '/a', 1, {}, '200 OK', [], 'abc')
+        cache.set('bar', '/a', 1, {}, '200 OK', [], 'abc')
+        cache.set('foo', '/b', 2, {}, '200 OK', [], 'def')
+        self.assertEqual(cache.get('foo', cache.key('foo', '/a', 1, {})), None)
+        self.failIf(cache.get('bar', cache.key('bar', '/a', 1, {})) is None)
+        self.assertEqual(cache.bytes, 6)
+
+    def test_older_transaction_not_stored(self):
+        cache = self.make_one()
+        cache.set('foo', '/a', 2, {}, '200 OK', [], 'abc')
+        cache.set('foo', '/b', 1, {}, '200 OK', [], 'def')
+        self.assertEqual(cache.get('foo', cache.key('foo', '/b', 1, {})), None)
+
+    def test_lru(self):
+        cache = self.make_one(max_bytes=6)
+        cache.set('foo', '/a', 1, {}, '200 OK', [], 'abc')
+        cache.set('foo', '/b', 1, {}, '200 OK', [], 'def')
+        cache.get('foo', cache.key('foo', '/a', 1, {}))
+        cache.set('foo', '/c', 1, {}, '200 OK', [], 'ghi')
+        self.assertEqual(cache.get('foo', cache.key('foo', '/b', 1, {})), None)
+        self.failIf(cache.get('foo', cache.key('foo', '/a', 1, {})) is None)
+        self.assertEqual(cache.bytes, 6)
+
+    def test_vary(self):
+        cache = self.make_one()
+        headers = [('Vary', 'Accept-Language')]
+        en = {'HTTP_ACCEPT_LANGUAGE': 'en'}
+        fr = {'HTTP_ACCEPT_LANGUAGE': 'fr'}
+        cache.set('foo', '/a', 1, en, '200 OK', headers, 'hello')
+        self.failIf(cache.get('foo', cache.key('foo', '/a', 1, en)) is None)
+        self.assertEqual(cache.get('foo', cache.key('foo', '/a', 1, fr)), None)
+
+    def test_vary_star(self):
+        cache = self.make_one()
+        cache.set('foo', '/a', 1, {}, '200 OK', [('Vary', '*')], 'abc')
+        self.assertEqual(cache.bytes, 0)
+
+
+class TestResponseCacheMiddleware(unittest.TestCase):
+
+    def make_one(self, app, db):
+        from karlserve.httpcache import ResponseCache
+        from karlserve.httpcache import ResponseCacheMiddleware as cut
+        self.cache = ResponseCache()
+        return cut(app, DummyKarl(db), 'foo', self.cache)
+
+    def call(self, middleware, method='GET', **environ):
+        environ.update({'REQUEST_METHOD': method, 'wsgi.url_scheme': 'http',
+                        'HTTP_HOST': 'example.com', 'PATH_INFO': '/a'})
+        started = []
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+        body = ''.join(middleware(environ, start_response))
+        return started[0], body
+
+    def test_cached_until_commit(self):
+        app = DummyApp()
+        db = DummyDB(1)
+        middleware = self.make_one(app, db)
+        self.assertEqual(self.call(middleware), ('200 OK', 'hello 1'))
+        self.assertEqual(self.call(middleware), ('200 OK', 'hello 1'))
+        self.assertEqual(app.calls, 1)
+        db.tid = 2
+        self.assertEqual(self.call(middleware), ('200 OK', 'hello 2'))
+        self.assertEqual(app.calls, 2)
+        self.assertEqual(self.cache.stats()['foo']['hits'], 1)
+
+    def test_not_anonymous(self):
+        app = DummyApp()
+        middleware = self.make_one(app, DummyDB(1))
+        self.call(middleware, HTTP_COOKIE='auth_tkt=abc')
+        self.call(middleware, HTTP_COOKIE='auth_tkt=abc')
+        self.assertEqual(app.calls, 2)
+
+    def test_post(self):
+        app = DummyApp()
+        middleware = self.make_one(app, DummyDB(1))
+        self.call(middleware, 'POST')
+        self.call(middleware, 'POST')
+        self.assertEqual(app.calls, 2)
+
+    def test_not_cacheable(self):
+        app = DummyApp(headers=[('Set-Cookie', 'foo=bar')])
+        middleware = self.make_one(app, DummyDB(1))
+        self.call(middleware)
+        self.call(middleware)
+        self.assertEqual(app.calls, 2)
+
+        app = DummyApp(status='404 Not Found')
+        middleware = self.make_one(app, DummyDB(1))
+        self.call(middleware)
+        self.call(middleware)
+        self.assertEqual(app.calls, 2)
+
+    def test_too_big(self):
+        app = DummyApp()
+        middleware = self.make_one(app, DummyDB(1))
+        self.cache.max_entry = 3
+        self.assertEqual(self.call(middleware), ('200 OK', 'hello 1'))
+        self.call(middleware)
+        self.assertEqual(app.calls, 2)
+
+
+class TestConditionalGetMiddleware(unittest.TestCase):
+
+    def make_one(self, app, db):
+        from karlserve.httpcache import ConditionalGetMiddleware as cut
+        return cut(app, DummyKarl(db), 'salt')
+
+    def call(self, middleware, method='GET', **environ):
+        environ.update({'REQUEST_METHOD': method, 'wsgi.url_scheme': 'http',
+                        'HTTP_HOST': 'example.com', 'PATH_INFO': '/a'})
+        started = []
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, dict(headers)]
+        body = ''.join(middleware(environ, start_response))
+        return started[0], started[1], body
+
+    def tid(self):
+        # A transaction committed on 2014-01-24 at noon UTC
+        from persistent.TimeStamp import TimeStamp
+        from ZODB.utils import u64
+        return u64(TimeStamp(2014, 1, 24, 12, 0, 0).raw())
+
+    def test_adds_validators(self):
+        app = DummyApp()
+        middleware = self.make_one(app, DummyDB(self.tid()))
+        status, headers, body = self.call(middleware)
+        self.assertEqual(status, '200 OK')
+        self.failUnless(headers['ETag'].startswith('"%016x-' % self.tid()))
+        self.assertEqual(headers['Last-Modified'],
+                         'Fri, 24 Jan 2014 12:00:00 GMT')
+
+    def test_if_none_match(self):
+        app = DummyApp()
+        db = DummyDB(self.tid())
+        middleware = self.make_one(app, db)
+        status, headers, body = self.call(middleware)
+        etag = headers['ETag']
+        status, headers, body = self.call(middleware, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(body, '')
+        self.assertEqual(app.calls, 1)
+
+        db.tid += 1
+        status, headers, body = self.call(middleware, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(app.calls, 2)
+
+    def test_etag_depends_on_user(self):
+        middleware = self.make_one(DummyApp(), DummyDB(self.tid()))
+        anonymous = self.call(middleware)[1]['ETag']
+        alice = self.call(middleware, HTTP_COOKIE='auth_tkt=alice')[1]['ETag']
+        bob = self.call(middleware, HTTP_COOKIE='auth_tkt=bob')[1]['ETag']
+        self.assertEqual(len(set([anonymous, alice, bob])), 3)
+        status, headers, body = self.call(
+            middleware, HTTP_COOKIE='auth_tkt=bob', HTTP_IF_NONE_MATCH=alice)
+        self.assertEqual(status, '200 OK')
+
+    def test_if_modified_since(self):
+        # The Last-Modified date is the same for every user, so it can't
+        # tell whether the client's copy is current.
+        app = DummyApp()
+        middleware = self.make_one(app, DummyDB(self.tid()))
+        status, headers, body = self.call(
+            middleware, HTTP_IF_MODIFIED_SINCE='Fri, 24 Jan 2014 12:00:00 GMT')
+        self.assertEqual(status, '200 OK')
+        etag = headers['ETag']
+        status, headers, body = self.call(
+            middleware, HTTP_IF_MODIFIED_SINCE='Fri, 24 Jan 2014 11:59:59 GMT',
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(app.calls, 1)
+
+    def test_if_none_match_star(self):
+        app = DummyApp()
+        middleware = self.make_one(app, DummyDB(self.tid()))
+        status, headers, body = self.call(middleware, HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(app.calls, 1)
+
+    def test_not_validatable(self):
+        app = DummyApp(headers=[('Cache-Control', 'no-store')])
+        middleware = self.make_one(app, DummyDB(self.tid()))
+        status, headers, body = self.call(middleware)
+        self.failIf('ETag' in headers)
+
+    def test_post(self):
+        app = DummyApp()
+        middleware = self.make_one(app, DummyDB(self.tid()))
+        status, headers, body = self.call(middleware, 'POST',
+                                          HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(status, '200 OK')
+        self.failIf('ETag' in headers)
+
+
+class DummyApp(object):
+    calls = 0
+
+    def __init__(self, status='200 OK', headers=()):
+        self.status = status
+        self.headers = list(headers)
+
+    def __call__(self, environ, start_response):
+        self.calls += 1
+        start_response(self.status, self.headers)
+        return ['hello %s' % environ.get('karlserve.tid')]
+
+
+class DummyRegistry(object):
+
+    def __init__(self, db):
+        self._zodb_databases = {'': db}
+
+
+class DummyKarl(object):
+
+    def __init__(self, db):
+        self.registry = DummyRegistry(db)
+
+
+class DummyDB(object):
+
+    def __init__(self, tid):
+        self.tid = tid
+
+    def open(self):
+        return DummyConnection(self.tid)
+
+
+class DummyConnection(object):
+
+    def __init__(self, tid):
+        self._storage = DummyStorage(tid)
+
+    def close(self):
+        pass
+
+
+class DummyStorage(object):
+
+    def __init__(self, tid):
+        self.tid = tid
+
+    def lastTransaction(self):
+        from ZODB.utils import p64
+        return p64(self.tid)
@@ -1,3 +1,5 @@
+from __future__ import with_statement
+
 import unittest
 
 
@@ -58,6 +60,449 @@ class TestInstances(unittest.TestCase):
         instances.close()
         self.assertEqual(closed, set(['foo', 'bar']))
 
+    def test_dispatch_table(self):
+        instances = self.make_one()
+        table = instances.dispatch_table
+        environ = {'SCRIPT_NAME': '/', 'PATH_INFO': '/foo/some/url/'}
+        name, instance = table.route('localhost', environ)
+        self.assertEqual(name, 'foo')
+        self.failUnless(instance is instances.get('foo'))
+        self.assertEqual(environ['SCRIPT_NAME'], '/foo')
+        self.assertEqual(environ['PATH_INFO'], '/some/url/')
+
+        environ = {'SCRIPT_NAME': '', 'PATH_INFO': '/foo/some/url'}
+        name, instance = table.route('example.com:80', environ)
+        self.assertEqual(name, 'bar')
+        self.assertEqual(environ['SCRIPT_NAME'], '')
+        self.assertEqual(environ['PATH_INFO'], '/foo/some/url')
+
+        environ = {'SCRIPT_NAME': '', 'PATH_INFO': '/baz/some/url'}
+        self.assertEqual(table.route('localhost', environ), (None, None))
+        self.assertEqual(environ['PATH_INFO'], '/baz/some/url')
+
+class TestInstancesAutosize(unittest.TestCase):
+
+    def make_one(self, **settings):
+        import pkg_resources
+        from karlserve.instance import Instances as cut
+        settings.update({'instances_config':
+                         pkg_resources.resource_filename(
+                             'karlserve.tests', 'instances.ini'),
+                         'var_instance': 'var/instance'})
+        return cut(settings)
+
+    def test_not_enabled(self):
+        instances = self.make_one(**{'karlserve.server_threads': '20'})
+        self.failIf('zodb.pool_size' in instances.get('foo').config)
+        self.failIf('zodb.cache_size_bytes' in instances.get('foo').config)
+
+    def test_pool_size(self):
+        instances = self.make_one(**{'zodb.autosize': 'true',
+                                     'karlserve.server_threads': '20'})
+        config = instances.get('foo').config
+        self.assertEqual(config['zodb.pool_size'], '20')
+        self.failIf('zodb.cache_size_bytes' in config)
+        # bar has max_concurrency = 4
+        self.assertEqual(instances.get('bar').config['zodb.pool_size'], '4')
+
+    def test_memory_budget(self):
+        instances = self.make_one(**{'zodb.autosize': 'true',
+                                     'zodb.memory_budget': '800mb',
+                                     'karlserve.server_threads': '4'})
+        config = instances.get('foo').config
+        # Two instances with four connections each
+        self.assertEqual(config['zodb.cache_size_bytes'], str(100 << 20))
+        self.assertEqual(config['zodb.cache_size'], '1000000')
+
+    def test_memory_budget_max_live(self):
+        instances = self.make_one(**{'zodb.autosize': 'true',
+                                     'zodb.memory_budget': '800mb',
+                                     'instances.max_live': '1',
+                                     'karlserve.server_threads': '4'})
+        config = instances.get('foo').config
+        self.assertEqual(config['zodb.cache_size_bytes'], str(200 << 20))
+
+    def test_explicit_settings_win(self):
+        instances = self.make_one(**{'zodb.autosize': 'true',
+                                     'zodb.memory_budget': '800mb',
+                                     'zodb.cache_size': '5000',
+                                     'karlserve.server_threads': '4'})
+        config = instances.get('foo').config
+        self.assertEqual(config['zodb.cache_size'], '5000')
+
+    def test_cache_stats_not_spun_up(self):
+        instances = self.make_one()
+        self.assertEqual(instances.cache_stats(), {})
+
+
+class TestInstancesEviction(unittest.TestCase):
+
+    def setUp(self):
+        from repoze.depinj import clear
+        clear()
+
+        from repoze.depinj import inject
+        from karlserve.instance import make_karl_instance
+        from karlserve.instance import make_karl_pipeline
+        # Each injected fixture is used up by a single lookup.
+        for i in range(10):
+            inject(DummyApp, make_karl_instance)
+            inject(lambda app: app, make_karl_pipeline)
+
+        import tempfile
+        self.tmp = tempfile.mkdtemp('.karlserve_tests')
+
+    def tearDown(self):
+        from repoze.depinj import clear
+        clear()
+
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def make_one(self, **settings):
+        import os
+        import pkg_resources
+        from karlserve.instance import Instances as cut
+        settings.update({
+            'instances_config': pkg_resources.resource_filename(
+                'karlserve.tests', 'instances.ini'),
+            'blob_cache': os.path.join(self.tmp, 'blob_cache'),
+            'var_instance': os.path.join(self.tmp, 'instance'),
+            'var_tmp': os.path.join(self.tmp, 'tmp'),
+        })
+        return cut(settings)
+
+    def use(self, instances, name):
+        instance = instances.acquire(instances.get(name))
+        try:
+            return instance.pipeline()
+        finally:
+            instances.release(instance)
+
+    def test_no_policy(self):
+        instances = self.make_one()
+        foo = self.use(instances, 'foo')
+        bar = self.use(instances, 'bar')
+        self.failIf(foo.closed)
+        self.failIf(bar.closed)
+        self.assertEqual(instances.stats(),
+                         {'live': 2, 'spin_ups': 2, 'evictions': 0})
+
+    def test_max_live(self):
+        instances = self.make_one(**{'instances.max_live': '1'})
+        foo = self.use(instances, 'foo')
+        bar = self.use(instances, 'bar')
+        self.failUnless(foo.closed)
+        self.failIf(bar.closed)
+        foo2 = self.use(instances, 'foo')
+        self.failIf(foo2 is foo)
+        self.failUnless(bar.closed)
+        self.assertEqual(instances.stats(),
+                         {'live': 1, 'spin_ups': 3, 'evictions': 2})
+
+    def test_max_live_in_flight_not_evicted(self):
+        instances = self.make_one(**{'instances.max_live': '1'})
+        foo = instances.get('foo')
+        instances.acquire(foo)
+        app = foo.pipeline()
+        self.use(instances, 'bar')
+        self.failIf(app.closed)
+        instances.release(foo)
+
+    def test_idle_ttl(self):
+        instances = self.make_one(**{'instances.idle_ttl': '30'})
+        foo = self.use(instances, 'foo')
+        instances.get('foo').last_used -= 60
+        instances._last_sweep -= 60
+        self.use(instances, 'bar')
+        self.failUnless(foo.closed)
+        self.assertEqual(instances.stats()['evictions'], 1)
+
+    def test_preload(self):
+        instances = self.make_one()
+        instances.preload(threads=2)
+        self.assertEqual(instances.stats(),
+                         {'live': 2, 'spin_ups': 2, 'evictions': 0})
+
+    def test_preload_some(self):
+        instances = self.make_one()
+        instances.preload(['bar', 'baz'])
+        self.assertEqual(instances.get('foo')._instance, None)
+        self.failIf(instances.get('bar')._instance is None)
+
+
+class TestInstancesReload(unittest.TestCase):
+
+    def setUp(self):
+        from repoze.depinj import clear
+        clear()
+
+        from repoze.depinj import inject
+        from karlserve.instance import make_karl_instance
+        from karlserve.instance import make_karl_pipeline
+        # Each injected fixture is used up by a single lookup.
+        for i in range(10):
+            inject(DummyApp, make_karl_instance)
+            inject(lambda app: app, make_karl_pipeline)
+
+        import os
+        import tempfile
+        self.tmp = tempfile.mkdtemp('.karlserve_tests')
+        self.ini = os.path.join(self.tmp, 'instances.ini')
+
+    def tearDown(self):
+        from repoze.depinj import clear
+        clear()
+
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def write_config(self, config):
+        with open(self.ini, 'w') as f:
+            f.write(config)
+
+    def make_one(self, **settings):
+        import os
+        from karlserve.instance import Instances as cut
+        settings.update({
+            'instances_config': self.ini,
+            'blob_cache': os.path.join(self.tmp, 'blob_cache'),
+            'var_instance': os.path.join(self.tmp, 'instance'),
+            'var_tmp': os.path.join(self.tmp, 'tmp'),
+        })
+        return cut(settings)
+
+    def test_reload(self):
+        self.write_config(reload_ini_1)
+        instances = self.make_one()
+        foo, bar, baz = [instances.get(name) for name in ('foo', 'bar', 'baz')]
+        foo_app = foo.pipeline()
+        bar_app = bar.pipeline()
+        baz_app = baz.pipeline()
+
+        self.write_config(reload_ini_2)
+        instances.reload()
+        self.failUnless(instances.get('foo') is foo)
+        self.failIf(foo_app.closed)
+        self.failIf(instances.get('bar') is bar)
+        self.failUnless(bar_app.closed)
+        self.failIf(instances.get('bar')._instance is None)
+        self.assertEqual(instances.get('baz'), None)
+        self.failUnless(baz_app.closed)
+        self.failIf(instances.get('qux') is None)
+        self.assertEqual(instances.get_virtual_host('example.com:80'), 'qux')
+        self.assertEqual(instances.root_instance, 'foo')
+
+        environ = {'PATH_INFO': '/'}
+        name, instance = instances.dispatch_table.route(
+            'example.com:80', environ)
+        self.assertEqual(name, 'qux')
+
+    def test_reload_in_flight(self):
+        self.write_config(reload_ini_1)
+        instances = self.make_one()
+        bar = instances.get('bar')
+        instances.acquire(bar)
+        bar_app = bar.pipeline()
+        self.write_config(reload_ini_2)
+        instances.reload()
+        self.failIf(bar_app.closed)
+        instances.release(bar)
+        self.failUnless(bar_app.closed)
+
+    def test_acquire_after_reload(self):
+        self.write_config(reload_ini_1)
+        instances = self.make_one()
+        foo, bar, baz = [instances.get(name) for name in ('foo', 'bar', 'baz')]
+        self.write_config(reload_ini_2)
+        instances.reload()
+        self.failUnless(instances.acquire(foo) is foo)
+        instances.release(foo)
+        new_bar = instances.acquire(bar)
+        self.failUnless(new_bar is instances.get('bar'))
+        self.failIf(new_bar is bar)
+        self.assertEqual(bar.in_flight, 0)
+        self.assertEqual(new_bar.in_flight, 1)
+        instances.release(new_bar)
+        self.assertEqual(instances.acquire(baz), None)
+        self.assertEqual(baz.in_flight, 0)
+
+    def test_check_config_disabled(self):
+        self.write_config(reload_ini_1)
+        instances = self.make_one()
+        instances._last_config_check -= 60
+        self.write_config(reload_ini_2)
+        instances.check_config()
+        self.failIf(instances.get('baz') is None)
+
+    def test_check_config(self):
+        import os
+        self.write_config(reload_ini_1)
+        instances = self.make_one(**{
+            'instances_config.reload_interval': '5'})
+        instances.check_config()
+        self.failIf(instances.get('baz') is None)
+        self.write_config(reload_ini_2)
+        st = os.stat(self.ini)
+        os.utime(self.ini, (st.st_atime, st.st_mtime + 10))
+        instances._last_config_check -= 60
+        instances.check_config()
+        for i in xrange(100):
+            if instances.get('baz') is None:
+                break
+            import time
+            time.sleep(0.01)
+        self.assertEqual(instances.get('baz'), None)
+
+
+class TestAdmissionGate(unittest.TestCase):
+
+    def make_one(self, *args, **kw):
+        from karlserve.instance import AdmissionGate as cut
+        return cut(*args, **kw)
+
+    def test_under_limit(self):
+        gate = self.make_one(2)
+        self.failUnless(gate.enter())
+        self.failUnless(gate.enter())
+        self.assertEqual(gate.active, 2)
+        gate.leave()
+        gate.leave()
+        self.assertEqual(gate.active, 0)
+
+    def test_queue_full(self):
+        gate = self.make_one(1, 0)
+        self.failUnless(gate.enter())
+        self.failIf(gate.enter())
+        self.assertEqual(gate.rejected, 1)
+
+    def test_queue_timeout(self):
+        gate = self.make_one(1, 1, timeout=0.01)
+        self.failUnless(gate.enter())
+        self.failIf(gate.enter())
+        self.assertEqual(gate.rejected, 1)
+        self.assertEqual(gate.waiting, 0)
+
+    def test_wait_for_slot(self):
+        import threading
+        gate = self.make_one(1, 1, timeout=10)
+        self.failUnless(gate.enter())
+        admitted = []
+        def wait():
+            admitted.append(gate.enter())
+        thread = threading.Thread(target=wait)
+        thread.start()
+        gate.leave()
+        thread.join()
+        self.assertEqual(admitted, [True])
+        self.assertEqual(gate.active, 1)
+
+    def test_configured_from_options(self):
+        import pkg_resources
+        from karlserve.instance import Instances
+        instances = Instances({
+            'instances_config': pkg_resources.resource_filename(
+                'karlserve.tests', 'instances.ini'),
+            'var_instance': 'var/instance'})
+        gate = instances.get('bar').gate
+        self.assertEqual(gate.max_concurrency, 4)
+        self.assertEqual(gate.max_queue, 2)
+        self.assertEqual(instances.get('foo').gate, None)
+        self.assertEqual(instances.admission_stats()['bar'],
+                         {'in_flight': 0, 'queued': 0, 'rejected': 0})
+
+
+class TestSharding(unittest.TestCase):
+
+    def make_one(self, *args, **kw):
+        from karlserve.instance import Sharding as cut
+        return cut(*args, **kw)
+
+    def test_owners(self):
+        sharding = self.make_one(8, 2)
+        owners = sharding.owners('foo')
+        self.assertEqual(len(owners), 2)
+        self.assertEqual(owners, sorted(owners))
+        self.assertEqual(owners, self.make_one(8, 2).owners('foo'))
+        for worker in owners:
+            self.failUnless(0 <= worker < 8)
+
+    def test_owners_stable_when_worker_added(self):
+        names = ['inst%d' % i for i in xrange(200)]
+        before = self.make_one(8)
+        after = self.make_one(9)
+        moved = [name for name in names
+                 if before.owners(name) != after.owners(name)]
+        for name in moved:
+            self.assertEqual(after.owners(name), [8])
+        self.failUnless(len(moved) < 50)
+
+    def test_replicas_capped(self):
+        sharding = self.make_one(2, 5)
+        self.assertEqual(sharding.owners('foo'), [0, 1])
+
+    def test_is_local(self):
+        sharding = self.make_one(4, worker_id='0')
+        owner = sharding.owners('foo')[0]
+        sharding._worker_id = str(owner)
+        self.failUnless(sharding.is_local('foo'))
+        sharding._worker_id = str((owner + 1) % 4)
+        self.failIf(sharding.is_local('foo'))
+
+    def test_is_local_no_worker_id(self):
+        import os
+        sharding = self.make_one(4)
+        saved = os.environ.pop('KARLSERVE_WORKER_ID', None)
+        try:
+            self.failUnless(sharding.is_local('foo'))
+            owner = sharding.owners('foo')[0]
+            os.environ['KARLSERVE_WORKER_ID'] = str((owner + 1) % 4)
+            self.failIf(sharding.is_local('foo'))
+        finally:
+            os.environ.pop('KARLSERVE_WORKER_ID', None)
+            if saved is not None:
+                os.environ['KARLSERVE_WORKER_ID'] = saved
+
+    def test_configured_from_settings(self):
+        import pkg_resources
+        from karlserve.instance import Instances
+        instances = Instances({
+            'instances_config': pkg_resources.resource_filename(
+                'karlserve.tests', 'instances.ini'),
+            'var_instance': 'var/instance',
+            'sharding.workers': '4',
+            'sharding.replicas': '2',
+            'sharding.worker_id': '1'})
+        sharding = instances.sharding
+        self.assertEqual(sharding.workers, 4)
+        self.assertEqual(sharding.replicas, 2)
+        self.assertEqual(sharding.worker_id, 1)
+        routing = sharding.routing_map(instances)
+        self.assertEqual(sorted(routing), ['bar', 'foo'])
+        self.assertEqual(routing['bar']['hosts'], ['example.com:80'])
+        self.assertEqual(routing['bar']['workers'], sharding.owners('bar'))
+        self.failIf('addresses' in routing['bar'])
+
+        routing = sharding.routing_map(instances, ('10.0.0.1', 8000))
+        self.assertEqual(routing['bar']['addresses'], [
+            '10.0.0.1:%d' % (8000 + worker)
+            for worker in sharding.owners('bar')])
+
+    def test_worker_address(self):
+        sharding = self.make_one(4)
+        self.assertEqual(sharding.worker_address('localhost', 8080, 3),
+                         ('localhost', 8083))
+
+    def test_not_configured(self):
+        import pkg_resources
+        from karlserve.instance import Instances
+        instances = Instances({
+            'instances_config': pkg_resources.resource_filename(
+                'karlserve.tests', 'instances.ini'),
+            'var_instance': 'var/instance'})
+        self.assertEqual(instances.sharding, None)
+
+
 class TestLazyInstance(unittest.TestCase):
 
     def setUp(self):
@@ -74,9 +519,11 @@ class TestLazyInstance(unittest.TestCase):
         from karlserve.instance import make_karl_instance
         from karlserve.instance import make_karl_pipeline
         from karlserve.instance import maintenance
-        inject(DummyApp, make_karl_instance)
-        inject(dummy_mkp, make_karl_pipeline)
-        inject(dummy_maintenance, maintenance)
+        # Each injected fixture is used up by a single lookup.
+        for i in range(10):
+            inject(DummyApp, make_karl_instance)
+            inject(dummy_mkp, make_karl_pipeline)
+            inject(dummy_maintenance, maintenance)
 
         import os
         import tempfile
@@ -106,12 +553,15 @@ class TestLazyInstance(unittest.TestCase):
         name, config, uri = app
         self.assertEqual(name, 'instance')
         self.assertEqual(config['blob_cache'], 'var/blob_cache/instance')
-        self.assertTrue(uri.startswith('zconfig:///'), uri)
-        zconfig = open(uri[10:]).read()
-        self.assertTrue('ha ha ha ha' in zconfig, zconfig)
-        self.assertTrue('cache-size 10000' in zconfig, zconfig)
-        self.assertTrue('pool-size 3' in zconfig, zconfig)
-        self.assertTrue('var/blob_cache/instance' in zconfig, zconfig)
+        self.assertTrue(uri.startswith('karlserve://instance/'), uri)
+        storage_factory, dbkw = get_database(uri)
+        self.assertEqual(storage_factory.dsn, 'ha ha ha ha')
+        self.assertEqual(storage_factory.blob_dir, 'var/blob_cache/instance')
+        self.assertEqual(storage_factory.read_only, False)
+        self.assertEqual(storage_factory.keep_history, False)
+        self.assertEqual(storage_factory.cache_servers, None)
+        self.assertEqual(dbkw['cache_size'], 10000)
+        self.assertEqual(dbkw['pool_size'], 3)
 
     def test_pipeline_relstorage_w_cache_size(self):
         instance = self.make_one(**{
@@ -121,11 +571,19 @@ class TestLazyInstance(unittest.TestCase):
         name, config, uri = app
         self.assertEqual(name, 'instance')
         self.assertEqual(config['blob_cache'], 'var/blob_cache/instance')
-        self.assertTrue(uri.startswith('zconfig:///'), uri)
-        zconfig = open(uri[10:]).read()
-        self.assertTrue('ha ha ha ha' in zconfig, zconfig)
-        self.assertTrue('cache-size 50000' in zconfig, zconfig)
-        self.assertTrue('var/blob_cache/instance' in zconfig, zconfig)
+        self.assertTrue(uri.startswith('karlserve://instance/'), uri)
+        storage_factory, dbkw = get_database(uri)
+        self.assertEqual(storage_factory.dsn, 'ha ha ha ha')
+        self.assertEqual(storage_factory.blob_dir, 'var/blob_cache/instance')
+        self.assertEqual(dbkw['cache_size'], 50000)
+
+    def test_pipeline_relstorage_w_cache_size_bytes(self):
+        instance = self.make_one(**{
+            'dsn': 'ha ha ha ha',
+            'zodb.cache_size_bytes': '64mb'})
+        name, config, uri = instance.pipeline()
+        storage_factory, dbkw = get_database(uri)
+        self.assertEqual(dbkw['cache_size_bytes'], 64 << 20)
 
     def test_pipeline_relstorage_w_pool_size(self):
         instance = self.make_one(**{
@@ -135,11 +593,25 @@ class TestLazyInstance(unittest.TestCase):
         name, config, uri = app
         self.assertEqual(name, 'instance')
         self.assertEqual(config['blob_cache'], 'var/blob_cache/instance')
-        self.assertTrue(uri.startswith('zconfig:///'), uri)
-        zconfig = open(uri[10:]).read()
-        self.assertTrue('ha ha ha ha' in zconfig, zconfig)
-        self.assertTrue('pool-size 8' in zconfig, zconfig)
-        self.assertTrue('var/blob_cache/instance' in zconfig, zconfig)
+        self.assertTrue(uri.startswith('karlserve://instance/'), uri)
+        storage_factory, dbkw = get_database(uri)
+        self.assertEqual(storage_factory.dsn, 'ha ha ha ha')
+        self.assertEqual(storage_factory.blob_dir, 'var/blob_cache/instance')
+        self.assertEqual(dbkw['pool_size'], 8)
+
+    def test_pipeline_relstorage_blob_cache_size(self):
+        instance = self.make_one(dsn='ha ha ha ha')
+        name, config, uri = instance.pipeline()
+        self.assertEqual(get_database(uri)[0].blob_cache_size, 8 << 30)
+
+        instance = self.make_one(dsn='ha ha ha ha', blob_cache_budget='100gb')
+        name, config, uri = instance.pipeline()
+        self.assertEqual(get_database(uri)[0].blob_cache_size, 100 << 30)
+
+        instance = self.make_one(dsn='ha ha ha ha', blob_cache_budget='100gb',
+                                 blob_cache_size='2gb')
+        name, config, uri = instance.pipeline()
+        self.assertEqual(get_database(uri)[0].blob_cache_size, 2 << 30)
 
     def test_pipeline_relstorage_w_memcached(self):
         instance = self.make_one(**{
@@ -150,11 +622,12 @@ class TestLazyInstance(unittest.TestCase):
         name, config, uri = app
         self.assertEqual(name, 'instance')
         self.assertEqual(config['blob_cache'], 'var/blob_cache/instance')
-        self.assertTrue(uri.startswith('zconfig:///'), uri)
-        zconfig = open(uri[10:]).read()
-        self.assertTrue('ha ha ha ha' in zconfig, zconfig)
-        self.assertTrue('cache-prefix instance' in zconfig, zconfig)
-        self.assertTrue('var/blob_cache/instance' in zconfig, zconfig)
+        self.assertTrue(uri.startswith('karlserve://instance/'), uri)
+        storage_factory, dbkw = get_database(uri)
+        self.assertEqual(storage_factory.dsn, 'ha ha ha ha')
+        self.assertEqual(storage_factory.blob_dir, 'var/blob_cache/instance')
+        self.assertEqual(storage_factory.cache_servers, 'somehost:port')
+        self.assertEqual(storage_factory.cache_prefix, 'instance')
 
     def test_pipeline_relstorage_w_memcached_and_prefix(self):
         instance = self.make_one(**{
@@ -166,11 +639,11 @@ class TestLazyInstance(unittest.TestCase):
         name, config, uri = app
         self.assertEqual(name, 'instance')
         self.assertEqual(config['blob_cache'], 'var/blob_cache/instance')
-        self.assertTrue(uri.startswith('zconfig:///'), uri)
-        zconfig = open(uri[10:]).read()
-        self.assertTrue('ha ha ha ha' in zconfig, zconfig)
-        self.assertTrue('cache-prefix testfoo' in zconfig, zconfig)
-        self.assertTrue('var/blob_cache/instance' in zconfig, zconfig)
+        self.assertTrue(uri.startswith('karlserve://instance/'), uri)
+        storage_factory, dbkw = get_database(uri)
+        self.assertEqual(storage_factory.dsn, 'ha ha ha ha')
+        self.assertEqual(storage_factory.blob_dir, 'var/blob_cache/instance')
+        self.assertEqual(storage_factory.cache_prefix, 'testfoo')
 
     def test_pipeline_relstorage_w_postoffice(self):
         instance = self.make_one(**{'dsn': 'ha ha ha ha',
@@ -180,12 +653,26 @@ class TestLazyInstance(unittest.TestCase):
         name, config, uri = app
         self.assertTrue('zodbconn.uri.postoffice' in config, config)
         uri = config['zodbconn.uri.postoffice']
-        self.assertTrue(uri.startswith('zconfig:///'), uri)
-        zconfig = open(uri[10:]).read()
-        self.assertTrue('ooh ooh ooh' in zconfig, zconfig)
-        self.assertTrue('var/po_blobs' in zconfig, zconfig)
+        self.assertTrue(uri.startswith('karlserve://instance/'), uri)
+        storage_factory, dbkw = get_database(uri)
+        self.assertEqual(storage_factory.dsn, 'ooh ooh ooh')
+        self.assertEqual(storage_factory.blob_dir, 'var/po_blobs')
         self.assertEqual(config['postoffice.queue'], 'instance')
 
+    def test_pipeline_relstorage_w_replica(self):
+        instance = self.make_one(**{'dsn': 'ha ha ha ha',
+                                    'replica_dsn': 'hee hee hee'})
+        name, config, uri = instance.pipeline()
+        storage_factory, dbkw = get_database(uri)
+        self.assertEqual(storage_factory.dsn, 'ha ha ha ha')
+        self.assertEqual(storage_factory.read_only, False)
+        replica_uri = config['karlserve.replica_uri']
+        storage_factory, dbkw = get_database(replica_uri)
+        self.assertEqual(storage_factory.dsn, 'hee hee hee')
+        self.assertEqual(storage_factory.read_only, True)
+        instance.close()
+        self.failIf('karlserve.replica_uri' in instance.config)
+
     def test_pipeline_relstorage_w_postoffice_missing_blob_cache(self):
         instance = self.make_one(**{'dsn': 'ha ha ha ha',
                                     'postoffice.dsn': 'ooh ooh ooh'})
@@ -199,11 +686,84 @@ class TestLazyInstance(unittest.TestCase):
         instance.mode = 'NORMAL'
         self.assertEqual(instance.mode, 'NORMAL')
 
+    def test_last_index_tid(self):
+        instance = self.make_one()
+        other = self.make_one()
+        self.assertEqual(instance.last_index_tid, None)
+        instance.last_index_tid = 291726698850381516
+        self.assertEqual(instance.last_index_tid, 291726698850381516)
+        self.expire_properties(other)
+        self.assertEqual(other.last_index_tid, 291726698850381516)
+
     def test_maintenance_mode(self):
         instance = self.make_one()
         instance.mode = 'MAINTENANCE'
         self.assertEqual(instance.pipeline(), 'maintenance app')
 
+    def expire_properties(self, instance):
+        cache = instance._property_cache
+        for name, (value, stamp, checked) in cache.items():
+            cache[name] = (value, stamp, checked - 60)
+
+    def test_mode_changed_by_other_process(self):
+        instance = self.make_one()
+        other = self.make_one()
+        self.assertEqual(instance.mode, 'NORMAL')
+        other.mode = 'MAINTENANCE'
+        self.assertEqual(instance.mode, 'NORMAL')  # cached
+        self.expire_properties(instance)
+        self.assertEqual(instance.mode, 'MAINTENANCE')
+        other.mode = 'NORMAL'
+        self.expire_properties(instance)
+        self.assertEqual(instance.mode, 'NORMAL')
+
+    def test_mode_change_rebuilds_pipeline(self):
+        instance = self.make_one(dsn='ha ha ha')
+        other = self.make_one(dsn='ha ha ha')
+        name, config, uri = instance.pipeline()
+        other.mode = 'MAINTENANCE'
+        self.expire_properties(instance)
+        self.assertEqual(instance.pipeline(), 'maintenance app')
+        other.mode = 'NORMAL'
+        self.expire_properties(instance)
+        name, config, uri2 = instance.pipeline()
+        self.assertEqual(uri, uri2)
+        self.assertEqual(instance.spin_ups, 1)
+
+    def test_readonly_mode_change_reopens_instance(self):
+        instance = self.make_one(dsn='ha ha ha')
+        app = instance.instance()
+        instance.pipeline()
+        instance.mode = 'READONLY'
+        name, config, uri = instance.pipeline()
+        self.failUnless(app.closed)
+        self.assertEqual(config['read_only'], True)
+        self.assertEqual(get_database(uri)[0].read_only, True)
+
+    def test_readonly_mode_change_closes_unlocked(self):
+        instance = self.make_one(dsn='ha ha ha')
+        app = instance.instance()
+        instance.pipeline()
+        locked = []
+        app.close = lambda: locked.append(instance._lock.locked())
+        instance.mode = 'READONLY'
+        instance.checkout()
+        self.assertEqual(locked, [False])
+
+    def test_readonly_mode_change_in_flight(self):
+        instance = self.make_one(dsn='ha ha ha')
+        app = instance.instance()
+        pipeline, generation = instance.checkout()
+        instance.mode = 'READONLY'
+        new_pipeline, new_generation = instance.checkout()
+        self.failIf(new_pipeline is pipeline)
+        self.failIf(app.closed)
+        instance.checkin(generation)
+        self.failUnless(app.closed)
+        self.failIf(instance._instance.closed)
+        instance.checkin(new_generation)
+        self.failIf(instance._instance.closed)
+
     def test_close(self):
         instance = self.make_one(dsn='ha ha ha')
         app = instance.instance()
@@ -211,6 +771,203 @@ class TestLazyInstance(unittest.TestCase):
         instance.close()
         self.failUnless(app.closed)
 
+    def test_close_checked_out(self):
+        instance = self.make_one(dsn='ha ha ha')
+        app = instance.instance()
+        pipeline, generation = instance.checkout()
+        instance.close()
+        self.failIf(app.closed)
+        name, config, uri = instance.pipeline()
+        self.failIf(app.closed)
+        instance.checkin(generation)
+        self.failUnless(app.closed)
+        self.failIf(instance._instance.closed)
+
+    def test_spin_up_after_close(self):
+        instance = self.make_one(dsn='ha ha ha')
+        name, config, uri = instance.pipeline()
+        instance.close()
+        name, config, new_uri = instance.pipeline()
+        self.assertNotEqual(uri, new_uri)
+        self.assertEqual(get_database(new_uri)[0].dsn, 'ha ha ha')
+        self.assertEqual(instance.spin_ups, 2)
+        self.assertRaises(ValueError, get_database, uri)
+
+    def test_pipeline_relstorage_zconfig_debug(self):
+        import os
+        instance = self.make_one(dsn='ha ha ha ha', zconfig_debug='true')
+        name, config, uri = instance.pipeline()
+        self.assertTrue(uri.startswith('zconfig:///'), uri)
+        zconfig = open(uri[10:]).read()
+        self.assertTrue('ha ha ha ha' in zconfig, zconfig)
+        instance.close()
+        self.failIf(os.path.exists(uri[10:]))
+
+
+def get_database(uri):
+    from karlserve.storage import get_database
+    return get_database(uri)
+
+
+class Test_include_zodbconn(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp('.karlserve_tests')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def uri(self, name):
+        import os
+        return 'file://%s' % os.path.join(self.tmp, name + '.fs')
+
+    def call_fut(self, config, databases):
+        from karlserve.instance import _include_zodbconn as fut
+        return fut(config, databases)
+
+    def test_reuse_primary(self):
+        import transaction
+        from pyramid.config import Configurator
+        from karlserve.instance import _db_from_uri
+        from karlserve.instance import _close_databases
+        databases = {}
+        primary = _db_from_uri(self.uri('main'), '', databases)
+        config = Configurator(settings={
+            'zodbconn.uri': self.uri('main'),
+            'zodbconn.uri.other': self.uri('other')})
+        self.call_fut(config, databases)
+        dbs = config.registry._zodb_databases
+        try:
+            self.failUnless(dbs[''] is primary)
+            self.assertEqual(sorted(dbs), ['', 'other'])
+            self.failUnless(primary.databases is dbs)
+            self.failUnless(dbs['other'].databases is dbs)
+            conn = primary.open()
+            other = conn.get_connection('other')
+            self.failUnless(other.db() is dbs['other'])
+            transaction.abort()
+            conn.close()
+        finally:
+            _close_databases(dbs)
+
+
+class Test_replica_connection(unittest.TestCase):
+
+    def call_fut(self, request, db, min_tid=0):
+        from karlserve.instance import _replica_connection as fut
+        return fut(request, db, min_tid)
+
+    def test_up_to_date(self):
+        request = DummyRequest()
+        db = DummyDB(5)
+        connection = self.call_fut(request, db, 5)
+        self.failUnless(connection.db() is db)
+        self.failUnless(request._primary_zodb_conn is connection)
+        request.finish()
+        self.failUnless(connection.closed)
+
+    def test_lagging(self):
+        request = DummyRequest()
+        db = DummyDB(4)
+        self.assertEqual(self.call_fut(request, db, 5), None)
+        self.failIf(hasattr(request, '_primary_zodb_conn'))
+        self.failUnless(db.connections[0].closed)
+
+    def test_unavailable(self):
+        request = DummyRequest()
+        db = DummyDB(4)
+        db.broken = True
+        self.assertEqual(self.call_fut(request, db), None)
+
+    def test_retry(self):
+        request = DummyRequest()
+        db = DummyDB(5)
+        connection = self.call_fut(request, db)
+        self.failUnless(self.call_fut(request, db) is connection)
+        request._primary_zodb_conn = DummyConnection(DummyDB(5))
+        self.assertEqual(self.call_fut(request, db), None)
+
+
+class Test_Replica(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmp = tempfile.mkdtemp('.karlserve_tests')
+        self.path = os.path.join(self.tmp, 'replica')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def make_one(self, **kw):
+        from karlserve.instance import _Replica as cut
+        uri = 'file://%s/Data.fs' % self.path
+        return cut({'karlserve.replica_uri': uri}, **kw)
+
+    def test_opened_lazily(self):
+        import os
+        os.mkdir(self.path)
+        replica = self.make_one()
+        self.assertEqual(replica.db, None)
+        db = replica.get()
+        self.failIf(db is None)
+        self.failUnless(replica.get() is db)
+        replica.close()
+        self.assertEqual(replica.db, None)
+
+    def test_unavailable(self):
+        import os
+        replica = self.make_one(retry_interval=60)
+        self.assertEqual(replica.get(), None)
+        os.mkdir(self.path)
+        self.assertEqual(replica.get(), None)
+        replica._retry_at -= 60
+        self.failIf(replica.get() is None)
+        replica.close()
+
+
+class Test_use_replica(unittest.TestCase):
+
+    def call_fut(self, request, read_only=False, primary_paths=()):
+        from karlserve.instance import _use_replica as fut
+        return fut(request, read_only, primary_paths)
+
+    def test_safe_method(self):
+        request = DummyRequest()
+        self.failUnless(self.call_fut(request))
+        request.method = 'OPTIONS'
+        self.failUnless(self.call_fut(request))
+
+    def test_unsafe_method(self):
+        request = DummyRequest()
+        request.method = 'POST'
+        self.failIf(self.call_fut(request))
+        self.failUnless(self.call_fut(request, read_only=True))
+
+    def test_primary_paths(self):
+        request = DummyRequest()
+        request.path_info = '/login.html'
+        self.failIf(self.call_fut(request, primary_paths=('/login',)))
+        self.failUnless(self.call_fut(request, primary_paths=('/logout',)))
+
+
+class Test_min_tid(unittest.TestCase):
+
+    def call_fut(self, request):
+        from karlserve.instance import _min_tid as fut
+        return fut(request, 'karlserve_tid')
+
+    def test_it(self):
+        request = DummyRequest()
+        self.assertEqual(self.call_fut(request), 0)
+        request.cookies['karlserve_tid'] = '00000000000000ff'
+        self.assertEqual(self.call_fut(request), 255)
+        request.cookies['karlserve_tid'] = 'garbage'
+        self.assertEqual(self.call_fut(request), 0)
+
 
 class Test_get_set_current_instance(unittest.TestCase):
 
@@ -227,6 +984,59 @@ class DummyInstances(object):
         self.settings = settings
 
 
+class DummyRequest(object):
+    method = 'GET'
+    path_info = '/'
+
+    def __init__(self):
+        self.cookies = {}
+        self.finished_callbacks = []
+
+    def add_finished_callback(self, callback):
+        self.finished_callbacks.append(callback)
+
+    def finish(self):
+        for callback in self.finished_callbacks:
+            callback(self)
+
+
+class DummyDB(object):
+    broken = False
+
+    def __init__(self, tid):
+        self.tid = tid
+        self.connections = []
+
+    def open(self):
+        if self.broken:
+            raise IOError('Connection refused')
+        connection = DummyConnection(self)
+        self.connections.append(connection)
+        return connection
+
+
+class DummyConnection(object):
+    closed = False
+
+    def __init__(self, db):
+        self._db = db
+        self._storage = self
+        self.transaction_manager = self
+
+    def db(self):
+        return self._db
+
+    def lastTransaction(self):
+        from ZODB.utils import p64
+        return p64(self._db.tid)
+
+    def abort(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
 class DummyApp(object):
     closed = False
 
@@ -236,3 +1046,29 @@ class DummyApp(object):
     def close(self):
         self.closed = True
 
+
+reload_ini_1 = """
+[instance:foo]
+dsn = foo
+root = true
+
+[instance:bar]
+dsn = bar
+
+[instance:baz]
+dsn = baz
+virtual_host = example.com:80
+"""
+
+reload_ini_2 = """
+[instance:foo]
+dsn = foo
+root = true
+
+[instance:bar]
+dsn = bar2
+
+[instance:qux]
+dsn = qux
+virtual_host = example.com:80
+"""
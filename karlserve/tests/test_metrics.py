@@ -0,0 +1,114 @@
+import unittest
+
+
+class TestHistogram(unittest.TestCase):
+
+    def make_one(self, bounds=(0, 1, 2, 4, 8)):
+        from karlserve.metrics import Histogram as cut
+        return cut(list(bounds))
+
+    def test_empty(self):
+        histogram = self.make_one()
+        self.assertEqual(histogram.percentile(50), 0)
+        self.assertEqual(histogram.summary()['mean'], 0)
+
+    def test_percentiles(self):
+        histogram = self.make_one()
+        for value in [0.5] * 50 + [1.5] * 45 + [3] * 4 + [6]:
+            histogram.add(value)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.percentile(50), 1)
+        self.assertEqual(histogram.percentile(95), 2)
+        self.assertEqual(histogram.percentile(99), 4)
+        self.assertEqual(histogram.percentile(100), 6)
+        self.assertEqual(histogram.max, 6)
+
+    def test_over_last_bound(self):
+        histogram = self.make_one()
+        histogram.add(100)
+        self.assertEqual(histogram.percentile(50), 100)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def make_one(self, **kw):
+        from karlserve.metrics import Metrics as cut
+        return cut(**kw)
+
+    def test_record_and_report(self):
+        metrics = self.make_one()
+        metrics.record('foo', 'Site:', DummyStats(0.1, 10, 2, 0.01))
+        metrics.record('foo', 'Site:', DummyStats(0.2, 20, 0, 0))
+        metrics.record('bar', 'Site:edit.html', DummyStats(0.3, 5, 1, 0.02))
+        report = metrics.report()
+        self.assertEqual(sorted(report.keys()), ['bar', 'foo'])
+        foo = report['foo']['Site:']
+        self.assertEqual(foo['count'], 2)
+        self.assertEqual(foo['loads']['max'], 20)
+        self.assertEqual(foo['commit']['count'], 1)
+        self.assertEqual(report['bar']['Site:edit.html']['stores']['max'], 1)
+
+    def test_storage_activity(self):
+        metrics = self.make_one()
+        metrics.record('foo', 'a', DummyStats(
+            0.1, 1, 0, 0, bytes_loaded=4096, blob_opens=2, blob_bytes=1 << 20,
+            round_trips=7, retries=1))
+        series = metrics.report()['foo']['a']
+        self.assertEqual(series['bytes_loaded']['max'], 4096)
+        self.assertEqual(series['blob_opens']['max'], 2)
+        self.assertEqual(series['blob_bytes']['max'], 1 << 20)
+        self.assertEqual(series['round_trips']['max'], 7)
+        self.assertEqual(series['retries']['max'], 1)
+
+    def test_max_series(self):
+        metrics = self.make_one(max_series=1)
+        metrics.record('foo', 'a', DummyStats(0.1, 1, 1, 0))
+        metrics.record('foo', 'b', DummyStats(0.1, 1, 1, 0))
+        metrics.record('foo', 'c', DummyStats(0.1, 1, 1, 0))
+        report = metrics.report()
+        self.assertEqual(sorted(report['foo'].keys()), ['a', 'other'])
+        self.assertEqual(report['foo']['other']['count'], 2)
+
+
+class Test_route_name(unittest.TestCase):
+
+    def call_fut(self, request):
+        from karlserve.metrics import route_name as fut
+        return fut(request)
+
+    def test_matched_route(self):
+        request = DummyRequest()
+        request.matched_route = DummyRoute('feeds')
+        self.assertEqual(self.call_fut(request), 'feeds')
+
+    def test_traversal(self):
+        request = DummyRequest()
+        request.matched_route = None
+        request.context = DummyRoute('foo')
+        request.view_name = 'edit.html'
+        self.assertEqual(self.call_fut(request), 'DummyRoute:edit.html')
+
+
+class DummyStats(object):
+    bytes_loaded = 0
+    blob_opens = 0
+    blob_bytes = 0
+    round_trips = 0
+    retries = 0
+
+    def __init__(self, elapsed, loads, stores, commit_time, **kw):
+        self.elapsed = elapsed
+        self.loads = loads
+        self.stores = stores
+        self.commit_time = commit_time
+        self.__dict__.update(kw)
+
+
+class DummyRequest(object):
+    pass
+
+
+class DummyRoute(object):
+
+    def __init__(self, name):
+        self.name = name
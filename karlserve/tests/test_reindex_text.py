@@ -0,0 +1,662 @@
+from __future__ import with_statement
+
+import unittest
+
+
+class Test_split_docids(unittest.TestCase):
+
+    def call_fut(self, docids, n):
+        from BTrees.IFBTree import IFTreeSet
+        from karlserve.scripts.reindex_text import split_docids as fut
+        return fut(IFTreeSet(docids), n)
+
+    def test_even(self):
+        self.assertEqual(self.call_fut(range(1, 9), 4),
+                         [(1, 2), (3, 4), (5, 6), (7, None)])
+
+    def test_uneven(self):
+        ranges = self.call_fut([2, 3, 5, 7, 11, 13, 17], 3)
+        self.assertEqual(ranges, [(2, 4), (5, 10), (11, None)])
+
+    def test_more_workers_than_docids(self):
+        self.assertEqual(self.call_fut([5, 6], 4), [(5, 5), (6, None)])
+
+    def test_one_worker(self):
+        self.assertEqual(self.call_fut([5, 6, 7], 1), [(5, None)])
+
+
+class Test_diff_docids(unittest.TestCase):
+
+    def call_fut(self, catalog_docids, index_docids):
+        from karlserve.scripts.reindex_text import diff_docids as fut
+        return list(fut(catalog_docids, index_docids))
+
+    def test_empty(self):
+        self.assertEqual(self.call_fut([], []), [])
+        self.assertEqual(self.call_fut([1, 2], []), [(1, True), (2, True)])
+        self.assertEqual(self.call_fut([], [1, 2]), [(1, False), (2, False)])
+
+    def test_same(self):
+        self.assertEqual(self.call_fut([1, 2, 3], [1, 2, 3]), [])
+
+    def test_interleaved(self):
+        self.assertEqual(self.call_fut([1, 3, 4, 6], [2, 3, 5, 6]),
+                         [(1, True), (2, False), (4, True), (5, False)])
+
+    def test_catalog_exhausted_first(self):
+        self.assertEqual(self.call_fut([1, 2], [2, 3, 4]),
+                         [(1, True), (3, False), (4, False)])
+
+    def test_index_exhausted_first(self):
+        self.assertEqual(self.call_fut([1, 3, 4], [1, 2]),
+                         [(2, False), (3, True), (4, True)])
+
+    def test_zero(self):
+        self.assertEqual(self.call_fut([0, 1], [1]), [(0, True)])
+
+    def test_duplicates(self):
+        self.assertEqual(self.call_fut([1, 1, 2, 3, 3], [1, 3]), [(2, True)])
+        self.assertEqual(self.call_fut([1, 3], [1, 1, 2, 2, 3]),
+                         [(2, False)])
+
+    def test_generators(self):
+        self.assertEqual(self.call_fut(iter([1, 2]), iter([2])), [(1, True)])
+
+
+class Test_remaining_docids(unittest.TestCase):
+
+    def call_fut(self, index, first, end=None):
+        from karlserve.scripts.reindex_text import remaining_docids as fut
+        return list(fut(index, first, end))
+
+    def test_no_marker(self):
+        index = DummyIndex(range(1, 11))
+        self.assertEqual(self.call_fut(index, 1), range(1, 11))
+        self.assertEqual(self.call_fut(index, 1, 5), range(1, 6))
+
+    def test_marker(self):
+        index = DummyIndex(range(1, 11))
+        index.progress[1] = 4
+        index.progress[6] = 8
+        self.assertEqual(self.call_fut(index, 1, 5), [5])
+        self.assertEqual(self.call_fut(index, 6), [9, 10])
+
+    def test_range_done(self):
+        index = DummyIndex(range(1, 11))
+        index.progress[1] = 5
+        self.assertEqual(self.call_fut(index, 1, 5), [])
+
+
+class Test_calculate_docids_to_index(unittest.TestCase):
+
+    def call_fut(self, catalog, new_index, index_docids):
+        import transaction
+        from karlserve.scripts import reindex_text
+        savepoints = []
+        def savepoint(optimistic=False):
+            savepoints.append(list(new_index.to_index))
+        saved = (reindex_text.CHUNK_SIZE, reindex_text.get_index_docids,
+                 transaction.savepoint)
+        reindex_text.CHUNK_SIZE = 3
+        reindex_text.get_index_docids = lambda index: iter(index_docids)
+        transaction.savepoint = savepoint
+        try:
+            reindex_text.calculate_docids_to_index(
+                catalog, catalog['texts'], new_index)
+        finally:
+            (reindex_text.CHUNK_SIZE, reindex_text.get_index_docids,
+             transaction.savepoint) = saved
+        return savepoints
+
+    def test_written_in_chunks(self):
+        catalog = DummyCatalog(range(1, 11))
+        new_index = DummyIndex()
+        new_index.indexed.insert(5)
+        new_index.docs[42] = 'gone'
+        savepoints = self.call_fut(catalog, new_index, [2, 3, 42])
+        self.assertEqual(savepoints, [[1, 4, 6], [1, 4, 6, 7, 8, 9]])
+        self.assertEqual(list(new_index.to_index), [1, 4, 6, 7, 8, 9, 10])
+        self.assertEqual(new_index.n_to_index, 7)
+        self.failIf(42 in new_index.docs)
+
+
+class Test_settle_progress(unittest.TestCase):
+
+    def call_fut(self, index):
+        from karlserve.scripts.reindex_text import settle_progress as fut
+        return fut(index)
+
+    def test_no_progress_recorded(self):
+        index = DummyIndex(range(1, 11))
+        del index.progress
+        self.call_fut(index)
+        self.assertEqual(len(index.progress), 0)
+        self.assertEqual(list(index.to_index), range(1, 11))
+
+    def test_nothing_to_settle(self):
+        index = DummyIndex(range(1, 11))
+        self.call_fut(index)
+        self.assertEqual(list(index.to_index), range(1, 11))
+        self.assertEqual(list(index.indexed), [])
+
+    def test_settle(self):
+        index = DummyIndex(range(1, 11))
+        index.progress[1] = 3
+        index.progress[6] = 7
+        self.call_fut(index)
+        self.assertEqual(list(index.indexed), [1, 2, 3, 6, 7])
+        self.assertEqual(list(index.to_index), [4, 5, 8, 9, 10])
+        self.assertEqual(len(index.progress), 0)
+
+    def test_settle_in_chunks(self):
+        from karlserve.scripts import reindex_text
+        index = DummyIndex(range(1, 11))
+        index.progress[1] = 8
+        saved = reindex_text.CHUNK_SIZE
+        reindex_text.CHUNK_SIZE = 3
+        try:
+            self.call_fut(index)
+        finally:
+            reindex_text.CHUNK_SIZE = saved
+        self.assertEqual(list(index.indexed), range(1, 9))
+        self.assertEqual(list(index.to_index), [9, 10])
+
+
+class Test_reindex_range(unittest.TestCase):
+
+    def call_fut(self, args, site, start=None, end=None):
+        from karlserve.scripts.reindex_text import reindex_range as fut
+        return fut(args, site, start, end)
+
+    def test_batches(self):
+        site = DummySite(range(1, 11))
+        index = site.catalog['new_texts']
+        markers = []
+        index.committed = lambda: markers.append(dict(index.progress))
+        self.call_fut(DummyArgs(batch_size=4, max_batch_size=4),
+                      site, 1, None)
+        self.assertEqual(sorted(index.docs), range(1, 11))
+        self.assertEqual(dict(index.progress), {1: 10})
+        # The docids stay in to_index until the progress is settled.
+        self.assertEqual(list(index.to_index), range(1, 11))
+
+    def test_resume(self):
+        site = DummySite(range(1, 11))
+        index = site.catalog['new_texts']
+        index.progress[1] = 4
+        self.call_fut(DummyArgs(), site, 1, None)
+        self.assertEqual(sorted(index.docs), range(5, 11))
+        self.assertEqual(dict(index.progress), {1: 10})
+
+    def test_range(self):
+        site = DummySite(range(1, 11))
+        index = site.catalog['new_texts']
+        self.call_fut(DummyArgs(), site, 3, 6)
+        self.assertEqual(sorted(index.docs), [3, 4, 5, 6])
+        self.assertEqual(dict(index.progress), {3: 6})
+
+    def test_empty_range(self):
+        site = DummySite(range(1, 11))
+        index = site.catalog['new_texts']
+        self.call_fut(DummyArgs(), site, 20, None)
+        self.assertEqual(index.docs, {})
+        self.assertEqual(len(index.progress), 0)
+
+    def test_missing_document(self):
+        site = DummySite(range(1, 11))
+        del site['doc3']
+        index = site.catalog['new_texts']
+        self.call_fut(DummyArgs(), site)
+        self.assertEqual(sorted(index.docs), [1, 2, 4, 5, 6, 7, 8, 9, 10])
+        self.assertEqual(dict(index.progress), {1: 10})
+
+    def test_conflict_retried(self):
+        from ZODB.POSException import ConflictError
+        site = DummySite(range(1, 11))
+        index = site.catalog['new_texts']
+        index_doc = index.index_doc
+        conflicts = [ConflictError()]
+
+        def conflicting(docid, doc):
+            if docid == 5 and conflicts:
+                raise conflicts.pop()
+            index_doc(docid, doc)
+        index.index_doc = conflicting
+        self.call_fut(DummyArgs(batch_size=4), site)
+        self.assertEqual(sorted(index.docs), range(1, 11))
+        self.assertEqual(dict(index.progress), {1: 10})
+
+
+class Test_find_docid(unittest.TestCase):
+
+    def call_fut(self, obj):
+        from karlserve.scripts.reindex_text import _find_docid as fut
+        return fut(obj)
+
+    def test_document(self):
+        site = DummySite([1, 2])
+        self.assertEqual(self.call_fut(site['doc2']), 2)
+
+    def test_nearest_document(self):
+        site = DummySite([1])
+        doc = site['doc1']
+        doc['nested'] = DummyResource('nested', doc, 5)
+        attachment = DummyResource('attachment', doc['nested'])
+        self.assertEqual(self.call_fut(attachment), 5)
+
+    def test_not_a_docid(self):
+        site = DummySite([1])
+        doc = site['doc1']
+        attachment = DummyResource('attachment', doc)
+        attachment.docid = 'not a docid'
+        self.assertEqual(self.call_fut(attachment), 1)
+
+    def test_no_document(self):
+        site = DummySite([1])
+        self.assertEqual(self.call_fut(site), None)
+        self.assertEqual(self.call_fut(None), None)
+
+
+class TestIncremental(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.FileStorage import FileStorage
+        from ZODB.utils import u64
+        self.tmp = tempfile.mkdtemp('.karlserve_tests')
+        self.db = DB(FileStorage(os.path.join(self.tmp, 'Data.fs')))
+        self.conn = self.db.open()
+        site = self.conn.root()['site'] = DummyStoredSite()
+        for docid in (1, 2, 3):
+            site.add(DummyStoredDocument(docid, 'Doc %d' % docid))
+        site['doc3'].attachment = DummyStoredAttachment(site['doc3'], 'one')
+        index = site.catalog['texts']
+        for docid in (1, 2, 3):
+            index.index_doc(docid, site['doc%d' % docid])
+        transaction.commit()
+        self.created = u64(self.db.lastTransaction())
+
+        site['doc1'].title = 'Doc 1 edited'
+        transaction.commit()
+        self.edited = u64(self.db.lastTransaction())
+
+        site['doc3'].attachment.data = 'two'
+        transaction.commit()
+
+        # Changed, then removed.
+        site['doc2'].title = 'Doc 2 edited'
+        transaction.commit()
+        site.remove('doc2')
+        transaction.commit()
+        self.site = site
+
+    def tearDown(self):
+        import shutil
+        import transaction
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+        shutil.rmtree(self.tmp)
+
+    def test_changed_docids(self):
+        from ZODB.utils import u64
+        from karlserve.scripts.reindex_text import changed_docids
+        last = u64(self.db.lastTransaction())
+        self.assertEqual(changed_docids(self.site, self.created, last),
+                         [1, 2, 3])
+        self.assertEqual(changed_docids(self.site, self.edited, last),
+                         [2, 3])
+        self.assertEqual(changed_docids(self.site, self.created,
+                                        self.edited), [1])
+        self.assertEqual(changed_docids(self.site, last, last), [])
+
+    def test_reindex_incremental(self):
+        from ZODB.utils import u64
+        from karlserve.scripts.reindex_text import reindex_incremental
+        last = u64(self.db.lastTransaction())
+        tid = reindex_incremental(DummyArgs(batch_size=2), self.site,
+                                  self.created)
+        self.assertEqual(tid, last)
+
+        conn = self.db.open()
+        try:
+            index = conn.root()['site'].catalog['texts']
+            self.assertEqual(dict(index.docs), {
+                1: 'Doc 1 edited',
+                3: 'Doc 3 two',
+            })
+        finally:
+            conn.close()
+
+    def test_main_records_last_tid(self):
+        from karlserve.scripts.reindex_text import main
+        instance = DummyInstance()
+        instance.last_index_tid = self.created
+        args = DummyArgs(incremental=True, batch_size=2)
+        args.get_root = lambda name: (self.site, None)
+        args.get_instance = lambda name: instance
+        main(args)
+        self.failUnless(instance.last_index_tid > self.created)
+        self.assertEqual(dict(self.site.catalog['texts'].docs), {
+            1: 'Doc 1 edited',
+            3: 'Doc 3 two',
+        })
+
+        # Nothing changed since.
+        from karlserve.scripts.reindex_text import changed_docids
+        self.assertEqual(changed_docids(
+            self.site, instance.last_index_tid, instance.last_index_tid), [])
+
+
+class TestParallelBookkeeping(unittest.TestCase):
+
+    def test_ranges_settled(self):
+        from karlserve.scripts.reindex_text import reindex_range
+        from karlserve.scripts.reindex_text import settle_progress
+        from karlserve.scripts.reindex_text import split_docids
+        site = DummySite(range(1, 11))
+        index = site.catalog['new_texts']
+        args = DummyArgs(batch_size=3)
+        ranges = split_docids(index.to_index, 2)
+        self.assertEqual(ranges, [(1, 5), (6, None)])
+        for start, end in ranges:
+            reindex_range(args, site, start, end)
+        self.assertEqual(dict(index.progress), {1: 5, 6: 10})
+        self.assertEqual(sorted(index.docs), range(1, 11))
+
+        settle_progress(index)
+        self.assertEqual(list(index.to_index), [])
+        self.assertEqual(list(index.indexed), range(1, 11))
+        self.assertEqual(len(index.progress), 0)
+
+
+class TestBatchSizer(unittest.TestCase):
+
+    def make_one(self, size=100, min_size=10, max_size=1000, commit_time=5.0,
+                 memory_growth=1000):
+        from karlserve.scripts.reindex_text import BatchSizer as cut
+        return cut(size, min_size, max_size, commit_time, memory_growth)
+
+    def test_initial_size_bounded(self):
+        self.assertEqual(self.make_one(size=5).size, 10)
+        self.assertEqual(self.make_one(size=5000).size, 1000)
+        self.assertEqual(self.make_one(min_size=0, max_size=0).size, 1)
+
+    def test_grow(self):
+        sizer = self.make_one()
+        sizer.committed(1.0, 0)
+        self.assertEqual(sizer.size, 125)
+        for i in xrange(50):
+            sizer.committed(1.0, 0)
+        self.assertEqual(sizer.size, 1000)
+
+    def test_grow_small(self):
+        sizer = self.make_one(size=1, min_size=1)
+        sizer.committed(1.0, 0)
+        self.assertEqual(sizer.size, 2)
+
+    def test_steady(self):
+        sizer = self.make_one()
+        sizer.committed(3.0, 0)
+        self.assertEqual(sizer.size, 100)
+
+    def test_shrink_slow_commit(self):
+        sizer = self.make_one()
+        sizer.committed(6.0, 0)
+        self.assertEqual(sizer.size, 50)
+        for i in xrange(10):
+            sizer.committed(6.0, 0)
+        self.assertEqual(sizer.size, 10)
+
+    def test_shrink_memory_growth(self):
+        sizer = self.make_one()
+        sizer.committed(1.0, 2000)
+        self.assertEqual(sizer.size, 50)
+
+    def test_conflicted(self):
+        sizer = self.make_one(size=15)
+        sizer.conflicted()
+        self.assertEqual(sizer.size, 10)
+
+
+class TestProgress(unittest.TestCase):
+
+    def setUp(self):
+        import logging
+        self.records = records = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+        self.handler = Handler()
+        self.logger = logging.getLogger('karlserve.scripts.reindex_text')
+        self.logger.addHandler(self.handler)
+        self.level = self.logger.level
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(self.level)
+
+    def make_one(self, total, interval=60.0):
+        from karlserve.scripts.reindex_text import Progress as cut
+        return cut(total, interval)
+
+    def test_report(self):
+        progress = self.make_one(100)
+        progress.started -= 10
+        progress.text_bytes = 1048576
+        progress.committed(20)
+        progress.text_bytes = 1048576
+        progress.conflicted()
+        progress.committed(30)
+        progress.report(50)
+        self.assertEqual(self.records, [
+            "Reindexed 50/100 documents (5.0 docs/s, 1.0 MB of text), "
+            "1 conflicts retried, batch size 50, ETA 0:00:10."])
+
+    def test_report_nothing_done(self):
+        progress = self.make_one(100)
+        progress.report(50)
+        self.failUnless(self.records[0].endswith('ETA unknown.'))
+
+    def test_maybe_report(self):
+        progress = self.make_one(100, interval=60)
+        progress.maybe_report(50)
+        self.assertEqual(self.records, [])
+        progress.reported -= 60
+        progress.maybe_report(50)
+        self.assertEqual(len(self.records), 1)
+
+
+class Test_main(unittest.TestCase):
+
+    def test_workers_need_pg(self):
+        from karlserve.scripts.reindex_text import main
+        site = DummySite(range(1, 11))
+        args = DummyArgs(workers=2)
+        args.get_root = lambda name: (site, None)
+        try:
+            main(args)
+        except ValueError, e:
+            self.failUnless('--workers' in str(e))
+        else:
+            self.fail("Expected an error.")
+        self.assertEqual(site.catalog['new_texts'].docs, {})
+
+
+class DummyArgs(object):
+    inst = 'instance'
+    show = False
+    incremental = False
+    since_tid = None
+    convert_to = None
+    workers = 1
+    batch_size = 500
+    min_batch_size = 1
+    max_batch_size = 5000
+    commit_time = 5.0
+    memory_growth = 256 << 20
+    report_interval = 60.0
+
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+        self.parser = DummyParser()
+
+    def get_instance(self, name):
+        return DummyInstance()
+
+
+class DummyParser(object):
+
+    def error(self, msg):
+        raise ValueError(msg)
+
+
+class DummyInstance(object):
+    last_index_tid = None
+
+
+class DummyIndex(object):
+
+    def __init__(self, docids=()):
+        from BTrees.IFBTree import IFTreeSet
+        from BTrees.IIBTree import IIBTree
+        self.to_index = IFTreeSet(docids)
+        self.indexed = IFTreeSet()
+        self.progress = IIBTree()
+        self.docs = {}
+
+    def index_doc(self, docid, doc):
+        self.docs[docid] = doc
+
+    def unindex_doc(self, docid):
+        self.docs.pop(docid, None)
+
+
+class DummyDocumentMap(object):
+
+    def __init__(self, docids):
+        from BTrees.IOBTree import IOBTree
+        self.docid_to_address = IOBTree()
+        for docid in docids:
+            self.docid_to_address[docid] = '/doc%d' % docid
+
+    def address_for_docid(self, docid):
+        return self.docid_to_address.get(docid)
+
+
+class DummyCatalog(dict):
+
+    def __init__(self, docids):
+        self.document_map = DummyDocumentMap(docids)
+        self['texts'] = DummyIndex()
+        self['new_texts'] = DummyIndex(docids)
+
+
+class DummyResource(dict):
+
+    def __init__(self, name, parent, docid=None):
+        self.__name__ = name
+        self.__parent__ = parent
+        if docid is not None:
+            self.docid = docid
+
+
+class DummySite(DummyResource):
+
+    def __init__(self, docids):
+        DummyResource.__init__(self, '', None)
+        self.catalog = DummyCatalog(docids)
+        self._p_jar = DummyJar()
+        for docid in docids:
+            name = 'doc%d' % docid
+            self[name] = DummyResource(name, self, docid)
+
+
+class DummyJar(object):
+
+    def db(self):
+        return self
+
+    def cacheMinimize(self):
+        pass
+
+
+# Stored in a FileStorage, so these must be importable and persistent.
+from persistent import Persistent
+from persistent.mapping import PersistentMapping
+
+
+class DummyStoredSite(PersistentMapping):
+    __name__ = ''
+    __parent__ = None
+
+    def __init__(self):
+        PersistentMapping.__init__(self)
+        self.catalog = DummyStoredCatalog()
+
+    def add(self, doc):
+        name = 'doc%d' % doc.docid
+        doc.__name__ = name
+        doc.__parent__ = self
+        self[name] = doc
+        self.catalog.document_map.docid_to_address[doc.docid] = '/' + name
+
+    def remove(self, name):
+        doc = self.pop(name)
+        del self.catalog.document_map.docid_to_address[doc.docid]
+
+
+class DummyStoredDocument(Persistent):
+    __name__ = __parent__ = None
+    attachment = None
+
+    def __init__(self, docid, title):
+        self.docid = docid
+        self.title = title
+
+
+class DummyStoredAttachment(Persistent):
+
+    def __init__(self, parent, data):
+        self.__parent__ = parent
+        self.data = data
+
+
+class DummyStoredCatalog(PersistentMapping):
+
+    def __init__(self):
+        PersistentMapping.__init__(self)
+        self.document_map = DummyStoredDocumentMap()
+        self['texts'] = DummyStoredIndex()
+
+
+class DummyStoredDocumentMap(Persistent):
+
+    def __init__(self):
+        from BTrees.IOBTree import IOBTree
+        self.docid_to_address = IOBTree()
+
+    def address_for_docid(self, docid):
+        return self.docid_to_address.get(docid)
+
+
+class DummyStoredIndex(Persistent):
+
+    def __init__(self):
+        from BTrees.IOBTree import IOBTree
+        self.docs = IOBTree()
+
+    def index_doc(self, docid, doc):
+        text = doc.title
+        if doc.attachment is not None:
+            text = '%s %s' % (text, doc.attachment.data)
+        self.docs[docid] = text
+
+    def unindex_doc(self, docid):
+        if docid in self.docs:
+            del self.docs[docid]
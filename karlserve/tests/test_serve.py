@@ -0,0 +1,508 @@
+from __future__ import with_statement
+
+import unittest
+
+
+class Test_prefork(unittest.TestCase):
+
+    def setUp(self):
+        from repoze.depinj import clear
+        clear()
+
+        from repoze.depinj import inject
+        from karlserve.scripts.serve import Master
+        from karlserve.scripts.serve import load_app
+        from karlserve.scripts.serve import serve
+        inject(DummyMaster, Master)
+        inject(dummy_load_app, load_app)
+        # Each injected fixture is used up by a single lookup.
+        for i in range(4):
+            inject(DummyServer, serve)
+
+    def tearDown(self):
+        from repoze.depinj import clear
+        clear()
+
+    def call_fut(self, args):
+        from karlserve.scripts.serve import prefork as fut
+        return fut(args)
+
+    def test_shared_socket(self):
+        args = DummyArgs(workers=4)
+        self.assertEqual(self.call_fut(args), 'ran')
+        master = args.instances.master
+        self.assertEqual([server.address for server in master.servers],
+                         [('127.0.0.1', 8080)])
+        self.assertEqual(master.workers, 4)
+        self.failUnless(master.app.app is args.app)
+        self.assertEqual(master.app.threads, 10)
+        self.assertEqual(args.loaded, (10, False))
+        self.failUnless(args.instances.closed)
+
+    def test_threads(self):
+        args = DummyArgs(workers=4, threads=3)
+        self.call_fut(args)
+        master = args.instances.master
+        self.assertEqual(master.app.threads, 3)
+        self.assertEqual(args.loaded, (3, False))
+
+    def test_sharded(self):
+        from karlserve.instance import Sharding
+        args = DummyArgs(workers=3, sharding=Sharding(3), port=9000)
+        self.call_fut(args)
+        servers = args.instances.master.servers
+        self.assertEqual([server.address for server in servers],
+                         [('127.0.0.1', 9000), ('127.0.0.1', 9001),
+                          ('127.0.0.1', 9002)])
+
+    def test_sharded_workers_mismatch(self):
+        from karlserve.instance import Sharding
+        args = DummyArgs(workers=4, sharding=Sharding(3))
+        self.assertRaises(ValueError, self.call_fut, args)
+
+
+class TestKarlServeCommand(unittest.TestCase):
+
+    def test_loadapp(self):
+        from paste.script.serve import ServeCommand
+        from karlserve.scripts.serve import KarlServeCommand
+        loaded = []
+        def loadapp(self, app_spec, name, relative_to, **kw):
+            loaded.append(kw)
+            return 'app'
+        saved = ServeCommand.loadapp
+        ServeCommand.loadapp = loadapp
+        try:
+            cmd = KarlServeCommand('karlserve serve')
+            app = cmd.loadapp('config:karlserve.ini', 'main', '.',
+                              global_conf={'here': '.'})
+        finally:
+            ServeCommand.loadapp = saved
+        self.assertEqual(app, 'app')
+        self.assertEqual(loaded, [{'global_conf': {
+            'here': '.', 'karlserve.serve': 'true'}}])
+
+    def test_loadapp_server_threads(self):
+        from paste.script.serve import ServeCommand
+        from karlserve.scripts.serve import KarlServeCommand
+        loaded = []
+        def loadapp(self, app_spec, name, relative_to, **kw):
+            loaded.append(kw)
+            return 'app'
+        saved = ServeCommand.loadapp
+        ServeCommand.loadapp = loadapp
+        try:
+            cmd = KarlServeCommand('karlserve serve')
+            cmd.server_threads = 20
+            cmd.loadapp('config:karlserve.ini', 'main', '.')
+        finally:
+            ServeCommand.loadapp = saved
+        self.assertEqual(loaded, [{'global_conf': {
+            'karlserve.serve': 'true', 'karlserve.server_threads': '20'}}])
+
+
+class Test_load_app(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmp = tempfile.mkdtemp('.karlserve_tests')
+        self.config = os.path.join(self.tmp, 'karlserve.ini')
+        with open(self.config, 'w') as f:
+            f.write(pipeline_config)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def call_fut(self, threads, preload=True):
+        from karlserve.scripts.serve import KarlServeCommand
+        from karlserve.scripts.serve import load_app as fut
+        logged = []
+        def logging_file_config(self, config_file):
+            logged.append(config_file)
+        saved = KarlServeCommand.logging_file_config
+        KarlServeCommand.logging_file_config = logging_file_config
+        try:
+            return logged, fut(DummyArgs(workers=0, config=self.config),
+                               threads, preload)
+        finally:
+            KarlServeCommand.logging_file_config = saved
+
+    def test_pipeline(self):
+        logged, (app, settings) = self.call_fut(20)
+        self.assertEqual(logged, [self.config])
+        self.failUnless(isinstance(app, DummyFilter))
+        self.failUnless(app.app.registry.settings is settings)
+        self.assertEqual(settings['karlserve.serve'], 'true')
+        self.assertEqual(settings['karlserve.server_threads'], '20')
+        self.assertEqual(settings['foo'], 'bar')
+
+    def test_no_preload(self):
+        logged, (app, settings) = self.call_fut(5, preload=False)
+        self.failIf('karlserve.serve' in settings)
+        self.assertEqual(settings['karlserve.server_threads'], '5')
+
+
+class Test_server_address(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmp = tempfile.mkdtemp('.karlserve_tests')
+        self.config = os.path.join(self.tmp, 'karlserve.ini')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def call_fut(self, server_main=None, **kw):
+        from karlserve.scripts.serve import server_address as fut
+        if server_main is not None:
+            with open(self.config, 'w') as f:
+                f.write('[server:main]\nuse = egg:Paste#http\n')
+                f.write(server_main)
+        args = DummyArgs(workers=0, config=self.config)
+        args.__dict__.update(kw)
+        return fut(args)
+
+    def test_no_config(self):
+        self.assertEqual(self.call_fut(), ('127.0.0.1', 8080))
+
+    def test_config(self):
+        self.assertEqual(self.call_fut('host = 0.0.0.0\nport = 6543\n'),
+                         ('0.0.0.0', 6543))
+
+    def test_options_win(self):
+        self.assertEqual(self.call_fut('host = 0.0.0.0\nport = 6543\n',
+                                       host='10.0.0.1', port=7000),
+                         ('10.0.0.1', 7000))
+
+
+class Test_server_threads(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmp = tempfile.mkdtemp('.karlserve_tests')
+        self.config = os.path.join(self.tmp, 'karlserve.ini')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def call_fut(self, server_main=None):
+        from karlserve.scripts.serve import server_threads as fut
+        if server_main is not None:
+            with open(self.config, 'w') as f:
+                f.write('[server:main]\nuse = egg:Paste#http\n')
+                f.write(server_main)
+        return fut(DummyArgs(workers=0, config=self.config))
+
+    def test_no_config(self):
+        self.assertEqual(self.call_fut(), 10)
+
+    def test_default(self):
+        self.assertEqual(self.call_fut(''), 10)
+
+    def test_threadpool_workers(self):
+        self.assertEqual(self.call_fut('threadpool_workers = 25\n'), 25)
+
+    def test_no_threadpool(self):
+        self.assertEqual(self.call_fut('use_threadpool = false\n'), None)
+
+
+class TestWorkerApp(unittest.TestCase):
+
+    def make_one(self, app, max_requests=0, threads=0):
+        from karlserve.scripts.serve import WorkerApp as cut
+        return cut(app, max_requests, threads)
+
+    def test_call(self):
+        calls = []
+
+        def app(environ, start_response):
+            calls.append((environ, start_response))
+            return ['ok']
+
+        worker = self.make_one(app)
+        self.assertEqual(worker({'a': 1}, 'start'), ['ok'])
+        self.assertEqual(calls, [({'a': 1}, 'start')])
+        self.assertEqual(worker.requests, 1)
+
+    def test_max_requests(self):
+        import threading
+        worker = self.make_one(lambda environ, start_response: ['ok'],
+                               max_requests=2)
+        worker.server = server = DummyServer(None, 'localhost', 0, False,
+                                             False)
+        worker({}, None)
+        self.failIf(server.shut_down.isSet())
+        # The request which reaches the limit is still served.
+        self.assertEqual(worker({}, None), ['ok'])
+        server.shut_down.wait(5)
+        self.failUnless(server.shut_down.isSet())
+        self.failIf(server.shut_down_from is threading.currentThread())
+
+    def test_threads(self):
+        import threading
+        import time
+        lock = threading.Lock()
+        running = []
+        most = []
+
+        def app(environ, start_response):
+            with lock:
+                running.append(1)
+                most.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+            return ['ok']
+
+        worker = self.make_one(app, threads=2)
+        threads = [threading.Thread(target=worker, args=({}, None))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(worker.requests, 6)
+        self.assertEqual(max(most), 2)
+
+
+class Test_gevent_main(unittest.TestCase):
+
+    def setUp(self):
+        import sys
+        import types
+        from karlserve.scripts import main
+        self.calls = calls = []
+        gevent = types.ModuleType('gevent')
+        gevent.monkey = types.ModuleType('gevent.monkey')
+        gevent.monkey.patch_all = lambda: calls.append('patch_all')
+        psycogreen = types.ModuleType('psycogreen')
+        psycogreen.gevent = types.ModuleType('psycogreen.gevent')
+        psycogreen.gevent.patch_psycopg = (
+            lambda: calls.append('patch_psycopg'))
+        modules = {
+            'gevent': gevent,
+            'gevent.monkey': gevent.monkey,
+            'psycogreen': psycogreen,
+            'psycogreen.gevent': psycogreen.gevent,
+        }
+        self.saved_modules = dict((name, sys.modules.get(name))
+                                  for name in modules)
+        sys.modules.update(modules)
+        self.saved_main = main.main
+        main.main = lambda argv, out: calls.append(('main', argv, out))
+
+    def tearDown(self):
+        import sys
+        from karlserve.scripts import main
+        main.main = self.saved_main
+        for name, module in self.saved_modules.items():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+
+    def test_patch_then_run(self):
+        from karlserve.scripts.gevent_main import main as fut
+        fut(['karlserve-gevent', 'serve', '--gevent'], 'out')
+        self.assertEqual(self.calls, [
+            'patch_all',
+            'patch_psycopg',
+            ('main', ['karlserve-gevent', 'serve', '--gevent'], 'out')])
+
+
+class Test_serve_gevent(unittest.TestCase):
+
+    def setUp(self):
+        import sys
+        import types
+        from repoze.depinj import clear
+        from repoze.depinj import inject
+        from karlserve.scripts.serve import load_app
+        clear()
+        inject(dummy_load_app, load_app)
+        self.servers = servers = []
+
+        class WSGIServer(object):
+
+            def __init__(self, address, app, spawn, log):
+                self.address = address
+                self.app = app
+                self.spawn = spawn
+                servers.append(self)
+
+            def serve_forever(self):
+                self.served = True
+
+            def stop(self, timeout):
+                pass
+
+        gevent = types.ModuleType('gevent')
+        gevent.signal = lambda signum, handler, *args: None
+        gevent.monkey = types.ModuleType('gevent.monkey')
+        gevent.monkey.is_module_patched = lambda name: True
+        gevent.pool = types.ModuleType('gevent.pool')
+        gevent.pool.Pool = lambda size: size
+        gevent.pywsgi = types.ModuleType('gevent.pywsgi')
+        gevent.pywsgi.WSGIServer = WSGIServer
+        modules = {
+            'gevent': gevent,
+            'gevent.monkey': gevent.monkey,
+            'gevent.pool': gevent.pool,
+            'gevent.pywsgi': gevent.pywsgi,
+        }
+        self.saved_modules = dict((name, sys.modules.get(name))
+                                  for name in modules)
+        sys.modules.update(modules)
+
+    def tearDown(self):
+        import sys
+        from repoze.depinj import clear
+        clear()
+        for name, module in self.saved_modules.items():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+
+    def test_serve_loaded_app(self):
+        from karlserve.scripts.serve import serve_gevent as fut
+        args = DummyArgs(workers=0, port=6544)
+        args.connections = 500
+        self.assertEqual(fut(args), 0)
+        server, = self.servers
+        self.assertEqual(server.address, ('127.0.0.1', 6544))
+        self.failUnless(server.app is args.app)
+        self.assertEqual(server.spawn, 500)
+        self.failUnless(server.served)
+        self.assertEqual(args.loaded, (500, True))
+
+
+class TestMaster(unittest.TestCase):
+
+    def make_one(self, servers, workers):
+        from karlserve.scripts.serve import Master as cut
+        return cut(servers, None, {}, workers)
+
+    def test_server_shared(self):
+        master = self.make_one(['server'], 4)
+        self.assertEqual(master.server(0), 'server')
+        self.assertEqual(master.server(3), 'server')
+
+    def test_server_per_worker(self):
+        master = self.make_one(['zero', 'one', 'two'], 3)
+        self.assertEqual(master.server(0), 'zero')
+        self.assertEqual(master.server(2), 'two')
+
+
+class DummyArgs(object):
+    config = 'does/not/exist.ini'
+    host = None
+    port = None
+    max_requests = 0
+    graceful_timeout = 30
+
+    def __init__(self, workers, sharding=None, port=None, threads=None,
+                 config=None):
+        self.workers = workers
+        self.port = port
+        self.threads = threads
+        if config is not None:
+            self.config = config
+        self.instances = DummyInstances(sharding)
+        self.app = DummyApp({'instances': self.instances})
+        self.parser = DummyParser()
+
+
+def dummy_load_app(args, threads, preload=True):
+    args.loaded = (threads, preload)
+    return args.app, args.app.registry.settings
+
+
+def dummy_app_factory(global_conf, **local_conf):
+    from pyramid.config import Configurator
+    settings = global_conf.copy()
+    settings.update(local_conf)
+    return Configurator(settings=settings).make_wsgi_app()
+
+
+class DummyFilter(object):
+
+    def __init__(self, app):
+        self.app = app
+
+    @classmethod
+    def factory(cls, global_conf, **local_conf):
+        return cls
+
+
+pipeline_config = """
+[app:karl]
+paste.app_factory = karlserve.tests.test_serve:dummy_app_factory
+foo = bar
+
+[filter:dummy]
+paste.filter_factory = karlserve.tests.test_serve:DummyFilter.factory
+
+[pipeline:main]
+pipeline = dummy karl
+"""
+
+
+class DummyParser(object):
+
+    def error(self, msg):
+        raise ValueError(msg)
+
+
+class DummyApp(object):
+
+    def __init__(self, settings):
+        self.registry = DummyRegistry(settings)
+
+
+class DummyRegistry(object):
+
+    def __init__(self, settings):
+        self.settings = settings
+
+
+class DummyInstances(object):
+    closed = False
+
+    def __init__(self, sharding):
+        self.sharding = sharding
+
+    def close(self):
+        self.closed = True
+
+
+class DummyServer(object):
+
+    def __init__(self, app, host, port, use_threadpool, start_loop):
+        import threading
+        self.address = (host, port)
+        self.shut_down = threading.Event()
+
+    def shutdown(self):
+        import threading
+        self.shut_down_from = threading.currentThread()
+        self.shut_down.set()
+
+
+class DummyMaster(object):
+
+    def __init__(self, servers, app, settings, workers, graceful_timeout):
+        self.servers = servers
+        self.app = app
+        self.settings = settings
+        self.workers = workers
+        settings['instances'].master = self
+
+    def run(self):
+        return 'ran'
@@ -0,0 +1,170 @@
+from __future__ import with_statement
+
+import unittest
+
+
+class Test_database_registry(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp('.karlserve_tests')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def register(self):
+        from karlserve.storage import register_database
+        return register_database('foo', 'zodb.conf', self.open_storage,
+                                 cache_size=1234, pool_size=5)
+
+    def open_storage(self):
+        from ZODB.FileStorage import FileStorage
+        return FileStorage(self.storage_path())
+
+    def storage_path(self):
+        import os
+        return os.path.join(self.tmp, 'Data.fs')
+
+    def test_register_unregister(self):
+        from karlserve.storage import get_database
+        from karlserve.storage import unregister_database
+        uri = self.register()
+        self.failUnless(uri.startswith('karlserve://foo/'), uri)
+        self.failUnless(uri.endswith('/zodb.conf'), uri)
+        self.assertNotEqual(uri, self.register())
+        self.assertEqual(get_database(uri),
+                         (self.open_storage, {'cache_size': 1234,
+                                              'pool_size': 5}))
+        unregister_database(uri)
+        self.assertRaises(ValueError, get_database, uri)
+
+    def test_register_unknown_option(self):
+        from karlserve.storage import register_database
+        self.assertRaises(TypeError, register_database, 'foo', 'zodb.conf',
+                          self.open_storage, cache_size=1234, foo='bar')
+
+    def test_db_from_karlserve_uri(self):
+        from karlserve.storage import db_from_karlserve_uri
+        databases = {}
+        db = db_from_karlserve_uri(self.register(), '', databases)
+        try:
+            self.failUnless(databases[''] is db)
+            self.assertEqual(db.getCacheSize(), 1234)
+            self.assertEqual(db.getPoolSize(), 5)
+        finally:
+            db.close()
+
+    def test_storage_from_uri(self):
+        from karlserve.storage import _storage_from_uri
+        storage = _storage_from_uri(self.register())
+        try:
+            self.assertEqual(storage.getName(), self.storage_path())
+        finally:
+            storage.close()
+
+    def test_resolve_karlserve_uri(self):
+        from karlserve.storage import resolve_karlserve_uri
+        factory, dbkw = resolve_karlserve_uri(self.register())
+        self.assertEqual(dbkw, {'connection_cache_size': 1234,
+                                'connection_pool_size': 5})
+        storage = factory()
+        storage.close()
+
+    def test_zodburi_resolve_uri(self):
+        import zodburi
+        from karlserve.storage import register_database
+        from karlserve.storage import resolve_karlserve_uri
+        uri = register_database('foo', 'zodb.conf', self.open_storage,
+                                cache_size=1234, pool_size=5,
+                                cache_size_bytes=1 << 20)
+
+        class DummyEntryPoint(object):
+            name = 'karlserve'
+
+            def load(self):
+                return resolve_karlserve_uri
+
+        saved = zodburi.iter_entry_points
+        zodburi.iter_entry_points = lambda group: [DummyEntryPoint()]
+        try:
+            factory, dbkw = zodburi.resolve_uri(uri)
+        finally:
+            zodburi.iter_entry_points = saved
+        self.assertEqual(dbkw['cache_size'], 1234)
+        self.assertEqual(dbkw['pool_size'], 5)
+        storage = factory()
+        storage.close()
+
+
+class TestRelStorageFactory(unittest.TestCase):
+
+    def make_one(self, *args, **kw):
+        from karlserve.storage import RelStorageFactory as cut
+        return cut(*args, **kw)
+
+    def test_defaults(self):
+        factory = self.make_one('dbname=karl', 'var/blob_cache')
+        options = factory.options()
+        self.assertEqual(options.blob_dir, 'var/blob_cache')
+        self.assertEqual(options.shared_blob_dir, False)
+        self.assertEqual(options.blob_cache_size, 8 << 30)
+        self.assertEqual(options.keep_history, False)
+        self.assertEqual(options.read_only, False)
+        self.assertEqual(options.cache_servers, ())
+
+    def test_settings_as_strings(self):
+        factory = self.make_one('dbname=karl', 'var/blob_cache',
+                                keep_history='true', read_only='false',
+                                blob_cache_size='2gb', poll_interval='0')
+        options = factory.options()
+        self.assertEqual(options.keep_history, True)
+        self.assertEqual(options.read_only, False)
+        self.assertEqual(options.blob_cache_size, 2 << 30)
+
+    def test_cache_servers(self):
+        factory = self.make_one('dbname=karl', 'var/blob_cache',
+                                cache_servers='host1:11211 host2:11211',
+                                cache_prefix='karl')
+        options = factory.options()
+        self.assertEqual(options.cache_servers, 'host1:11211 host2:11211')
+        self.assertEqual(options.cache_prefix, 'karl')
+
+
+class Test_zconfig_uri(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmp = tempfile.mkdtemp('.karlserve_tests')
+        self.path = os.path.join(self.tmp, 'zodb.conf')
+        with open(self.path, 'w') as f:
+            f.write(zconfig_template % {
+                'path': os.path.join(self.tmp, 'Data.fs')})
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def test_storage_from_uri(self):
+        import os
+        from karlserve.storage import _storage_from_uri
+        storage = _storage_from_uri('zconfig://%s' % self.path)
+        try:
+            self.assertEqual(storage.getName(),
+                             os.path.join(self.tmp, 'Data.fs'))
+        finally:
+            storage.close()
+
+    def test_schema_parsed_once(self):
+        from karlserve.storage import _ZConfigURIResolver
+        from karlserve.storage import _load_schema
+        schema_xml = _ZConfigURIResolver.schema_xml_template
+        self.failUnless(_load_schema(schema_xml) is _load_schema(schema_xml))
+
+
+zconfig_template = """
+<filestorage>
+  path %(path)s
+</filestorage>
+"""
@@ -1,4 +1,5 @@
 from karl.utils import get_setting
+from karlserve.connstats import CountingCursor
 
 try:
     from repoze.pgtextindex import PGTextIndex
@@ -73,3 +74,8 @@ class KarlPGTextIndex(PGTextIndex):
             maxlen = int(get_setting(self, 'pgtextindex.maxlen', 1048575))
             self._v_maxlen = maxlen
         return maxlen
+
+    @property
+    def cursor(self):
+        # Counts the statements executed, for the per request statistics.
+        return CountingCursor(super(KarlPGTextIndex, self).cursor)
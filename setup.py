@@ -32,7 +32,7 @@ except IOError:
 
 requires = [
     'pyramid_tm',
-    'pyramid_zodbconn',
+    'pyramid_zodbconn>=0.5',
     'karl',
     'repoze.depinj',
     'repoze.retry',
@@ -42,6 +42,7 @@ requires = [
 
 if sys.version_info[:2] < (2, 7):
     requires.append('argparse')
+    requires.append('ordereddict')
 
 setup(name='karlserve',
       version=__version__,
@@ -64,6 +65,9 @@ setup(name='karlserve',
       include_package_data=True,
       zip_safe=False,
       install_requires = requires,
+      extras_require = {
+          'gevent': ['gevent', 'psycogreen'],
+      },
       tests_require = requires,
       test_suite="karlserve",
       entry_points = """\
@@ -74,8 +78,13 @@ setup(name='karlserve',
 
       [console_scripts]
       karlserve = karlserve.scripts.main:main
+      karlserve-gevent = karlserve.scripts.gevent_main:main
+
+      [zodburi.resolvers]
+      karlserve = karlserve.storage:resolve_karlserve_uri
 
       [karlserve.scripts]
+      copy_storage = karlserve.scripts.copy_storage:config_parser
       create_mailin_trace = karlserve.scripts.create_mailin_trace:config_parser
       debug = karlserve.scripts.debug:config_parser
       digest = karlserve.scripts.digest:config_parser
@@ -89,6 +98,7 @@ setup(name='karlserve',
       samplegen = karlserve.scripts.samplegen:config_parser
       serve = karlserve.scripts.serve:config_parser
       settings = karlserve.scripts.settings:config_parser
+      shards = karlserve.scripts.shards:config_parser
       reindex_text = karlserve.scripts.reindex_text:config_parser
       """
       )